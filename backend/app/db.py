@@ -1,18 +1,25 @@
 import os
 import logging
-from sqlalchemy import text
+import datetime as dt
+from sqlalchemy import text, bindparam
 from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine, async_sessionmaker
 
+from . import search, stats
 from .models import (
     Base,
     Driver,
     Order,
+    OrderEvent,
     Payout,
+    PayoutItem,
     DeliveryNote,
     DeliveryNoteItem,
     EmployeeLog,
     VerificationOrder,
     Merchant,
+    ShopifyOrder,
+    DriverDailyStats,
+    JobStatus,
 )
 
 logger = logging.getLogger(__name__)
@@ -30,6 +37,61 @@ async def get_session() -> AsyncSession:
         yield session
 
 
+def _is_date(value: str) -> bool:
+    try:
+        dt.datetime.strptime(value.strip(), "%Y-%m-%d")
+    except ValueError:
+        return False
+    return True
+
+
+async def _set_aside_bad_dates(conn, table: str, column: str) -> None:
+    """Clear values of a text date column that cannot be cast to DATE."""
+    result = await conn.execute(
+        text(f"SELECT DISTINCT {column} FROM {table} WHERE {column} IS NOT NULL")
+    )
+    bad = [value for (value,) in result if not _is_date(value)]
+    if not bad:
+        return
+
+    async def run(sql: str):
+        stmt = text(f"{sql} WHERE {column} IN :bad")
+        return await conn.execute(stmt.bindparams(bindparam("bad", expanding=True)), {"bad": bad})
+
+    if table == "orders":
+        # The orders stay, without a scan day; the raw values are kept aside
+        await conn.execute(
+            text(
+                "CREATE TABLE IF NOT EXISTS orders_invalid_scan_date "
+                "(order_id INTEGER, scan_date VARCHAR)"
+            )
+        )
+        await run(
+            "INSERT INTO orders_invalid_scan_date (order_id, scan_date) "
+            "SELECT id, scan_date FROM orders"
+        )
+        result = await run("UPDATE orders SET scan_date = NULL")
+        logger.warning(
+            "Cleared the scan_date of %d orders that was not YYYY-MM-DD (e.g. %r); "
+            "the old values are in orders_invalid_scan_date",
+            result.rowcount,
+            bad[0],
+        )
+    else:
+        # Rollup rows are derived: drop them and let init_db rebuild the rollup
+        result = await run(f"DELETE FROM {table}")
+        await conn.execute(
+            text("DELETE FROM job_status WHERE name = :name"), {"name": stats.ROLLUP_MARKER}
+        )
+        logger.warning(
+            "Dropped %d %s rows whose %s was not YYYY-MM-DD (e.g. %r)",
+            result.rowcount,
+            table,
+            column,
+            bad[0],
+        )
+
+
 async def init_db() -> None:
     """Create tables and ensure default drivers exist."""
     logger.info("Initializing database")
@@ -85,6 +147,113 @@ async def init_db() -> None:
             if not result.first():
                 await conn.execute(text("ALTER TABLE orders ADD COLUMN return_time TIMESTAMP"))
 
+            result = await conn.execute(
+                text(
+                    "SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name='orders' AND column_name='change_version'"
+                )
+            )
+            if not result.first():
+                await conn.execute(text("ALTER TABLE orders ADD COLUMN change_version BIGINT DEFAULT 0"))
+                await conn.execute(
+                    text(
+                        "CREATE INDEX IF NOT EXISTS ix_orders_driver_change_version "
+                        "ON orders (driver_id, change_version)"
+                    )
+                )
+
+            result = await conn.execute(
+                text(
+                    "SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name='drivers' AND column_name='change_version'"
+                )
+            )
+            if not result.first():
+                await conn.execute(text("ALTER TABLE drivers ADD COLUMN change_version BIGINT DEFAULT 0"))
+
+            for column, index in (
+                ("last_status_at", "ix_orders_driver_last_status_at"),
+                ("scheduled_at", "ix_orders_driver_scheduled_at"),
+            ):
+                result = await conn.execute(
+                    text(
+                        "SELECT column_name FROM information_schema.columns "
+                        f"WHERE table_name='orders' AND column_name='{column}'"
+                    )
+                )
+                if not result.first():
+                    await conn.execute(text(f"ALTER TABLE orders ADD COLUMN {column} TIMESTAMP"))
+                    await conn.execute(
+                        text(
+                            f"CREATE INDEX IF NOT EXISTS {index} "
+                            f"ON orders (driver_id, {column})"
+                        )
+                    )
+
+            # scan_date used to be a "YYYY-MM-DD" string
+            for table, column in (("orders", "scan_date"), ("driver_daily_stats", "day")):
+                result = await conn.execute(
+                    text(
+                        "SELECT data_type FROM information_schema.columns "
+                        f"WHERE table_name='{table}' AND column_name='{column}'"
+                    )
+                )
+                row = result.first()
+                if row and row[0] != "date":
+                    await _set_aside_bad_dates(conn, table, column)
+                    logger.info("Converting %s.%s to DATE", table, column)
+                    await conn.execute(
+                        text(
+                            f"ALTER TABLE {table} ALTER COLUMN {column} TYPE DATE "
+                            f"USING {column}::date"
+                        )
+                    )
+
+            for index, definition in (
+                ("ix_orders_driver_scan_date", "orders (driver_id, scan_date)"),
+                ("ix_orders_driver_status", "orders (driver_id, delivery_status)"),
+                ("ix_delivery_note_items_order_note", "delivery_note_items (order_id, note_id)"),
+            ):
+                await conn.execute(text(f"CREATE INDEX IF NOT EXISTS {index} ON {definition}"))
+
+            result = await conn.execute(
+                text("SELECT 1 FROM pg_indexes WHERE indexname='uq_orders_driver_order_name'")
+            )
+            if not result.first():
+                result = await conn.execute(
+                    text(
+                        "SELECT driver_id, order_name FROM orders "
+                        "GROUP BY driver_id, order_name HAVING COUNT(*) > 1 LIMIT 1"
+                    )
+                )
+                if result.first():
+                    logger.warning(
+                        "Duplicate (driver_id, order_name) rows in orders; "
+                        "uq_orders_driver_order_name not created"
+                    )
+                else:
+                    await conn.execute(
+                        text(
+                            "CREATE UNIQUE INDEX uq_orders_driver_order_name "
+                            "ON orders (driver_id, order_name)"
+                        )
+                    )
+
+            for column in ("order_number", "phone_digits"):
+                result = await conn.execute(
+                    text(
+                        "SELECT column_name FROM information_schema.columns "
+                        f"WHERE table_name='orders' AND column_name='{column}'"
+                    )
+                )
+                if not result.first():
+                    await conn.execute(text(f"ALTER TABLE orders ADD COLUMN {column} VARCHAR"))
+                    await conn.execute(
+                        text(f"CREATE INDEX IF NOT EXISTS ix_orders_{column} ON orders ({column})")
+                    )
+
+        await search.create_indexes(conn)
+
     default_drivers = ["abderrehman", "anouar", "mohammed", "nizar"]
     async with AsyncSessionLocal() as session:
         for d_id in default_drivers:
@@ -102,5 +271,14 @@ async def init_db() -> None:
             )
         )
         await session.commit()
+
+        # Before any write path can track() into a rollup missing older orders
+        try:
+            built = await stats.backfill(session)
+        except Exception:
+            logger.exception("Building driver_daily_stats failed; retried by order_backfill")
+        else:
+            if built:
+                logger.info("Built %d driver_daily_stats rows", built)
     logger.info("Database initialization complete")
 
@@ -0,0 +1,247 @@
+"""Order timeline events.
+
+Status changes, driver notes and return acceptances used to be appended to
+``Order.status_log`` / ``Order.driver_notes`` as ever-growing strings.  Each
+one is now a row in ``order_events``.  The legacy ``statusLog`` and
+``driverNotes`` strings are still rendered for the existing clients, from
+whatever the old columns hold followed by the events.
+"""
+
+import datetime as dt
+from typing import Iterable, Optional, Sequence
+
+from sqlalchemy import select, insert, and_, or_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Order, OrderEvent
+
+STATUS = "status"
+DRIVER_NOTE = "driver_note"
+RETURN_ACCEPTED = "return_accepted"
+SCAN = "scan"
+# Kinds rendered into the legacy statusLog / driverNotes strings
+LOG_KINDS = (STATUS, DRIVER_NOTE, RETURN_ACCEPTED)
+# Kinds that count as the order's last status update for follow-ups
+STATUS_KINDS = (SCAN, STATUS, RETURN_ACCEPTED)
+
+STATUS_TS_FORMAT = "%Y-%m-%d %H:%M:%S"
+NOTE_TS_FORMAT = "%Y-%m-%d %H:%M"
+
+
+def record(
+    session: AsyncSession,
+    order: Order,
+    kind: str,
+    *,
+    status: Optional[str] = None,
+    actor: Optional[str] = None,
+    text: Optional[str] = None,
+) -> OrderEvent:
+    """Add an event for ``order`` (already flushed) stamped with local time.
+
+    Status-like events also move ``order.last_status_at`` forward.
+    """
+    event = OrderEvent(
+        order_id=order.id,
+        kind=kind,
+        status=status,
+        actor=actor,
+        text=text,
+        ts=dt.datetime.now().replace(microsecond=0),
+    )
+    session.add(event)
+    if kind in STATUS_KINDS:
+        order.last_status_at = event.ts
+    return event
+
+
+async def record_bulk(
+    session: AsyncSession,
+    order_ids: Sequence[int],
+    kind: str,
+    *,
+    status: Optional[str] = None,
+    actor: Optional[str] = None,
+) -> dt.datetime:
+    """Add the same event to many orders with one INSERT; return its time.
+
+    Unlike :func:`record` this leaves ``last_status_at`` to the caller.
+    """
+    ts = dt.datetime.now().replace(microsecond=0)
+    await session.execute(
+        insert(OrderEvent),
+        [
+            {"order_id": order_id, "kind": kind, "status": status, "actor": actor, "ts": ts}
+            for order_id in order_ids
+        ],
+    )
+    return ts
+
+
+def _status_entry(ev) -> Optional[str]:
+    ts = ev.ts.strftime(STATUS_TS_FORMAT)
+    if ev.kind == STATUS:
+        return f"{ev.status} @ {ts}"
+    if ev.kind == RETURN_ACCEPTED:
+        return f"return accepted {ev.actor} @ {ts}"
+    return None
+
+
+def render_status_log(legacy: Optional[str], events: Sequence) -> Optional[str]:
+    """Rebuild the ``" | Status @ ts"`` string clients parse."""
+    entries = [legacy.strip(" |")] if legacy and legacy.strip(" |") else []
+    entries += filter(None, (_status_entry(ev) for ev in events))
+    return " | ".join(entries) if entries else legacy
+
+
+def render_driver_notes(legacy: Optional[str], events: Sequence) -> Optional[str]:
+    """Rebuild the newline separated ``"ts - note"`` string."""
+    notes = "".join(
+        f"{ev.ts.strftime(NOTE_TS_FORMAT)} - {ev.text}\n"
+        for ev in events
+        if ev.kind == DRIVER_NOTE
+    )
+    if not notes:
+        return legacy
+    return (legacy or "") + notes
+
+
+async def load_log_events(
+    session: AsyncSession, order_ids: Iterable[int]
+) -> dict[int, list]:
+    """Return the log events of ``order_ids`` grouped by order, oldest first."""
+    ids = list(order_ids)
+    grouped: dict[int, list] = {}
+    if not ids:
+        return grouped
+    result = await session.execute(
+        select(
+            OrderEvent.order_id,
+            OrderEvent.kind,
+            OrderEvent.status,
+            OrderEvent.actor,
+            OrderEvent.ts,
+            OrderEvent.text,
+        )
+        .where(OrderEvent.order_id.in_(ids), OrderEvent.kind.in_(LOG_KINDS))
+        .order_by(OrderEvent.order_id, OrderEvent.ts, OrderEvent.id)
+    )
+    for row in result:
+        grouped.setdefault(row.order_id, []).append(row)
+    return grouped
+
+
+def serialize_event(ev: OrderEvent) -> dict:
+    return {
+        "id": ev.id,
+        "kind": ev.kind,
+        "status": ev.status,
+        "actor": ev.actor,
+        "ts": ev.ts.strftime(STATUS_TS_FORMAT),
+        "text": ev.text,
+    }
+
+
+async def timeline_page(
+    session: AsyncSession, order_id: int, limit: int, before: Optional[int] = None
+) -> dict:
+    """Return up to ``limit`` events older than event id ``before``.
+
+    Events come back oldest first so a chat view can prepend the page;
+    ``nextBefore`` is the cursor for the next older page, or ``None`` once
+    the start of the timeline is reached.
+    """
+    q = select(OrderEvent).where(OrderEvent.order_id == order_id)
+    if before is not None:
+        anchor = await session.get(OrderEvent, before)
+        if anchor is not None:
+            q = q.where(
+                or_(
+                    OrderEvent.ts < anchor.ts,
+                    and_(OrderEvent.ts == anchor.ts, OrderEvent.id < anchor.id),
+                )
+            )
+    result = await session.execute(
+        q.order_by(OrderEvent.ts.desc(), OrderEvent.id.desc()).limit(limit + 1)
+    )
+    rows = result.scalars().all()
+    more = len(rows) > limit
+    page = list(reversed(rows[:limit]))
+    return {
+        "events": [serialize_event(ev) for ev in page],
+        "nextBefore": page[0].id if more and page else None,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Legacy log migration
+# ---------------------------------------------------------------------------
+
+MIGRATION_BATCH = 500
+
+
+def _parse_legacy(order: Order) -> list[OrderEvent]:
+    events = []
+    for entry in (order.status_log or "").split("|"):
+        entry = entry.strip()
+        if not entry:
+            continue
+        label, _, ts_str = entry.rpartition("@")
+        if not label:
+            label, ts_str = entry, ""
+        try:
+            ts = dt.datetime.strptime(ts_str.strip(), STATUS_TS_FORMAT)
+        except ValueError:
+            ts = order.timestamp or dt.datetime.now()
+        label = label.strip()
+        if label.startswith("return accepted "):
+            events.append(
+                OrderEvent(
+                    order_id=order.id,
+                    kind=RETURN_ACCEPTED,
+                    actor=label[len("return accepted "):],
+                    ts=ts,
+                )
+            )
+        else:
+            events.append(OrderEvent(order_id=order.id, kind=STATUS, status=label, ts=ts))
+    for line in (order.driver_notes or "").splitlines():
+        if not line.strip():
+            continue
+        ts_str, sep, text = line.partition(" - ")
+        try:
+            ts = dt.datetime.strptime(ts_str.strip(), NOTE_TS_FORMAT) if sep else None
+        except ValueError:
+            ts = None
+        if ts is None:
+            ts, text = order.timestamp or dt.datetime.now(), line
+        events.append(
+            OrderEvent(order_id=order.id, kind=DRIVER_NOTE, actor=order.driver_id, text=text, ts=ts)
+        )
+    return events
+
+
+async def migrate_legacy_logs(session: AsyncSession) -> int:
+    """Move ``status_log`` / ``driver_notes`` strings into ``order_events``.
+
+    Orders are converted in batches and their legacy columns cleared, so the
+    job is a no-op once every row has been migrated.  Returns the number of
+    orders converted.
+    """
+    migrated = 0
+    while True:
+        result = await session.execute(
+            select(Order)
+            .where(or_(Order.status_log != None, Order.driver_notes != None))
+            .order_by(Order.id)
+            .limit(MIGRATION_BATCH)
+        )
+        orders = result.scalars().all()
+        if not orders:
+            return migrated
+        for order in orders:
+            session.add_all(_parse_legacy(order))
+            order.status_log = None
+            order.driver_notes = None
+        await session.commit()
+        migrated += len(orders)
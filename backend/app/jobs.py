@@ -0,0 +1,159 @@
+"""Background jobs that must run on one worker at a time.
+
+Every Gunicorn worker (and Cloud Run instance) runs the same periodic loops;
+each tick first claims the job's lease on its ``job_status`` row.  The winner
+renews the lease while the job runs, so a slow run is never started twice,
+and releases it when done.  The row also records the last run's outcome for
+``/admin/jobs``.
+"""
+
+import asyncio
+import datetime as dt
+import logging
+from typing import Awaitable, Callable, Optional
+
+from sqlalchemy import select, update, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import db as app_db
+from .models import JobStatus
+
+logger = logging.getLogger(__name__)
+
+JobFunc = Callable[[AsyncSession], Awaitable[Optional[int]]]
+
+
+async def _ensure_row(name: str) -> None:
+    async with app_db.AsyncSessionLocal() as session:
+        if await session.get(JobStatus, name):
+            return
+        session.add(JobStatus(name=name))
+        try:
+            await session.commit()
+        except IntegrityError:  # another worker created it first
+            await session.rollback()
+
+
+async def claim(name: str, lease_seconds: float) -> Optional[dt.datetime]:
+    """Take the single-runner lease for ``name`` if it is free.
+
+    The lease is a conditional UPDATE on the ``job_status`` row, so only one
+    worker (or instance) sharing the database wins each period.  Returns the
+    start time identifying this holder, or ``None`` if the lease is taken.
+    """
+    await _ensure_row(name)
+    now = dt.datetime.utcnow()
+    async with app_db.AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(JobStatus)
+            .where(
+                JobStatus.name == name,
+                or_(JobStatus.lease_until == None, JobStatus.lease_until <= now),
+            )
+            .values(
+                lease_until=now + dt.timedelta(seconds=lease_seconds),
+                last_started_at=now,
+            )
+        )
+        await session.commit()
+        return now if result.rowcount == 1 else None
+
+
+async def _set_lease(name: str, started: dt.datetime, until: dt.datetime) -> bool:
+    # Only the holder's run (same last_started_at) may move its lease
+    async with app_db.AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(JobStatus)
+            .where(JobStatus.name == name, JobStatus.last_started_at == started)
+            .values(lease_until=until)
+        )
+        await session.commit()
+        return result.rowcount == 1
+
+
+async def _heartbeat(name: str, started: dt.datetime, lease_seconds: float) -> None:
+    """Keep extending the lease while the job runs."""
+    while True:
+        await asyncio.sleep(lease_seconds / 3)
+        try:
+            until = dt.datetime.utcnow() + dt.timedelta(seconds=lease_seconds)
+            if not await _set_lease(name, started, until):
+                logger.warning("Job %s lost its lease", name)
+                return
+        except Exception:
+            logger.exception("Job %s lease renewal failed", name)
+
+
+async def _record(name: str, status: str, message: str = "", count: Optional[int] = None) -> None:
+    now = dt.datetime.utcnow()
+    values = {
+        "last_finished_at": now,
+        "last_status": status,
+        "last_message": message,
+        "last_count": count,
+    }
+    if status == "ok":
+        values["last_success_at"] = now
+    async with app_db.AsyncSessionLocal() as session:
+        await session.execute(update(JobStatus).where(JobStatus.name == name).values(**values))
+        await session.commit()
+
+
+async def run_job(name: str, func: JobFunc, interval: float) -> bool:
+    """Run ``func`` once if this worker wins the lease. Return ``True`` if it ran."""
+    # Slightly shorter than the interval so the holder can re-claim on its next tick
+    lease_seconds = interval * 0.9
+    started = await claim(name, lease_seconds)
+    if started is None:
+        return False
+    heartbeat = None
+    if lease_seconds > 0:
+        heartbeat = asyncio.create_task(_heartbeat(name, started, lease_seconds))
+    try:
+        async with app_db.AsyncSessionLocal() as session:
+            count = await func(session)
+    except Exception as e:
+        logger.exception("Job %s failed", name)
+        await _record(name, "error", str(e))
+    else:
+        await _record(name, "ok", count=count)
+    finally:
+        if heartbeat:
+            heartbeat.cancel()
+            await asyncio.gather(heartbeat, return_exceptions=True)
+        # Release: back to the original expiry, which still spaces runs one
+        # period apart, or free right away when the run outlasted it
+        await _set_lease(name, started, started + dt.timedelta(seconds=lease_seconds))
+    return True
+
+
+async def run_periodic(name: str, func: JobFunc, interval: float) -> None:
+    """Run ``func`` every ``interval`` seconds until cancelled."""
+    while True:
+        try:
+            await run_job(name, func, interval)
+        except Exception:
+            logger.exception("Job %s scheduling failed", name)
+        await asyncio.sleep(interval)
+
+
+async def job_statuses() -> list[dict]:
+    async with app_db.AsyncSessionLocal() as session:
+        result = await session.execute(select(JobStatus).order_by(JobStatus.name))
+
+        def fmt(ts):
+            return ts.strftime("%Y-%m-%d %H:%M:%S") if ts else ""
+
+        return [
+            {
+                "name": j.name,
+                "lastStartedAt": fmt(j.last_started_at),
+                "lastFinishedAt": fmt(j.last_finished_at),
+                "lastSuccessAt": fmt(j.last_success_at),
+                "status": j.last_status or "",
+                "message": j.last_message or "",
+                "count": j.last_count,
+            }
+            for j in result.scalars()
+        ]
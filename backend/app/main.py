@@ -19,13 +19,14 @@ import os
 import json
 import asyncio
 import logging
+import secrets
+import time
+from types import SimpleNamespace
 
 logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO"))
 logger = logging.getLogger(__name__)
 import datetime as dt
 from typing import List, Optional
-from datetime import timezone
-import httpx
 from fastapi import (
     FastAPI,
     HTTPException,
@@ -40,7 +41,15 @@ from cachetools import TTLCache
 from fastapi.responses import HTMLResponse, FileResponse, RedirectResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi import Request, Response
+from . import sheet_utils
 from .sheet_utils import load_sheet_orders, get_order_from_sheet
+from . import shopify
+from . import jobs
+from . import orderbook
+from . import events
+from . import stats
+from . import search
+from . import realtime
 
 try:
     import redis.asyncio as redis  # type: ignore
@@ -49,7 +58,7 @@ except Exception:  # pragma: no cover - redis optional
 
 from pydantic import BaseModel
 
-from sqlalchemy import select, or_, func
+from sqlalchemy import select, insert, update, or_, func, case
 from sqlalchemy.orm import selectinload
 from sqlalchemy.ext.asyncio import AsyncSession
 from .db import get_session, init_db
@@ -57,6 +66,7 @@ from .models import (
     Driver,
     Order,
     Payout,
+    PayoutItem,
     EmployeeLog,
     DeliveryNote,
     DeliveryNoteItem,
@@ -69,15 +79,16 @@ from .utils import (
     calculate_driver_fee,
     get_primary_display_tag,
     parse_timestamp,
-    serialize_order,
-    get_order_from_store,
-    order_exists,
     get_order_row,
     get_open_delivery_note,
     update_verification_from_order,
     add_to_payout,
     remove_from_payout,
-    sync_order_paid_status,
+    set_payout_orders,
+    migrate_payout_strings,
+    unsynced_paid_orders,
+    backfill_order_payout_ids,
+    load_note_summaries,
 )
 
 # ───────────────────────────────────────────────────────────────
@@ -89,12 +100,14 @@ SHOPIFY_STORES = [
         "name": "irrakids",
         "api_key": os.getenv("IRRAKIDS_API_KEY", ""),
         "password": os.getenv("IRRAKIDS_PASSWORD", ""),
+        "webhook_secret": os.getenv("IRRAKIDS_WEBHOOK_SECRET", ""),
         "domain": "nouralibas.myshopify.com",
     },
     {
         "name": "irranova",
         "api_key": os.getenv("IRRANOVA_API_KEY", ""),
         "password": os.getenv("IRRANOVA_PASSWORD", ""),
+        "webhook_secret": os.getenv("IRRANOVA_WEBHOOK_SECRET", ""),
         "domain": "fdd92b-2e.myshopify.com",
     },
 ]
@@ -114,18 +127,6 @@ DELIVERY_STATUSES = [
     "Returned",
     "Deleted",
 ]
-COMPLETED_STATUSES = [
-    "Livré",
-    "Paid",
-    "Deleted",
-]
-ARCHIVE_STATUSES = [
-    "Livré",
-    "Paid",
-    "Annulé",
-    "Refusé",
-    "Returned",
-]
 
 
 # ───────────────────────────────────────────────────────────────
@@ -211,9 +212,47 @@ class PayoutUpdate(BaseModel):
 app = FastAPI(title="Delivery FastAPI backend")
 
 
+# Long-running tasks started with the app and cancelled on shutdown
+background_tasks: set[asyncio.Task] = set()
+
+
 @app.on_event("startup")
 async def startup_event():
     await init_db()
+    await shopify.open_client()
+    background_tasks.add(asyncio.create_task(manager.backend.run()))
+    if os.getenv("SHEET_ID"):
+        background_tasks.add(asyncio.create_task(sheet_utils.run_snapshot_refresher()))
+    if os.getenv("VERIFICATION_SHEET_ID") or os.getenv("SHEET_ID"):
+        background_tasks.add(
+            asyncio.create_task(
+                jobs.run_periodic(
+                    "verification_sync", verification_sync_job, VERIFICATION_SYNC_INTERVAL
+                )
+            )
+        )
+    # Converts rows written before order_events and the follow-up columns
+    # existed; a cheap no-op once they are all migrated.
+    background_tasks.add(
+        asyncio.create_task(
+            jobs.run_periodic("order_backfill", order_backfill_job, 3600)
+        )
+    )
+    background_tasks.add(
+        asyncio.create_task(
+            jobs.run_periodic("paid_reconcile", paid_reconcile_job, PAID_RECONCILE_INTERVAL)
+        )
+    )
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+    await manager.shutdown()
+    await shopify.close_client()
 
 
 # ✅ Define the path correctly
@@ -252,40 +291,42 @@ if redis and REDIS_URL:
 else:  # pragma: no cover - used in local/dev
     redis_client = None
 
-orders_cache = TTLCache(maxsize=8, ttl=60)
+# One order book per driver backs all of the /orders views
+orderbook_cache = TTLCache(maxsize=32, ttl=60)
 payouts_cache = TTLCache(maxsize=8, ttl=60)
-archive_cache = TTLCache(maxsize=8, ttl=60)
-followups_cache = TTLCache(maxsize=8, ttl=60)
-all_orders_cache = TTLCache(maxsize=8, ttl=60)
 
 
-async def cache_get(namespace: str, key: str):
+async def cache_get(namespace: str, key: str, version: str):
+    """Return the cached value if it was stored under data ``version``.
+
+    Entries carry the version read before their data was loaded, so a list
+    loaded just before a write is never served under the write's new ETag.
+    """
     if redis_client:
         val = await redis_client.hget(namespace, key)
-        return json.loads(val) if val else None
-    cache = {
-        "orders": orders_cache,
-        "payouts": payouts_cache,
-        "archive": archive_cache,
-        "followups": followups_cache,
-        "orders_all": all_orders_cache,
-    }[namespace]
-    return cache.get(key)
-
-
-async def cache_set(namespace: str, key: str, value, ttl: int = 60):
+        entry = json.loads(val) if val else None
+    else:
+        cache = {
+            "orderbook": orderbook_cache,
+            "payouts": payouts_cache,
+        }[namespace]
+        entry = cache.get(key)
+    if entry is None or entry.get("version") != version:
+        return None
+    return entry["value"]
+
+
+async def cache_set(namespace: str, key: str, value, version: str, ttl: int = 60):
+    entry = {"version": version, "value": value}
     if redis_client:
-        await redis_client.hset(namespace, key, json.dumps(value))
+        await redis_client.hset(namespace, key, json.dumps(entry))
         await redis_client.expire(namespace, ttl)
     else:
         cache = {
-            "orders": orders_cache,
+            "orderbook": orderbook_cache,
             "payouts": payouts_cache,
-            "archive": archive_cache,
-            "followups": followups_cache,
-            "orders_all": all_orders_cache,
         }[namespace]
-        cache[key] = value
+        cache[key] = entry
 
 
 async def cache_delete(namespace: str, key: str):
@@ -293,103 +334,285 @@ async def cache_delete(namespace: str, key: str):
         await redis_client.hdel(namespace, key)
     else:
         cache = {
-            "orders": orders_cache,
+            "orderbook": orderbook_cache,
             "payouts": payouts_cache,
-            "archive": archive_cache,
-            "followups": followups_cache,
-            "orders_all": all_orders_cache,
         }[namespace]
         cache.pop(key, None)
 
 
-class ConnectionManager:
-    """WebSocket connection manager for push notifications."""
+# Per-driver data version behind the list ETags.  With Redis it is shared by
+# every worker; the in-process fallback expires like the caches above so a
+# worker that missed another worker's write stops answering 304 within a TTL.
+data_versions = TTLCache(maxsize=256, ttl=60)
 
-    def __init__(self) -> None:
-        self.active: list[WebSocket] = []
 
-    async def connect(self, ws: WebSocket) -> None:
-        await ws.accept()
-        self.active.append(ws)
+async def data_version(driver: str) -> str:
+    if redis_client:
+        val = await redis_client.hget("dataversion", driver)
+        if val:
+            return val
+        await redis_client.hsetnx("dataversion", driver, secrets.token_hex(8))
+        return await redis_client.hget("dataversion", driver)
+    if driver not in data_versions:
+        data_versions[driver] = secrets.token_hex(8)
+    return data_versions[driver]
+
+
+async def invalidate_driver(driver: str) -> None:
+    """Drop the driver's cached lists and give its data a new version."""
+    await cache_delete("orderbook", driver)
+    await cache_delete("payouts", driver)
+    token = secrets.token_hex(8)
+    if redis_client:
+        await redis_client.hset("dataversion", driver, token)
+    else:
+        data_versions[driver] = token
 
-    def disconnect(self, ws: WebSocket) -> None:
-        if ws in self.active:
-            self.active.remove(ws)
 
-    async def broadcast(self, data: dict) -> None:
-        for ws in list(self.active):
-            try:
-                await ws.send_json(data)
-            except Exception:
-                self.disconnect(ws)
+async def driver_etag(driver: str, view: str, per_minute: bool = False) -> str:
+    """Strong ETag for one of the driver's list views.
+
+    Views whose content depends on the clock (urgency, overdue follow-ups)
+    pass ``per_minute`` so their tag also rolls over every minute.
+    """
+    tag = f"{view}-{await data_version(driver)}"
+    if per_minute:
+        tag += f"-{int(time.time() // 60)}"
+    return f'"{tag}"'
+
+
+def check_etag(request: Request, response: Response, etag: str) -> Optional[Response]:
+    """Return a 304 response if the client already holds ``etag``.
+
+    Otherwise the tag is set on ``response`` for the full body.
+    """
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if_none_match = request.headers.get("if-none-match", "")
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    if etag in tags or "*" in tags:
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return None
+
+
+manager = realtime.ConnectionManager()
+if redis_client:
+    # reach sockets held by the other workers and instances too
+    manager.backend = realtime.RedisBroadcast(redis_client, manager.deliver)
+
 
+# Upper bound on names per IN (...) clause; keeps well under asyncpg's bind
+# parameter limit.  SQLite before 3.32 allows only 999 parameters.
+IN_BATCH_SIZE = 10_000
+SQLITE_IN_BATCH_SIZE = 900
 
-manager = ConnectionManager()
 
+def _date_range(start: str, end: str) -> list[str]:
+    """Return every ``YYYY-MM-DD`` day between ``start`` and ``end`` inclusive."""
+    s = dt.datetime.strptime(start, "%Y-%m-%d").date()
+    e = dt.datetime.strptime(end, "%Y-%m-%d").date()
+    if e < s:
+        s, e = e, s
+    return [(s + dt.timedelta(days=i)).strftime("%Y-%m-%d") for i in range((e - s).days + 1)]
 
-async def sync_verification_orders(date_str: str, session: AsyncSession) -> None:
-    """Import new orders from the Google Sheet for the given date."""
+
+async def sync_verification_orders(date_str: str, session: AsyncSession) -> int:
+    """Import new orders from the Google Sheet for the given date.
+
+    Returns the number of verification rows created.
+    """
+    counts = await sync_verification_range(date_str, date_str, session)
+    return counts[date_str]
+
+
+async def sync_verification_range(
+    start: str, end: str, session: AsyncSession, undated_day: Optional[str] = None
+) -> dict[str, int]:
+    """Import new orders from the Google Sheet for every day in a range.
+
+    The sheet is downloaded and parsed once, its rows are partitioned by
+    ``order_date`` and all days are imported in one transaction. Rows with
+    no date belong to ``undated_day`` (the first day by default), and an
+    order listed on several days is imported on the earliest one, as a
+    day-by-day import would do.
+
+    The import is set-based: one query loads the verification rows that
+    already exist for the sheet's order names, one query finds the latest
+    scan of each name, then new rows are inserted in one multi-row INSERT
+    and missing drivers/scan times are filled with one bulk UPDATE.
+
+    Returns the number of verification rows created per day.
+    """
+    days = _date_range(start, end)
+    counts = {d: 0 for d in days}
     rows = await asyncio.to_thread(load_sheet_orders)
     logger.info("Loaded %d rows from sheet", len(rows))
     if not rows:
-        return
-    created = 0
-    seen: set[str] = set()
+        return counts
+
+    by_day: dict[str, dict[str, dict]] = {d: {} for d in days}
     for row in rows:
-        row_date = row.get("order_date") or date_str
-        if row_date != date_str:
-            continue
-        order_num = row["order_name"]
-        if order_num in seen:
-            continue
-        seen.add(order_num)
-        existing = await session.scalar(
-            select(VerificationOrder).where(
-                VerificationOrder.order_name == order_num
-            )
+        row_date = row.get("order_date") or undated_day or days[0]
+        if row_date in by_day:
+            by_day[row_date].setdefault(row["order_name"], row)
+    day_rows: dict[str, tuple[str, dict]] = {}
+    for d in days:
+        for name, row in by_day[d].items():
+            day_rows.setdefault(name, (d, row))
+    if not day_rows:
+        return counts
+    names = list(day_rows)
+
+    existing: dict[str, list[tuple[int, Optional[str]]]] = {}
+    latest_scan: dict[str, tuple[str, dt.datetime]] = {}
+    batch = IN_BATCH_SIZE
+    if session.get_bind().dialect.name == "sqlite":
+        batch = SQLITE_IN_BATCH_SIZE
+    for i in range(0, len(names), batch):
+        chunk = names[i : i + batch]
+        result = await session.execute(
+            select(
+                VerificationOrder.id,
+                VerificationOrder.order_name,
+                VerificationOrder.driver_id,
+            ).where(VerificationOrder.order_name.in_(chunk))
         )
-        if existing:
-            # If driver not yet set, try to fetch from scans
-            if not existing.driver_id:
-                scanned = await session.scalar(
-                    select(Order)
-                    .where(Order.order_name == order_num)
-                    .order_by(Order.timestamp.desc())
+        for vid, name, driver_id in result.all():
+            existing.setdefault(name, []).append((vid, driver_id))
+        # Ascending by timestamp so the newest scan of each name wins
+        result = await session.execute(
+            select(Order.order_name, Order.driver_id, Order.timestamp)
+            .where(Order.order_name.in_(chunk))
+            .order_by(Order.timestamp)
+        )
+        for name, driver_id, ts in result.all():
+            latest_scan[name] = (driver_id, ts)
+
+    inserts: list[dict] = []
+    updates: list[dict] = []
+    for name, (row_date, row) in day_rows.items():
+        scanned = latest_scan.get(name)
+        if name in existing:
+            # If driver not yet set, fill it from the latest scan
+            if scanned:
+                updates.extend(
+                    {"id": vid, "driver_id": scanned[0], "scan_time": scanned[1]}
+                    for vid, driver_id in existing[name]
+                    if not driver_id
                 )
-                if scanned:
-                    existing.driver_id = scanned.driver_id
-                    existing.scan_time = scanned.timestamp
-                    logger.info(
-                        "Matched %s to driver %s", row["order_name"], scanned.driver_id
-                    )
             continue
+        inserts.append(
+            {
+                "order_date": row_date,
+                "order_name": name,
+                "customer_name": row.get("customer_name", ""),
+                "customer_phone": row.get("customer_phone", ""),
+                "address": row.get("address", ""),
+                "cod_total": row.get("cod_total", ""),
+                "city": row.get("city", ""),
+                "driver_id": scanned[0] if scanned else None,
+                "scan_time": scanned[1] if scanned else None,
+            }
+        )
+        counts[row_date] += 1
 
-        scanned = await session.scalar(
-            select(Order)
-            .where(Order.order_name == order_num)
-            .order_by(Order.timestamp.desc())
+    if inserts:
+        await session.execute(insert(VerificationOrder), inserts)
+    if updates:
+        await session.execute(update(VerificationOrder), updates)
+    await session.commit()
+    if inserts or updates:
+        logger.info(
+            "Imported %d verification rows, matched %d to drivers",
+            len(inserts),
+            len(updates),
         )
-        vo = VerificationOrder(
-            order_date=date_str,
-            order_name=order_num,
-            customer_name=row.get("customer_name", ""),
-            customer_phone=row.get("customer_phone", ""),
-            address=row.get("address", ""),
-            cod_total=row.get("cod_total", ""),
-            city=row.get("city", ""),
-            driver_id=scanned.driver_id if scanned else None,
-            scan_time=scanned.timestamp if scanned else None,
+    return counts
+
+
+# Seconds between background imports of the verification sheet
+VERIFICATION_SYNC_INTERVAL = float(os.getenv("VERIFICATION_SYNC_INTERVAL", "300"))
+# Days (today included) each import covers, so rows added late for earlier
+# days are still picked up
+VERIFICATION_SYNC_DAYS = max(1, int(os.getenv("VERIFICATION_SYNC_DAYS", "7")))
+
+
+async def order_backfill_job(session: AsyncSession) -> int:
+    """Move legacy log and payout strings into their tables, then fill the
+    follow-up columns."""
+    # init_db builds the rollup; this only retries when that failed
+    migrated = await stats.backfill(session)
+    migrated += await events.migrate_legacy_logs(session)
+    migrated += await migrate_payout_strings(session)
+    migrated += await backfill_order_payout_ids(session)
+    migrated += await search.backfill(session)
+    return migrated + await orderbook.backfill_followup_columns(session)
+
+
+# Seconds between paid-status reconciliation runs
+PAID_RECONCILE_INTERVAL = float(os.getenv("PAID_RECONCILE_INTERVAL", "300"))
+PAID_RECONCILE_BATCH = 500
+
+
+async def paid_reconcile_job(session: AsyncSession) -> int:
+    """Mark orders Paid whose payout has been paid.
+
+    Each batch is fixed with one UPDATE, plus one INSERT for the status
+    events and one rollup upsert.  Returns the number of orders fixed.
+    """
+    fixed = 0
+    while True:
+        rows = (await session.execute(unsynced_paid_orders(PAID_RECONCILE_BATCH))).all()
+        if not rows:
+            return fixed
+        # one row per order, so no order is counted or logged twice
+        rows = list({r.id: r for r in rows}.values())
+        versions = {}
+        for driver_id in sorted({r.driver_id for r in rows if r.driver_id}):
+            versions[driver_id] = await orderbook.bump_version(session, driver_id)
+        ids = [r.id for r in rows]
+        ts = await events.record_bulk(
+            session, ids, events.STATUS, status="Paid", actor="system"
         )
-        session.add(vo)
-        created += 1
-        if scanned:
-            logger.info(
-                "Matched %s to driver %s", row["order_name"], scanned.driver_id
+        await session.execute(
+            update(Order)
+            .where(Order.id.in_(ids))
+            .values(
+                delivery_status="Paid",
+                payout_id=func.coalesce(
+                    Order.payout_id,
+                    case({r.id: r.paid_payout_id for r in rows}, value=Order.id),
+                ),
+                change_version=(
+                    case(versions, value=Order.driver_id, else_=Order.change_version)
+                    if versions
+                    else Order.change_version
+                ),
+                last_status_at=ts,
             )
-        logger.info("Created verification order for %s", row["order_name"])
-    await session.commit()
-    if created:
-        logger.info("Imported %d verification rows", created)
+            .execution_options(synchronize_session=False)
+        )
+        await stats.track(
+            session,
+            [stats.contribution(r) for r in rows],
+            [SimpleNamespace(**{**r._asdict(), "delivery_status": "Paid"}) for r in rows],
+        )
+        await session.commit()
+        fixed += len(rows)
+        for driver_id in versions:
+            await invalidate_driver(driver_id)
+        logger.info("Marked %d orders Paid for %d drivers", len(rows), len(versions))
+
+
+async def verification_sync_job(session: AsyncSession) -> int:
+    """Background job: import the verification sheet rows of the last
+    ``VERIFICATION_SYNC_DAYS`` days; undated rows count as today's."""
+    today = dt.datetime.now().date()
+    start = today - dt.timedelta(days=VERIFICATION_SYNC_DAYS - 1)
+    counts = await sync_verification_range(
+        start.isoformat(), today.isoformat(), session, undated_day=today.isoformat()
+    )
+    return sum(counts.values())
 
 
 @app.get("/", response_class=HTMLResponse)
@@ -473,13 +696,58 @@ async def list_drivers(request: Request, agent: str | None = None, all: bool = F
         return list(drivers.keys())
 
 
+async def ws_topics(
+    driver: str | None = None, agent: str | None = None, admin: bool = False
+) -> list[str]:
+    """Topics for a socket watching ``driver``, an agent's drivers, or all."""
+    if admin:
+        return [realtime.ADMIN_TOPIC]
+    topics = [realtime.driver_topic(driver)] if driver else []
+    if agent:
+        async for session in get_session():
+            ag = await load_agent(session, agent)
+            if ag:
+                topics += [realtime.driver_topic(d.id) for d in ag.drivers]
+    return topics
+
+
 @app.websocket("/ws")
-async def websocket_endpoint(ws: WebSocket):
-    await manager.connect(ws)
+async def websocket_endpoint(
+    ws: WebSocket,
+    driver: str | None = None,
+    agent: str | None = None,
+    admin: bool = False,
+):
+    """Push events for ``?driver=``, ``?agent=`` (or the agent cookie) or
+    ``?admin=1``.  Sockets can add topics later by sending
+    ``{"type": "subscribe", "driver": ...}`` with the same keys; the reply
+    lists the socket's topics.
+
+    Sockets that ask for nothing receive every event, as before topics.
+    """
+    agent = agent or ws.cookies.get("agent")
+    topics = await ws_topics(driver, agent, admin)
+    if not (driver or agent or admin):
+        topics = [realtime.ADMIN_TOPIC]
+    await manager.connect(ws, topics)
     try:
         while True:
-            await ws.receive_text()
+            text_data = await ws.receive_text()
+            try:
+                msg = json.loads(text_data)
+            except ValueError:
+                continue
+            if isinstance(msg, dict) and msg.get("type") == "subscribe":
+                manager.subscribe(
+                    ws,
+                    await ws_topics(msg.get("driver"), msg.get("agent"), bool(msg.get("admin"))),
+                )
+                manager.send(
+                    ws, {"type": "subscribed", "topics": sorted(manager.subscriptions.get(ws, ()))}
+                )
     except WebSocketDisconnect:
+        pass
+    finally:
         manager.disconnect(ws)
 
 
@@ -517,19 +785,15 @@ async def scan(
 ):
     async for session in get_session():
         await get_driver(session, driver)
-        scan_day = dt.datetime.now().strftime("%Y-%m-%d")
-        try:
-            await sync_verification_orders(scan_day, session)
-        except Exception:
-            logger.exception("sync_verification_orders failed")
+        scan_day = dt.datetime.now().date()
         barcode = payload.barcode.strip()
         order_number = "#" + "".join(filter(str.isdigit, barcode))
 
         if len(order_number) <= 1:
             raise HTTPException(status_code=400, detail="Invalid barcode")
 
-        if await order_exists(session, driver, order_number):
-            existing = await get_order_row(session, driver, order_number)
+        existing = await get_order_row(session, driver, order_number)
+        if existing:
             if existing.return_pending and existing.delivery_status in ("Returned", "Annulé", "Refusé"):
                 return ScanResult(
                     result="⚠️ Awaiting agent confirmation",
@@ -544,63 +808,35 @@ async def scan(
                 deliveryStatus=existing.delivery_status,
             )
 
-        # --- Shopify look-up (unchanged) ----------------------------------
-        window_start = dt.datetime.now(timezone.utc) - dt.timedelta(days=50)
-        chosen_order, chosen_store_name = None, ""
-        for store in SHOPIFY_STORES:
-            order = await get_order_from_store(order_number, store)
-            if order:
-                created_at = dt.datetime.fromisoformat(
-                    order["created_at"].replace("Z", "+00:00")
-                )
-                if created_at >= window_start and (
-                    not chosen_order
-                    or created_at
-                    > dt.datetime.fromisoformat(
-                        chosen_order["created_at"].replace("Z", "+00:00")
-                    )
-                ):
-                    chosen_order, chosen_store_name = order, store["name"]
-
-        tags = chosen_order.get("tags", "") if chosen_order else ""
-        fulfillment = (
-            chosen_order.get("fulfillment_status", "unfulfilled")
-            if chosen_order
-            else ""
-        )
-        order_status = (
-            "closed" if (chosen_order and chosen_order.get("cancelled_at")) else "open"
-        )
+        # --- Shopify look-up: local webhook mirror first, live API on a miss
+        info, chosen_store_name = None, ""
+        mirrored = await shopify.find_mirrored_order(session, order_number)
+        if mirrored:
+            info, chosen_store_name = shopify.mirror_fields(mirrored), mirrored.store
+        else:
+            chosen_order, chosen_store_name = await shopify.find_order(
+                order_number, SHOPIFY_STORES
+            )
+            if chosen_order:
+                info = shopify.order_fields(chosen_order)
+
+        tags = info["tags"] if info else ""
+        fulfillment = info["fulfillment_status"] if info else ""
+        order_status = "closed" if (info and info["cancelled"]) else "open"
         customer_name = phone = address = ""
         cash_amount = 0.0
         result_msg = "❌ Not found"
 
-        if chosen_order:
+        if info:
             result_msg = (
                 "⚠️ Cancelled"
-                if chosen_order.get("cancelled_at")
+                if info["cancelled"]
                 else "❌ Unfulfilled" if fulfillment != "fulfilled" else "✅ OK"
             )
-            cash_amount = float(
-                chosen_order.get("total_outstanding")
-                or chosen_order.get("total_price")
-                or 0
-            )
-            if chosen_order.get("shipping_address"):
-                sa = chosen_order["shipping_address"]
-                customer_name = sa.get("name", "")
-                phone = sa.get("phone", "") or chosen_order.get("phone", "")
-                address = ", ".join(
-                    filter(
-                        None,
-                        [
-                            sa.get("address1"),
-                            sa.get("address2"),
-                            sa.get("city"),
-                            sa.get("province"),
-                        ],
-                    )
-                )
+            cash_amount = info["cod_total"]
+            customer_name = info["customer_name"]
+            phone = info["customer_phone"]
+            address = info["address"]
 
         # Try to supplement missing details from the Google Sheet when
         # Shopify didn't return them
@@ -651,8 +887,12 @@ async def scan(
             driver_fee=driver_fee,
             follow_log="",
         )
+        search.index_order(order)
         session.add(order)
+        await orderbook.mark_changed(session, driver, order)
         await session.flush()
+        events.record(session, order, events.SCAN, status="Dispatched", actor=driver)
+        await stats.track(session, [], [order])
 
         note = await get_open_delivery_note(session, driver)
         session.add(
@@ -668,7 +908,7 @@ async def scan(
             session, order_number, driver, order.timestamp
         )
 
-        await cache_delete("orders", driver)
+        await invalidate_driver(driver)
         await manager.broadcast(
             {
                 "type": "new_order",
@@ -686,43 +926,79 @@ async def scan(
         )
 
 
+# ---------------------------  WEBHOOKS  ---------------------------
+@app.post("/webhooks/shopify", tags=["webhooks"])
+async def shopify_webhook(request: Request):
+    """Keep the local ``shopify_orders`` mirror in sync with the stores."""
+    body = await request.body()
+    domain = request.headers.get("X-Shopify-Shop-Domain", "")
+    topic = request.headers.get("X-Shopify-Topic", "")
+    store = next((s for s in SHOPIFY_STORES if s["domain"] == domain), None)
+    secret = (store or {}).get("webhook_secret") or os.getenv("SHOPIFY_WEBHOOK_SECRET", "")
+    if not store or not shopify.verify_webhook(
+        body, request.headers.get("X-Shopify-Hmac-Sha256"), secret
+    ):
+        raise HTTPException(status_code=401, detail="Invalid webhook signature")
+
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+
+    async for session in get_session():
+        if topic in shopify.ORDER_TOPICS:
+            await shopify.upsert_order(session, store["name"], payload)
+        elif topic in shopify.FULFILLMENT_TOPICS:
+            await shopify.apply_fulfillment(session, store["name"], payload)
+        else:
+            logger.info("Ignoring Shopify webhook topic %s", topic)
+            return {"success": True}
+        await session.commit()
+        return {"success": True}
+
+
 # -----------------------  DELIVERY NOTES  ------------------------
 
 
 @app.get("/notes", tags=["notes"])
-async def list_notes(driver: str = Query(...), history: bool = Query(False)):
+async def list_notes(
+    request: Request,
+    response: Response,
+    driver: str = Query(...),
+    history: bool = Query(False),
+    limit: int | None = Query(None, ge=1, le=200),
+    before: int | None = Query(None, description="id of the last note already shown"),
+):
+    etag = await driver_etag(driver, "notes-history" if history else "notes")
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
     async for session in get_session():
         await get_driver(session, driver)
-        q = select(DeliveryNote).where(DeliveryNote.driver_id == driver)
-        q = (
-            q.where(DeliveryNote.status == "approved")
-            if history
-            else q.where(DeliveryNote.status == "draft")
+        summaries = await load_note_summaries(
+            session, driver, "approved" if history else "draft", limit, before
         )
-        q = q.order_by(DeliveryNote.created_at.desc())
-        result = await session.execute(q)
-        notes: list[dict] = []
-        for n in result.scalars():
-            row = await session.execute(
-                select(func.count(Order.id), func.sum(Order.cash_amount))
-                .join(DeliveryNoteItem, DeliveryNoteItem.order_id == Order.id)
-                .where(DeliveryNoteItem.note_id == n.id)
-            )
-            parcels, total_cash = row.first()
-            notes.append(
-                {
-                    "id": n.id,
-                    "createdAt": n.created_at.strftime("%Y-%m-%d %H:%M:%S"),
-                    "parcels": parcels or 0,
-                    "totalCod": total_cash or 0,
-                    "status": n.status,
-                }
-            )
-        return notes
+        return [
+            {
+                "id": row["note"].id,
+                "createdAt": row["note"].created_at.strftime("%Y-%m-%d %H:%M:%S"),
+                "parcels": row["parcels"],
+                "totalCod": row["totalCod"],
+                "status": row["note"].status,
+                "summary": row["summary"],
+            }
+            for row in summaries
+        ]
 
 
 @app.get("/notes/{note_id}", tags=["notes"])
-async def get_note(note_id: int, driver: str = Query(...)):
+async def get_note(
+    note_id: int, request: Request, response: Response, driver: str = Query(...)
+):
+    etag = await driver_etag(driver, f"note{note_id}")
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
     async for session in get_session():
         note = await session.get(DeliveryNote, note_id)
         if not note or note.driver_id != driver:
@@ -782,9 +1058,10 @@ async def remove_note_item(note_id: int, order_name: str, driver: str = Query(..
             raise HTTPException(status_code=404, detail="Item not in note")
 
         await session.delete(item)
+        await orderbook.mark_changed(session, driver, order)
         await session.commit()
 
-        await cache_delete("orders", driver)
+        await invalidate_driver(driver)
         await manager.broadcast(
             {"type": "note_update", "driver": driver, "noteId": note_id}
         )
@@ -808,8 +1085,9 @@ async def approve_note(note_id: int, driver: str = Query(...)):
             raise HTTPException(status_code=400, detail="Cannot approve empty note")
         note.status = "approved"
         note.approved_at = dt.datetime.utcnow()
+        await orderbook.mark_note_changed(session, driver, note_id)
         await session.commit()
-        await cache_delete("orders", driver)
+        await invalidate_driver(driver)
         await manager.broadcast(
             {"type": "note_approved", "driver": driver, "noteId": note_id}
         )
@@ -817,175 +1095,101 @@ async def approve_note(note_id: int, driver: str = Query(...)):
 
 
 # -----------------------------  ORDERS  -------------------------------
-@app.get("/orders", tags=["orders"])
-async def list_active_orders(driver: str = Query(...)):
-    cached = await cache_get("orders", driver)
+async def get_order_book(driver: str) -> list[dict]:
+    """Return the driver's cached order book, loading it on a miss."""
+    # Read the version before the orders so a concurrent write leaves the
+    # entry under the old version rather than passing it off as current
+    version = await data_version(driver)
+    cached = await cache_get("orderbook", driver, version)
     if cached is not None:
         return cached
 
     async for session in get_session():
         await get_driver(session, driver)
-        result = await session.execute(
-            select(Order)
-            .outerjoin(DeliveryNoteItem, DeliveryNoteItem.order_id == Order.id)
-            .outerjoin(DeliveryNote, DeliveryNote.id == DeliveryNoteItem.note_id)
-            .where(
-                Order.driver_id == driver,
-                Order.delivery_status.notin_(COMPLETED_STATUSES),
-                or_(
-                    DeliveryNote.status == "approved",
-                    DeliveryNote.id == None,
-                ),
-            )
-        )
-        rows = result.scalars().all()
+        book = await orderbook.load_order_book(session, driver)
 
-        active = [serialize_order(o) for o in rows]
+    await cache_set("orderbook", driver, book, version)
+    return book
 
-    def sort_key(o):
-        if o["scheduledTime"]:
-            try:
-                return parse_timestamp(o["scheduledTime"])
-            except Exception:
-                pass
-        return parse_timestamp(o["timestamp"])
 
-    active.sort(key=sort_key)
+@app.get("/orders", tags=["orders"])
+async def list_active_orders(request: Request, response: Response, driver: str = Query(...)):
+    etag = await driver_etag(driver, "orders", per_minute=True)
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
+    return orderbook.active_orders(await get_order_book(driver))
 
-    now = dt.datetime.now()
-    for o in active:
-        if o["scheduledTime"]:
-            try:
-                st = parse_timestamp(o["scheduledTime"])
-                o["urgent"] = (st - now).total_seconds() <= 3600
-            except Exception:
-                o["urgent"] = False
-        else:
-            o["urgent"] = False
 
-    await cache_set("orders", driver, active)
-    return active
+@app.get("/orders/archive", tags=["orders"])
+async def list_archived_orders(request: Request, response: Response, driver: str = Query(...)):
+    etag = await driver_etag(driver, "archive")
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
+    return orderbook.archived_orders(await get_order_book(driver))
 
 
-@app.get("/orders/archive", tags=["orders"])
-async def list_archived_orders(driver: str = Query(...)):
-    cached = await cache_get("archive", driver)
-    if cached is not None:
-        return cached
+@app.get("/orders/all", tags=["orders"])
+async def list_all_orders(request: Request, response: Response, driver: str = Query(...)):
+    etag = await driver_etag(driver, "all")
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
+    return orderbook.all_orders(await get_order_book(driver))
+
 
+@app.get("/orders/followups", tags=["orders"])
+async def list_followup_orders(request: Request, response: Response, driver: str = Query(...)):
+    etag = await driver_etag(driver, "followups", per_minute=True)
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
     async for session in get_session():
         await get_driver(session, driver)
-        result = await session.execute(
-            select(Order)
-            .outerjoin(DeliveryNoteItem, DeliveryNoteItem.order_id == Order.id)
-            .outerjoin(DeliveryNote, DeliveryNote.id == DeliveryNoteItem.note_id)
-            .where(
-                Order.driver_id == driver,
-                Order.delivery_status.in_(ARCHIVE_STATUSES),
-                or_(Order.return_pending == None, Order.return_pending == 0),
-                or_(
-                    DeliveryNote.status == "approved",
-                    DeliveryNote.id == None,
-                ),
-            )
-            .order_by(Order.timestamp.desc())
-        )
-        rows = result.scalars().all()
-
-        archived = [serialize_order(o) for o in rows]
-
-    await cache_set("archive", driver, archived)
-    return archived
+        return await orderbook.load_followups(session, driver)
 
 
-@app.get("/orders/all", tags=["orders"])
-async def list_all_orders(driver: str = Query(...)):
-    cached = await cache_get("orders_all", driver)
-    if cached is not None:
-        return cached
+@app.get("/orders/changes", tags=["orders"])
+async def list_order_changes(
+    driver: str = Query(...),
+    since: int = Query(0, ge=0),
+    scope: str = Query("all", pattern="^(all|active)$"),
+):
+    """Orders written after change version ``since`` plus the new version.
 
+    Pass the returned ``version`` back as ``since`` on the next call.  When
+    ``full`` is true the client should replace its copy with ``orders``;
+    otherwise it upserts ``orders`` and drops the names in ``removed``.
+    """
     async for session in get_session():
         await get_driver(session, driver)
-        result = await session.execute(
-            select(Order)
-            .outerjoin(DeliveryNoteItem, DeliveryNoteItem.order_id == Order.id)
-            .outerjoin(DeliveryNote, DeliveryNote.id == DeliveryNoteItem.note_id)
-            .where(
-                Order.driver_id == driver,
-                Order.delivery_status != "Deleted",
-                or_(
-                    DeliveryNote.status == "approved",
-                    DeliveryNote.id == None,
-                ),
-            )
+        return await orderbook.load_changes(
+            session, driver, since, active_only=scope == "active"
         )
-        rows = result.scalars().all()
-
-        all_orders = [serialize_order(o) for o in rows]
-
-    await cache_set("orders_all", driver, all_orders)
-    return all_orders
 
 
-@app.get("/orders/followups", tags=["orders"])
-async def list_followup_orders(driver: str = Query(...)):
-    cached = await cache_get("followups", driver)
-    if cached is not None:
-        return cached
-
+@app.get("/orders/{order_name}/timeline", tags=["orders"])
+async def order_timeline(
+    order_name: str,
+    driver: str = Query(...),
+    limit: int = Query(50, ge=1, le=200),
+    before: int | None = Query(None, description="event id from nextBefore"),
+):
+    """Page backwards through an order's events, newest page first."""
     async for session in get_session():
-        await get_driver(session, driver)
-        result = await session.execute(
-            select(Order)
-            .outerjoin(DeliveryNoteItem, DeliveryNoteItem.order_id == Order.id)
-            .outerjoin(DeliveryNote, DeliveryNote.id == DeliveryNoteItem.note_id)
-            .where(
-                Order.driver_id == driver,
-                Order.delivery_status.notin_(COMPLETED_STATUSES),
-                or_(
-                    DeliveryNote.status == "approved",
-                    DeliveryNote.id == None,
-                ),
-            )
-        )
-        rows = result.scalars().all()
-
-        followups = []
-        # Use a naive timestamp to match values loaded from SQLite/PG
-        now = dt.datetime.utcnow()
-        for o in rows:
-            last_update = o.timestamp
-            if o.status_log:
-                try:
-                    ts_str = o.status_log.strip().split("|")[-1].split("@")[-1].strip()
-                    last_update = parse_timestamp(ts_str)
-                except Exception:
-                    pass
-
-            overdue = False
-            if o.scheduled_time:
-                try:
-                    st = parse_timestamp(o.scheduled_time)
-                    overdue = st <= now
-                except Exception:
-                    overdue = False
-
-            if (
-                overdue
-                or (now - last_update).total_seconds() > 8 * 3600
-                or o.delivery_status in ["Pas de réponse 3", "Rescheduled"]
-            ):
-                item = serialize_order(o)
-                item["urgent"] = overdue
-                followups.append(item)
-
-    await cache_set("followups", driver, followups)
-    return followups
+        order = await get_order_row(session, driver, order_name)
+        if not order:
+            raise HTTPException(status_code=404, detail="Order not found")
+        return await events.timeline_page(session, order.id, limit, before)
 
 
 @app.put("/order/status", tags=["orders"])
 async def update_order_status(
-    payload: StatusUpdate, bg: BackgroundTasks, driver: str = Query(...)
+    payload: StatusUpdate,
+    bg: BackgroundTasks,
+    request: Request,
+    driver: str = Query(...),
 ):
     if payload.new_status and payload.new_status not in DELIVERY_STATUSES:
         raise HTTPException(status_code=400, detail="Invalid status")
@@ -997,24 +1201,25 @@ async def update_order_status(
             raise HTTPException(status_code=404, detail="Order not found")
 
         prev_status = order.delivery_status
+        before = stats.contribution(order)
 
+        actor = request.cookies.get("agent") or driver
         if payload.new_status:
             order.delivery_status = payload.new_status
-            ts = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            order.status_log = (
-                (order.status_log or "") + f" | {payload.new_status} @ {ts}"
-            ).strip(" |")
+            events.record(
+                session, order, events.STATUS, status=payload.new_status, actor=actor
+            )
             if payload.new_status in ("Returned", "Annulé", "Refusé"):
                 order.return_pending = 1
         if payload.note is not None:
             order.notes = payload.note
         if payload.driver_note is not None:
-            ts = dt.datetime.now().strftime("%Y-%m-%d %H:%M")
-            order.driver_notes = (
-                (order.driver_notes or "") + f"{ts} - {payload.driver_note}\n"
-            ).lstrip()
+            events.record(
+                session, order, events.DRIVER_NOTE, actor=actor, text=payload.driver_note
+            )
         if payload.scheduled_time is not None:
             order.scheduled_time = payload.scheduled_time
+            order.scheduled_at = orderbook.parse_scheduled(payload.scheduled_time)
         if payload.cash_amount is not None:
             order.cash_amount = payload.cash_amount
         if payload.comm_log is not None:
@@ -1032,7 +1237,7 @@ async def update_order_status(
                 driver_fee = calculate_driver_fee(order.tags)
                 cash_amt = payload.cash_amount or (order.cash_amount or 0)
                 payout_id = await add_to_payout(
-                    session, driver, payload.order_name, cash_amt, driver_fee
+                    session, driver, order, cash_amt, driver_fee
                 )
                 order.payout_id = payout_id
                 order.driver_fee = driver_fee
@@ -1041,21 +1246,14 @@ async def update_order_status(
             and payload.new_status != "Livré"
             and prev_status == "Livré"
         ):
-            driver_fee = order.driver_fee or 0
-            cash_amt = (
-                payload.cash_amount
-                if payload.cash_amount is not None
-                else (order.cash_amount or 0)
-            )
-            await remove_from_payout(
-                session, order.payout_id, payload.order_name, cash_amt, driver_fee
-            )
+            await remove_from_payout(session, order.payout_id, order)
             order.payout_id = None
 
+        await stats.track(session, [before], [order])
+        await orderbook.mark_changed(session, driver, order)
         await session.commit()
 
-        await cache_delete("orders", driver)
-        await cache_delete("payouts", driver)
+        await invalidate_driver(driver)
         await manager.broadcast(
             {
                 "type": "status_update",
@@ -1075,22 +1273,22 @@ async def accept_return(payload: ManualAdd, request: Request, driver: str = Quer
         if not order:
             raise HTTPException(status_code=404, detail="Order not found")
 
+        before = stats.contribution(order)
         order.return_pending = 0
         order.return_agent = request.cookies.get("agent") or "unknown"
         order.return_time = dt.datetime.utcnow()
-        ts = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        event = events.record(session, order, events.RETURN_ACCEPTED, actor=order.return_agent)
+        # The follow log stays a plain column the follow page edits and saves
+        # back whole, so the acceptance is still written into it
+        ts = event.ts.strftime(events.STATUS_TS_FORMAT)
         order.follow_log = (
-            (order.follow_log or "")
-            + f"{ts} - Return accepted by {order.return_agent}\n"
+            (order.follow_log or "") + f"{ts} - Return accepted by {order.return_agent}\n"
         ).lstrip()
-        order.status_log = (
-            (order.status_log or "")
-            + f" | return accepted {order.return_agent} @ {ts}"
-        ).strip(" |")
 
+        await stats.track(session, [before], [order])
+        await orderbook.mark_changed(session, driver, order)
         await session.commit()
-        await cache_delete("orders", driver)
-        await cache_delete("archive", driver)
+        await invalidate_driver(driver)
         await manager.broadcast(
             {
                 "type": "status_update",
@@ -1104,47 +1302,34 @@ async def accept_return(payload: ManualAdd, request: Request, driver: str = Quer
 
 # ----------------------------  PAYOUTS  -------------------------------
 @app.get("/payouts", tags=["payouts"])
-async def get_payouts(driver: str = Query(...)):
-    cached = await cache_get("payouts", driver)
+async def get_payouts(request: Request, response: Response, driver: str = Query(...)):
+    etag = await driver_etag(driver, "payouts")
+    not_modified = check_etag(request, response, etag)
+    if not_modified:
+        return not_modified
+    version = await data_version(driver)
+    cached = await cache_get("payouts", driver, version)
     if cached is not None:
         return cached
 
     async for session in get_session():
         await get_driver(session, driver)
         result = await session.execute(
-            select(Payout)
+            select(Payout, PayoutItem.order_name, PayoutItem.cash, PayoutItem.fee)
+            .outerjoin(PayoutItem, PayoutItem.payout_id == Payout.id)
             .where(Payout.driver_id == driver)
-            .order_by(Payout.date_created.desc())
+            .order_by(Payout.date_created.desc(), Payout.id, PayoutItem.id)
         )
-        rows = result.scalars().all()
         payouts = []
-        for p in rows:
-            orders_list = [o.strip() for o in (p.orders or "").split(",") if o.strip()]
-            order_details = []
-            for name in orders_list:
-                order = await session.scalar(
-                    select(Order).where(
-                        Order.driver_id == driver, Order.order_name == name
-                    )
-                )
-                if order:
-                    order_details.append(
-                        {
-                            "name": name,
-                            "cashAmount": order.cash_amount or 0,
-                            "driverFee": order.driver_fee or 0,
-                        }
-                    )
-                else:
-                    order_details.append(
-                        {"name": name, "cashAmount": 0.0, "driverFee": 0.0}
-                    )
-
-            payouts.append(
-                {
+        by_id: dict[int, dict] = {}
+        for p, name, cash, fee in result:
+            entry = by_id.get(p.id)
+            if entry is None:
+                entry = by_id[p.id] = {
                     "payoutId": p.payout_id,
                     "dateCreated": p.date_created.strftime("%Y-%m-%d %H:%M:%S"),
-                    "orders": p.orders,
+                    # not yet migrated payouts still carry the legacy string
+                    "orders": p.orders or "",
                     "totalCash": p.total_cash or 0,
                     "totalFees": p.total_fees or 0,
                     "totalPayout": p.total_payout or 0,
@@ -1152,11 +1337,18 @@ async def get_payouts(driver: str = Query(...)):
                     "datePaid": (
                         p.date_paid.strftime("%Y-%m-%d %H:%M:%S") if p.date_paid else ""
                     ),
-                    "orderDetails": order_details,
+                    "orderDetails": [],
                 }
-            )
+                payouts.append(entry)
+            if name is not None:
+                entry["orderDetails"].append(
+                    {"name": name, "cashAmount": cash or 0, "driverFee": fee or 0}
+                )
+        for entry in payouts:
+            if entry["orderDetails"]:
+                entry["orders"] = ", ".join(d["name"] for d in entry["orderDetails"])
 
-        await cache_set("payouts", driver, payouts)
+        await cache_set("payouts", driver, payouts, version)
         return payouts
 
 
@@ -1176,26 +1368,31 @@ async def mark_payout_paid(payout_id: str, driver: str = Query(...)):
         payout.date_paid = dt.datetime.utcnow()
 
         result = await session.execute(
-            select(Order).where(Order.payout_id == payout_id)
+            select(Order).where(Order.driver_id == driver, Order.payout_id == payout_id)
         )
+        changed, before = [], []
         for o in result.scalars():
             if o.delivery_status == "Livré":
+                before.append(stats.contribution(o))
                 o.delivery_status = "Paid"
-                ts = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                o.status_log = ((o.status_log or "") + f" | Paid @ {ts}").strip(" |")
-                await manager.broadcast(
-                    {
-                        "type": "status_update",
-                        "driver": driver,
-                        "order": o.order_name,
-                        "status": "Paid",
-                    }
-                )
+                events.record(session, o, events.STATUS, status="Paid", actor=driver)
+                changed.append(o)
 
+        if changed:
+            await stats.track(session, before, changed)
+            await orderbook.mark_changed(session, driver, *changed)
         await session.commit()
 
-        await cache_delete("payouts", driver)
-        await cache_delete("orders", driver)
+        await invalidate_driver(driver)
+        for o in changed:
+            await manager.broadcast(
+                {
+                    "type": "status_update",
+                    "driver": driver,
+                    "order": o.order_name,
+                    "status": "Paid",
+                }
+            )
         return {"success": True}
 
 
@@ -1215,26 +1412,31 @@ async def mark_payout_unpaid(payout_id: str, driver: str = Query(...)):
         payout.date_paid = None
 
         result = await session.execute(
-            select(Order).where(Order.payout_id == payout_id)
+            select(Order).where(Order.driver_id == driver, Order.payout_id == payout_id)
         )
+        changed, before = [], []
         for o in result.scalars():
             if o.delivery_status == "Paid":
+                before.append(stats.contribution(o))
                 o.delivery_status = "Livré"
-                ts = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                o.status_log = ((o.status_log or "") + f" | Livré @ {ts}").strip(" |")
-                await manager.broadcast(
-                    {
-                        "type": "status_update",
-                        "driver": driver,
-                        "order": o.order_name,
-                        "status": "Livré",
-                    }
-                )
+                events.record(session, o, events.STATUS, status="Livré", actor=driver)
+                changed.append(o)
 
+        if changed:
+            await stats.track(session, before, changed)
+            await orderbook.mark_changed(session, driver, *changed)
         await session.commit()
 
-        await cache_delete("payouts", driver)
-        await cache_delete("orders", driver)
+        await invalidate_driver(driver)
+        for o in changed:
+            await manager.broadcast(
+                {
+                    "type": "status_update",
+                    "driver": driver,
+                    "order": o.order_name,
+                    "status": "Livré",
+                }
+            )
         return {"success": True}
 
 
@@ -1253,7 +1455,9 @@ async def update_payout(
             raise HTTPException(status_code=404, detail="Payout not found")
 
         if payload.orders is not None:
-            payout.orders = payload.orders
+            relinked = await set_payout_orders(session, payout, payload.orders)
+            if relinked:
+                await orderbook.mark_changed(session, driver, *relinked)
         if payload.total_cash is not None:
             payout.total_cash = payload.total_cash
         if payload.total_fees is not None:
@@ -1269,21 +1473,16 @@ async def update_payout(
             payout.total_payout = (payout.total_cash or 0) - (payout.total_fees or 0)
 
         await session.commit()
-        await cache_delete("payouts", driver)
+        await invalidate_driver(driver)
         return {"success": True}
 
 
 # ----------------------------  STATS  -------------------------------
-async def _compute_stats(
-    session: AsyncSession,
-    driver: str,
+def _stats_range(
     days: int | None = None,
     start: str | None = None,
     end: str | None = None,
-) -> dict:
-    await get_driver(session, driver)
-    q = select(Order).where(Order.driver_id == driver)
-
+) -> tuple[dt.date | None, dt.date | None]:
     if start:
         try:
             start_date = dt.datetime.strptime(start, "%Y-%m-%d").date()
@@ -1301,57 +1500,7 @@ async def _compute_stats(
             raise HTTPException(status_code=400, detail="Invalid end date")
     else:
         end_date = None
-
-    if start_date:
-        q = q.where(Order.scan_date >= start_date.strftime("%Y-%m-%d"))
-    if end_date:
-        q = q.where(Order.scan_date <= end_date.strftime("%Y-%m-%d"))
-
-    result = await session.execute(q)
-    rows = result.scalars().all()
-
-    total = delivered = returned = pending_ret = 0
-    collect = fees = canceled_amount = 0.0
-    for o in rows:
-        sd = None
-        try:
-            sd = (
-                dt.datetime.strptime(o.scan_date, "%Y-%m-%d").date()
-                if o.scan_date
-                else None
-            )
-        except Exception:
-            sd = None
-        if start_date and (not sd or sd < start_date):
-            continue
-        if end_date and (not sd or sd > end_date):
-            continue
-        total += 1
-        status = o.delivery_status
-        cash = o.cash_amount or 0
-        fee = o.driver_fee or 0
-        if status in ("Livré", "Paid"):
-            delivered += 1
-            collect += cash
-            fees += fee
-        elif status in ("Returned", "Annulé", "Refusé"):
-            if o.return_pending:
-                pending_ret += 1
-            else:
-                returned += 1
-                canceled_amount += cash
-
-    rate = (delivered / total * 100) if total else 0
-    return {
-        "totalOrders": total,
-        "delivered": delivered,
-        "returned": returned,
-        "pendingReturns": pending_ret,
-        "totalCollect": collect,
-        "totalFees": fees,
-        "deliveryRate": rate,
-        "canceledAmount": canceled_amount,
-    }
+    return start_date, end_date
 
 
 @app.get("/stats", tags=["stats"])
@@ -1362,8 +1511,10 @@ async def get_stats(
     end: str | None = Query(None),
 ):
     async for session in get_session():
-        stats = await _compute_stats(session, driver, days, start, end)
-        return stats
+        await get_driver(session, driver)
+        start_date, end_date = _stats_range(days, start, end)
+        result = await stats.load_stats(session, start_date, end_date, driver_id=driver)
+        return result.get(driver) or stats.empty_stats()
 
 
 @app.get("/admin/stats", tags=["admin"])
@@ -1373,11 +1524,10 @@ async def admin_stats(
     end: str | None = Query(None),
 ):
     async for session in get_session():
-        drivers = await load_drivers(session)
-        result = {}
-        for d in drivers.keys():
-            result[d] = await _compute_stats(session, d, days, start, end)
-        return result
+        start_date, end_date = _stats_range(days, start, end)
+        drivers = (await session.execute(select(Driver.id))).scalars().all()
+        per_driver = await stats.load_stats(session, start_date, end_date)
+        return {d: per_driver.get(d) or stats.empty_stats() for d in drivers}
 
 
 # -------------------------------------------------------------------
@@ -1388,92 +1538,57 @@ async def admin_trends(
     start: str | None = Query(None),
     end: str | None = Query(None),
     days: int | None = Query(None),
+    by: str | None = Query(None, pattern="^(driver|store|merchant)$"),
 ):
-    """Return delivered count per day across all drivers."""
-    if start:
-        try:
-            start_date = dt.datetime.strptime(start, "%Y-%m-%d").date()
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid start date")
-    elif days and days > 0:
-        start_date = dt.datetime.now().date() - dt.timedelta(days=days - 1)
-    else:
-        start_date = None
+    """Return delivered count per day across all drivers.
 
-    if end:
-        try:
-            end_date = dt.datetime.strptime(end, "%Y-%m-%d").date()
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid end date")
-    else:
-        end_date = dt.datetime.now().date()
+    Every day of the range is listed, with zero when nothing was delivered.
+    ``by`` adds a per driver, store or merchant ``breakdown`` to each day.
+    """
+    start_date, end_date = _stats_range(days, start, end)
+    end_date = end_date or dt.datetime.now().date()
 
     async for session in get_session():
-        drivers = await load_drivers(session)
-        counts: dict[dt.date, int] = {}
-        for driver in drivers.keys():
-            q = select(Order).where(
-                Order.driver_id == driver,
-                Order.delivery_status.in_(["Livré", "Paid"]),
-            )
-            if start_date:
-                q = q.where(Order.scan_date >= start_date.strftime("%Y-%m-%d"))
-            if end_date:
-                q = q.where(Order.scan_date <= end_date.strftime("%Y-%m-%d"))
-            result = await session.execute(q)
-            for o in result.scalars():
-                try:
-                    sd = (
-                        dt.datetime.strptime(o.scan_date, "%Y-%m-%d").date()
-                        if o.scan_date
-                        else None
-                    )
-                except Exception:
-                    continue
-                if not sd:
-                    continue
-                counts[sd] = counts.get(sd, 0) + 1
-
-        days_sorted = sorted(counts.keys())
-        return [
-            {"date": d.strftime("%Y-%m-%d"), "delivered": counts[d]}
-            for d in days_sorted
-        ]
+        return await stats.load_trend(session, start_date, end_date, by)
 
 
 @app.get("/admin/search", tags=["admin"])
-async def admin_search(q: str = Query(...)):
-    """Search orders across all drivers by order name or phone."""
-    q_lower = q.lower()
+async def admin_search(
+    response: Response,
+    q: str = Query(...),
+    limit: int = Query(50, ge=1, le=200),
+    cursor: str | None = Query(None, description="X-Next-Cursor of the previous page"),
+):
+    """Search orders across all drivers by order number, phone or name.
+
+    Exact matches come first, then prefixes, then substrings.  Results come
+    in pages of ``limit``; the ``X-Next-Cursor`` header holds the next
+    page's cursor when more results exist.
+    """
     results: list[dict] = []
     async for session in get_session():
-        drivers = await load_drivers(session)
-        for driver in drivers.keys():
-            result = await session.execute(
-                select(Order).where(
-                    Order.driver_id == driver,
-                    or_(
-                        Order.order_name.ilike(f"%{q_lower}%"),
-                        Order.customer_phone.ilike(f"%{q_lower}%"),
-                    ),
-                )
+        try:
+            orders, next_cursor = await search.search_orders(session, q, limit, cursor)
+        except ValueError as exc:
+            raise HTTPException(status_code=400, detail=str(exc))
+        for o in orders:
+            results.append(
+                {
+                    "driver": o.driver_id,
+                    "orderName": o.order_name,
+                    "customerName": o.customer_name,
+                    "customerPhone": o.customer_phone,
+                    "deliveryStatus": o.delivery_status or "Dispatched",
+                    "cashAmount": o.cash_amount or 0,
+                    "address": o.address,
+                    "scheduledTime": o.scheduled_time,
+                    "notes": o.notes,
+                    "followLog": o.follow_log,
+                    "timestamp": o.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
+                }
             )
-            for o in result.scalars():
-                results.append(
-                    {
-                        "driver": driver,
-                        "orderName": o.order_name,
-                        "customerName": o.customer_name,
-                        "customerPhone": o.customer_phone,
-                        "deliveryStatus": o.delivery_status or "Dispatched",
-                        "cashAmount": o.cash_amount or 0,
-                        "address": o.address,
-                        "scheduledTime": o.scheduled_time,
-                        "notes": o.notes,
-                        "followLog": o.follow_log,
-                        "timestamp": o.timestamp.strftime("%Y-%m-%d %H:%M:%S"),
-                    }
-                )
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
         return results
 
 
@@ -1492,24 +1607,9 @@ async def admin_verify(
         end,
         q,
     )
+    if not (start or end or date):
+        raise HTTPException(status_code=400, detail="Date or range required")
     async for session in get_session():
-        dates_to_sync: list[str] = []
-        if start or end:
-            s = dt.datetime.strptime(start or end or "", "%Y-%m-%d").date()
-            e = dt.datetime.strptime(end or start or "", "%Y-%m-%d").date()
-            if e < s:
-                s, e = e, s
-            current = s
-            while current <= e:
-                dates_to_sync.append(current.strftime("%Y-%m-%d"))
-                current += dt.timedelta(days=1)
-        elif date:
-            dates_to_sync.append(date)
-        else:
-            raise HTTPException(status_code=400, detail="Date or range required")
-
-        for d in dates_to_sync:
-            await sync_verification_orders(d, session)
 
         q_filter = []
         if q:
@@ -1604,32 +1704,72 @@ async def admin_verify_update(item_id: int, payload: VerificationUpdate):
 
 
 @app.post("/admin/verify/sync", tags=["admin"])
-async def admin_verify_sync(date: str = Query(...)):
-    """Manually import verification orders from the Google Sheet."""
+async def admin_verify_sync(
+    date: str | None = Query(None),
+    start: str | None = Query(None),
+    end: str | None = Query(None),
+):
+    """Manually import verification orders for a day or a date range.
+
+    The sheet is downloaded once for the whole range; the response lists
+    how many rows were created for each day.
+    """
+    first = start or end or date
+    last = end or start or date
+    if not first:
+        raise HTTPException(status_code=400, detail="Date or range required")
+    try:
+        days = _date_range(first, last)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid date")
     async for session in get_session():
-        await sync_verification_orders(date, session)
-        return {"success": True}
+        counts = await sync_verification_range(days[0], days[-1], session)
+        return {"success": True, "created": sum(counts.values()), "days": counts}
+
+
+@app.get("/admin/jobs", tags=["admin"])
+async def admin_jobs():
+    """Last-run status of the background jobs (e.g. verification sync)."""
+    return await jobs.job_statuses()
+
+
+@app.get("/admin/ws", tags=["admin"])
+async def admin_ws_stats():
+    """Open sockets, outbound queue depth and dropped/coalesced events."""
+    return manager.stats()
+
+
+@app.get("/admin/sheet-cache", tags=["admin"])
+async def admin_sheet_cache():
+    """Report size and age of the in-memory fallback sheet snapshot."""
+    return sheet_utils.snapshot.stats()
 
 
 @app.get("/admin/notes", tags=["admin"])
-async def admin_list_notes(driver: str | None = Query(None)):
+async def admin_list_notes(
+    driver: str | None = Query(None),
+    limit: int | None = Query(None, ge=1, le=200),
+    before: int | None = Query(None, description="id of the last note already shown"),
+):
     async for session in get_session():
-        q = select(DeliveryNote).order_by(DeliveryNote.created_at.desc())
-        if driver:
-            q = q.where(DeliveryNote.driver_id == driver)
-        result = await session.execute(q)
+        summaries = await load_note_summaries(
+            session, driver or None, limit=limit, before=before
+        )
+        result = await session.execute(
+            select(DeliveryNoteItem.note_id, Order)
+            .join(Order, Order.id == DeliveryNoteItem.order_id)
+            .where(DeliveryNoteItem.note_id.in_([row["note"].id for row in summaries]))
+            .order_by(DeliveryNoteItem.id)
+        )
+        note_orders: dict[int, list[Order]] = {}
+        for note_id, o in result:
+            note_orders.setdefault(note_id, []).append(o)
+
         notes = []
-        for n in result.scalars():
-            item_rows = await session.execute(
-                select(Order)
-                .join(DeliveryNoteItem, DeliveryNoteItem.order_id == Order.id)
-                .where(DeliveryNoteItem.note_id == n.id)
-            )
-            orders = item_rows.scalars().all()
-            summary = {"delivered": 0, "cancelled": 0, "returned": 0}
+        for row in summaries:
+            n = row["note"]
             items = []
-            for o in orders:
-                await sync_order_paid_status(session, o)
+            for o in note_orders.get(n.id, []):
                 pending = bool(o.return_pending) and o.delivery_status in ("Returned", "Annulé", "Refusé")
                 items.append(
                     {
@@ -1638,23 +1778,16 @@ async def admin_list_notes(driver: str | None = Query(None)):
                         "returnPending": pending,
                     }
                 )
-                if o.delivery_status in ("Livré", "Paid"):
-                    summary["delivered"] += 1
-                elif o.delivery_status in ("Annulé", "Refusé"):
-                    summary["cancelled"] += 1
-                elif o.delivery_status == "Returned":
-                    summary["returned"] += 1
             notes.append(
                 {
                     "id": n.id,
                     "driver": n.driver_id,
                     "createdAt": n.created_at.strftime("%Y-%m-%d %H:%M:%S"),
                     "status": n.status,
-                    "summary": summary,
+                    "summary": row["summary"],
                     "items": items,
                 }
             )
-        await session.commit()
         return notes
 
 
@@ -1,11 +1,15 @@
 from sqlalchemy import (
     Column,
     Integer,
+    BigInteger,
     String,
     Float,
     DateTime,
+    Date,
     Text,
     ForeignKey,
+    Index,
+    UniqueConstraint,
 )
 from sqlalchemy.orm import declarative_base, relationship
 from datetime import datetime
@@ -19,9 +23,20 @@ class Driver(Base):
     id = Column(String, primary_key=True)
     order_tab = Column(String)
     payouts_tab = Column(String)
+    # Last change version handed out to one of this driver's orders
+    change_version = Column(BigInteger, default=0)
 
 class Order(Base):
     __tablename__ = "orders"
+    __table_args__ = (
+        Index("ix_orders_driver_change_version", "driver_id", "change_version"),
+        Index("ix_orders_driver_last_status_at", "driver_id", "last_status_at"),
+        Index("ix_orders_driver_scheduled_at", "driver_id", "scheduled_at"),
+        Index("ix_orders_driver_scan_date", "driver_id", "scan_date"),
+        Index("ix_orders_driver_status", "driver_id", "delivery_status"),
+        Index("uq_orders_driver_order_name", "driver_id", "order_name", unique=True),
+    )
+
     id = Column(Integer, primary_key=True, autoincrement=True)
     driver_id = Column(String, ForeignKey("drivers.id"), index=True)
     timestamp = Column(DateTime, default=datetime.utcnow, index=True)
@@ -37,7 +52,7 @@ class Order(Base):
     notes = Column(Text)
     driver_notes = Column(Text)
     scheduled_time = Column(String)
-    scan_date = Column(String, index=True)
+    scan_date = Column(Date, index=True)
     cash_amount = Column(Float)
     driver_fee = Column(Float)
     payout_id = Column(String)
@@ -47,15 +62,39 @@ class Order(Base):
     return_pending = Column(Integer, default=0)
     return_agent = Column(String)
     return_time = Column(DateTime)
+    # Driver's change version at the last write; see /orders/changes
+    change_version = Column(BigInteger, default=0)
+    # Time of the scan or latest status event (local time, like timestamp)
+    last_status_at = Column(DateTime)
+    # scheduled_time parsed, so follow-ups can compare it in SQL
+    scheduled_at = Column(DateTime)
+    # Digits of order_name / customer_phone for /admin/search
+    order_number = Column(String, index=True)
+    phone_digits = Column(String, index=True)
 
     driver = relationship("Driver")
 
+class OrderEvent(Base):
+    """One entry of an order's timeline: a status change, note or scan."""
+
+    __tablename__ = "order_events"
+    __table_args__ = (Index("ix_order_events_order_ts", "order_id", "ts"),)
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=False)
+    kind = Column(String, nullable=False)  # status, driver_note, return_accepted, scan
+    status = Column(String)
+    actor = Column(String)
+    ts = Column(DateTime, nullable=False)  # local time, like Order.timestamp
+    text = Column(Text)
+
 class Payout(Base):
     __tablename__ = "payouts"
     id = Column(Integer, primary_key=True, autoincrement=True)
     driver_id = Column(String, ForeignKey("drivers.id"), index=True)
     payout_id = Column(String, index=True)
     date_created = Column(DateTime, default=datetime.utcnow, index=True)
+    # Legacy comma-joined order names; moved into payout_items and cleared
     orders = Column(Text)
     total_cash = Column(Float)
     total_fees = Column(Float)
@@ -64,6 +103,23 @@ class Payout(Base):
     date_paid = Column(DateTime)
 
     driver = relationship("Driver")
+    items = relationship(
+        "PayoutItem", back_populates="payout", order_by="PayoutItem.id"
+    )
+
+class PayoutItem(Base):
+    """One order collected in a payout, with the cash and fee it added."""
+
+    __tablename__ = "payout_items"
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    payout_id = Column(Integer, ForeignKey("payouts.id"), nullable=False, index=True)
+    order_id = Column(Integer, ForeignKey("orders.id"), index=True)
+    order_name = Column(String, nullable=False)
+    cash = Column(Float, default=0)
+    fee = Column(Float, default=0)
+
+    payout = relationship("Payout", back_populates="items")
+    order = relationship("Order")
 
 class DeliveryNote(Base):
     __tablename__ = "delivery_notes"
@@ -78,6 +134,9 @@ class DeliveryNote(Base):
 
 class DeliveryNoteItem(Base):
     __tablename__ = "delivery_note_items"
+    __table_args__ = (
+        Index("ix_delivery_note_items_order_note", "order_id", "note_id"),
+    )
     id = Column(Integer, primary_key=True, autoincrement=True)
     note_id = Column(Integer, ForeignKey("delivery_notes.id",), index=True)
     order_id = Column(Integer, ForeignKey("orders.id"), index=True)
@@ -113,6 +172,61 @@ class VerificationOrder(Base):
     driver = relationship("Driver")
 
 
+class ShopifyOrder(Base):
+    """Local mirror of Shopify orders kept current by webhooks."""
+
+    __tablename__ = "shopify_orders"
+    __table_args__ = (
+        UniqueConstraint("store", "shopify_id", name="uq_shopify_orders_store_id"),
+        Index("ix_shopify_orders_name_created", "order_name", "created_at"),
+    )
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    store = Column(String, nullable=False)
+    shopify_id = Column(BigInteger, nullable=False)
+    order_name = Column(String, nullable=False)
+    created_at = Column(DateTime)  # UTC, naive
+    updated_at = Column(DateTime)  # Shopify's updated_at, UTC, naive
+    cancelled_at = Column(DateTime)
+    tags = Column(String)
+    fulfillment_status = Column(String)
+    cod_total = Column(Float)
+    customer_name = Column(String)
+    customer_phone = Column(String)
+    address = Column(Text)
+
+
+class DriverDailyStats(Base):
+    """Per driver and scan day totals behind the stats and trend endpoints."""
+
+    __tablename__ = "driver_daily_stats"
+
+    driver_id = Column(String, primary_key=True)
+    day = Column(Date, primary_key=True)  # the orders' scan_date
+    scanned = Column(Integer, nullable=False, default=0)
+    delivered = Column(Integer, nullable=False, default=0)
+    returned = Column(Integer, nullable=False, default=0)
+    pending_returns = Column(Integer, nullable=False, default=0)
+    collect = Column(Float, nullable=False, default=0)
+    fees = Column(Float, nullable=False, default=0)
+    canceled_amount = Column(Float, nullable=False, default=0)
+
+
+class JobStatus(Base):
+    """Lease and last-run bookkeeping for a periodic background job."""
+
+    __tablename__ = "job_status"
+
+    name = Column(String, primary_key=True)
+    lease_until = Column(DateTime)
+    last_started_at = Column(DateTime)
+    last_finished_at = Column(DateTime)
+    last_success_at = Column(DateTime)
+    last_status = Column(String)
+    last_message = Column(Text)
+    last_count = Column(Integer)
+
+
 # ---------------------------------------------------------------------------
 # Follow Agents and assignments
 # ---------------------------------------------------------------------------
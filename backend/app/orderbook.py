@@ -0,0 +1,339 @@
+"""Per-driver order book behind the driver app's order lists.
+
+``/orders``, ``/orders/archive``, ``/orders/all`` and ``/orders/followups``
+are all views over the same set of rows: a driver's non-deleted orders that
+are not held in a pending delivery note.  The book is loaded with a single
+column-projected query, serialized once and cached as a whole; each endpoint
+then filters and sorts it in memory.
+
+Every write to an order stamps it with the driver's next change version so
+``/orders/changes`` can hand a client only the rows it has not seen yet.
+"""
+
+import datetime as dt
+from typing import Optional
+
+from sqlalchemy import select, update, and_, or_, func
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from . import events
+from .models import Driver, Order, OrderEvent, DeliveryNote, DeliveryNoteItem
+from .utils import parse_timestamp, serialize_order
+
+COMPLETED_STATUSES = [
+    "Livré",
+    "Paid",
+    "Deleted",
+]
+ARCHIVE_STATUSES = [
+    "Livré",
+    "Paid",
+    "Annulé",
+    "Refusé",
+    "Returned",
+]
+FOLLOWUP_STATUSES = ["Pas de réponse 3", "Rescheduled"]
+# Orders untouched for longer than this need a follow-up call.
+FOLLOWUP_STALE_SECONDS = 8 * 3600
+# Scheduled orders due within this window are flagged urgent.
+URGENT_WINDOW_SECONDS = 3600
+
+# Only the columns serialize_order and the views read.
+BOOK_COLUMNS = (
+    Order.id.label("order_id"),
+    Order.timestamp,
+    Order.order_name,
+    Order.customer_name,
+    Order.customer_phone,
+    Order.address,
+    Order.tags,
+    Order.delivery_status,
+    Order.notes,
+    Order.driver_notes,
+    Order.scheduled_time,
+    Order.scan_date,
+    Order.cash_amount,
+    Order.driver_fee,
+    Order.payout_id,
+    Order.status_log,
+    Order.comm_log,
+    Order.follow_log,
+    Order.return_pending,
+)
+
+
+def _visible(status: Optional[str], note_id, note_status: Optional[str]) -> bool:
+    return (
+        status is not None
+        and status != "Deleted"
+        and (note_id is None or note_status == "approved")
+    )
+
+
+async def load_order_book(session: AsyncSession, driver_id: str) -> list[dict]:
+    """Load every order any of the list views can show for ``driver_id``.
+
+    Each entry holds the serialized order under ``order`` plus the raw
+    fields the views filter on, so the whole book stays JSON-serializable
+    for the shared cache.  The orders' timeline rows are fetched with one
+    more query to render the status log and driver notes.
+    """
+    result = await session.execute(
+        select(*BOOK_COLUMNS)
+        .outerjoin(DeliveryNoteItem, DeliveryNoteItem.order_id == Order.id)
+        .outerjoin(DeliveryNote, DeliveryNote.id == DeliveryNoteItem.note_id)
+        .where(
+            Order.driver_id == driver_id,
+            Order.delivery_status != "Deleted",
+            or_(
+                DeliveryNote.status == "approved",
+                DeliveryNote.id == None,
+            ),
+        )
+    )
+    rows = result.all()
+    log = await events.load_log_events(session, {row.order_id for row in rows})
+    book = []
+    for row in rows:
+        book.append(
+            {
+                "order": serialize_order(row, log.get(row.order_id, ())),
+                "status": row.delivery_status,
+                "returnPending": bool(row.return_pending),
+            }
+        )
+    return book
+
+
+def _scheduled_at(order: dict) -> Optional[dt.datetime]:
+    if not order["scheduledTime"]:
+        return None
+    try:
+        return parse_timestamp(order["scheduledTime"])
+    except Exception:
+        return None
+
+
+def active_orders(book: list[dict], now: Optional[dt.datetime] = None) -> list[dict]:
+    """Open orders, soonest scheduled (or oldest scanned) first."""
+    now = now or dt.datetime.now()
+    active = []
+    for entry in book:
+        if entry["status"] in COMPLETED_STATUSES:
+            continue
+        item = dict(entry["order"])
+        st = _scheduled_at(item)
+        item["urgent"] = st is not None and (st - now).total_seconds() <= URGENT_WINDOW_SECONDS
+        active.append((st or parse_timestamp(item["timestamp"]), item))
+    active.sort(key=lambda pair: pair[0])
+    return [item for _, item in active]
+
+
+def archived_orders(book: list[dict]) -> list[dict]:
+    """Finished orders with no pending return, newest first."""
+    archived = [
+        entry["order"]
+        for entry in book
+        if entry["status"] in ARCHIVE_STATUSES and not entry["returnPending"]
+    ]
+    archived.sort(key=lambda o: o["timestamp"], reverse=True)
+    return archived
+
+
+def all_orders(book: list[dict]) -> list[dict]:
+    """Every non-deleted order in the book."""
+    return [entry["order"] for entry in book]
+
+
+async def load_followups(
+    session: AsyncSession, driver_id: str, now: Optional[dt.datetime] = None
+) -> list[dict]:
+    """Open orders that are overdue, stale or waiting on the customer.
+
+    Runs entirely in SQL on the indexed ``scheduled_at`` / ``last_status_at``
+    columns, so the cost follows the number of follow-ups rather than the
+    driver's whole backlog.
+    """
+    # Naive UTC to match the timestamps stored in SQLite/PG
+    now = now or dt.datetime.utcnow()
+    stale_before = now - dt.timedelta(seconds=FOLLOWUP_STALE_SECONDS)
+    result = await session.execute(
+        select(*BOOK_COLUMNS, Order.scheduled_at)
+        .outerjoin(DeliveryNoteItem, DeliveryNoteItem.order_id == Order.id)
+        .outerjoin(DeliveryNote, DeliveryNote.id == DeliveryNoteItem.note_id)
+        .where(
+            Order.driver_id == driver_id,
+            Order.delivery_status.notin_(COMPLETED_STATUSES),
+            or_(
+                DeliveryNote.status == "approved",
+                DeliveryNote.id == None,
+            ),
+            or_(
+                Order.scheduled_at <= now,
+                Order.last_status_at < stale_before,
+                and_(Order.last_status_at == None, Order.timestamp < stale_before),
+                Order.delivery_status.in_(FOLLOWUP_STATUSES),
+            ),
+        )
+    )
+    rows = result.all()
+    log = await events.load_log_events(session, {row.order_id for row in rows})
+    followups = []
+    for row in rows:
+        item = serialize_order(row, log.get(row.order_id, ()))
+        item["urgent"] = row.scheduled_at is not None and row.scheduled_at <= now
+        followups.append(item)
+    return followups
+
+
+def parse_scheduled(value: Optional[str]) -> Optional[dt.datetime]:
+    """Parse a ``scheduled_time`` string into the naive ``scheduled_at`` value."""
+    if not value:
+        return None
+    try:
+        return parse_timestamp(value).replace(tzinfo=None)
+    except Exception:
+        return None
+
+
+async def backfill_followup_columns(session: AsyncSession) -> int:
+    """Fill ``last_status_at`` / ``scheduled_at`` on rows written before them.
+
+    ``last_status_at`` comes from the newest status event, else the scan
+    time; ``scheduled_at`` is parsed from ``scheduled_time``.  Only rows
+    still missing a value are touched, so repeated runs are cheap.
+    """
+    latest = (
+        select(func.max(OrderEvent.ts))
+        .where(
+            OrderEvent.order_id == Order.id,
+            OrderEvent.kind.in_(events.STATUS_KINDS),
+        )
+        .scalar_subquery()
+    )
+    result = await session.execute(
+        update(Order)
+        .where(Order.last_status_at == None)
+        .values(last_status_at=func.coalesce(latest, Order.timestamp))
+        .execution_options(synchronize_session=False)
+    )
+    count = result.rowcount or 0
+
+    rows = await session.execute(
+        select(Order.id, Order.scheduled_time).where(
+            Order.scheduled_at == None,
+            Order.scheduled_time != None,
+            Order.scheduled_time != "",
+        )
+    )
+    parsed = [
+        {"id": order_id, "scheduled_at": parse_scheduled(value)}
+        for order_id, value in rows
+    ]
+    parsed = [p for p in parsed if p["scheduled_at"] is not None]
+    if parsed:
+        await session.execute(update(Order), parsed)
+    await session.commit()
+    return count + len(parsed)
+
+
+# ---------------------------------------------------------------------------
+# Change versions
+# ---------------------------------------------------------------------------
+
+
+async def bump_version(session: AsyncSession, driver_id: str) -> int:
+    """Take the driver's next change version inside the current transaction.
+
+    The UPDATE locks the driver row until commit, so versions for one driver
+    become visible in the order they were handed out.
+    """
+    return await session.scalar(
+        update(Driver)
+        .where(Driver.id == driver_id)
+        .values(change_version=func.coalesce(Driver.change_version, 0) + 1)
+        .returning(Driver.change_version)
+        .execution_options(synchronize_session=False)
+    )
+
+
+async def mark_changed(session: AsyncSession, driver_id: str, *orders: Order) -> int:
+    """Stamp ``orders`` with a fresh change version for ``driver_id``."""
+    version = await bump_version(session, driver_id)
+    for order in orders:
+        order.change_version = version
+    return version
+
+
+async def mark_note_changed(session: AsyncSession, driver_id: str, note_id: int) -> int:
+    """Stamp every order in a delivery note, e.g. when approval reveals them."""
+    version = await bump_version(session, driver_id)
+    await session.execute(
+        update(Order)
+        .where(
+            Order.id.in_(
+                select(DeliveryNoteItem.order_id).where(DeliveryNoteItem.note_id == note_id)
+            )
+        )
+        .values(change_version=version)
+        .execution_options(synchronize_session=False)
+    )
+    return version
+
+
+async def current_version(session: AsyncSession, driver_id: str) -> int:
+    return await session.scalar(
+        select(func.coalesce(Driver.change_version, 0)).where(Driver.id == driver_id)
+    ) or 0
+
+
+async def load_changes(
+    session: AsyncSession, driver_id: str, since: int, active_only: bool = False
+) -> dict:
+    """Return the driver's orders written after version ``since``.
+
+    Orders that are still shown in the book come back serialized under
+    ``orders``; deleted orders and orders now held in a draft note are only
+    named under ``removed``.  The version is read before the rows, so a
+    concurrent write is at worst sent twice, never skipped.
+
+    ``since=0``, or a version the server never handed out (e.g. after a
+    database restore), returns a full snapshot of the book flagged with
+    ``full`` so the client replaces what it holds.  With ``active_only`` the
+    snapshot is limited to the open orders; deltas always carry every
+    changed order.
+    """
+    version = await current_version(session, driver_id)
+    if since <= 0 or since > version:
+        book = await load_order_book(session, driver_id)
+        return {
+            "version": version,
+            "full": True,
+            "orders": active_orders(book) if active_only else all_orders(book),
+            "removed": [],
+        }
+    result = await session.execute(
+        select(*BOOK_COLUMNS, DeliveryNote.id, DeliveryNote.status)
+        .outerjoin(DeliveryNoteItem, DeliveryNoteItem.order_id == Order.id)
+        .outerjoin(DeliveryNote, DeliveryNote.id == DeliveryNoteItem.note_id)
+        .where(Order.driver_id == driver_id, Order.change_version > since)
+        .order_by(Order.change_version)
+    )
+    rows = result.all()
+    visible = [row for row in rows if _visible(row.delivery_status, row[-2], row[-1])]
+    log = await events.load_log_events(session, {row.order_id for row in visible})
+    changed: dict[str, dict] = {}
+    removed: dict[str, bool] = {}
+    for row in rows:
+        name = row.order_name
+        if _visible(row.delivery_status, row[-2], row[-1]):
+            changed[name] = serialize_order(row, log.get(row.order_id, ()))
+            removed.pop(name, None)
+        elif name not in changed:
+            removed[name] = True
+    return {
+        "version": version,
+        "full": False,
+        "orders": list(changed.values()),
+        "removed": list(removed),
+    }
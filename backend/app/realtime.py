@@ -0,0 +1,284 @@
+"""WebSocket push notifications.
+
+Every socket subscribes to topics when it connects: ``driver:<id>`` for a
+driver's app, one ``driver:<id>`` per assigned driver for a follow agent,
+and ``admin`` for dashboards that watch every driver.  Events about a driver
+go only to that driver's topic and ``admin``, so fan-out follows the number
+of interested sockets rather than every open connection.
+
+Events travel through a broadcast backend: :class:`LocalBroadcast` hands them
+straight to this process's sockets, :class:`RedisBroadcast` publishes each
+event once on a Redis channel that every worker listens to and delivers from.
+"""
+
+import asyncio
+import json
+import logging
+import os
+from typing import Callable, Iterable, Optional
+
+from fastapi import WebSocket
+
+logger = logging.getLogger(__name__)
+
+ADMIN_TOPIC = "admin"
+
+# events a socket may have waiting before it is considered stuck
+WS_QUEUE_SIZE = int(os.getenv("WS_QUEUE_SIZE", "100"))
+# seconds a single send may take before the socket is closed
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))
+WS_REDIS_CHANNEL = os.getenv("WS_REDIS_CHANNEL", "ws-events")
+
+Deliver = Callable[[dict, Iterable[str]], None]
+
+
+def driver_topic(driver_id: str) -> str:
+    return f"driver:{driver_id}"
+
+
+def event_topics(data: dict) -> list[str]:
+    """Topics an event is delivered to: its driver's and ``admin``."""
+    topics = [ADMIN_TOPIC]
+    if data.get("driver"):
+        topics.append(driver_topic(data["driver"]))
+    return topics
+
+
+def coalesce_key(data: dict) -> tuple:
+    """Events with the same key replace each other while still queued.
+
+    Clients treat every event as "reload this driver's orders/notes", so only
+    the latest one per kind and driver (and note) needs to go out.
+    """
+    return (data.get("type"), data.get("driver"), data.get("noteId"))
+
+
+class LocalBroadcast:
+    """Broadcast backend for a single process: publishing is delivering."""
+
+    def __init__(self, deliver: Deliver) -> None:
+        self.deliver = deliver
+
+    async def publish(self, data: dict, topics: Iterable[str]) -> None:
+        self.deliver(data, topics)
+
+    async def run(self) -> None:
+        """Nothing to listen to; returns at once."""
+
+
+class RedisBroadcast:
+    """Broadcast backend shared by every worker through Redis pub/sub.
+
+    ``publish`` sends the event once; :meth:`run` (one per worker) receives
+    every worker's events, this one's included, and delivers them to the
+    local sockets.
+    """
+
+    def __init__(
+        self, client, deliver: Deliver, channel: str = WS_REDIS_CHANNEL, retry: float = 5
+    ) -> None:
+        self.client = client
+        self.deliver = deliver
+        self.channel = channel
+        self.retry = retry
+        self.published = 0
+        self.received = 0
+
+    async def publish(self, data: dict, topics: Iterable[str]) -> None:
+        message = json.dumps({"topics": list(topics), "data": data})
+        try:
+            await self.client.publish(self.channel, message)
+        except Exception as exc:
+            # keep this worker's sockets up to date while Redis is away
+            logger.warning("Redis publish failed, delivering locally: %s", exc)
+            self.deliver(data, topics)
+            return
+        self.published += 1
+
+    async def run(self) -> None:
+        while True:
+            try:
+                await self.listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as exc:
+                logger.warning("Redis subscription lost, retrying: %s", exc)
+            await asyncio.sleep(self.retry)
+
+    async def listen(self) -> None:
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        try:
+            await pubsub.subscribe(self.channel)
+            async for message in pubsub.listen():
+                if message.get("type") != "message":
+                    continue
+                try:
+                    event = json.loads(message["data"])
+                    data, topics = event["data"], event["topics"]
+                except (ValueError, KeyError, TypeError):
+                    logger.warning("Ignoring malformed event on %s", self.channel)
+                    continue
+                self.received += 1
+                self.deliver(data, topics)
+        finally:
+            await pubsub.aclose()
+
+
+class Connection:
+    """One socket's outbound queue of coalesce keys and their latest event."""
+
+    def __init__(self, ws: WebSocket, maxsize: int) -> None:
+        self.ws = ws
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize)
+        self.pending: dict[tuple, dict] = {}
+        self.writer: Optional[asyncio.Task] = None
+
+
+class ConnectionManager:
+    """WebSocket connection manager for push notifications.
+
+    ``broadcast`` only enqueues: each socket has a bounded queue drained by
+    its own writer task, so a slow client never holds up the request that
+    produced an event or the other sockets.  A queued event is replaced by a
+    newer one with the same :func:`coalesce_key`; a socket whose queue still
+    overflows, or whose send takes longer than ``send_timeout``, is closed.
+    """
+
+    def __init__(
+        self, queue_size: int = WS_QUEUE_SIZE, send_timeout: float = WS_SEND_TIMEOUT
+    ) -> None:
+        self.queue_size = queue_size
+        self.send_timeout = send_timeout
+        # topic -> sockets subscribed to it, and the reverse
+        self.topics: dict[str, set[WebSocket]] = {}
+        self.subscriptions: dict[WebSocket, set[str]] = {}
+        self.connections: dict[WebSocket, Connection] = {}
+        self.closing: set[asyncio.Task] = set()
+        self.backend = LocalBroadcast(self.deliver)
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self.slow_disconnects = 0
+
+    @property
+    def active(self) -> list[WebSocket]:
+        return list(self.subscriptions)
+
+    async def connect(self, ws: WebSocket, topics: Iterable[str] = ()) -> None:
+        await ws.accept()
+        conn = Connection(ws, self.queue_size)
+        conn.writer = asyncio.create_task(self._write(conn))
+        self.connections[ws] = conn
+        self.subscriptions.setdefault(ws, set())
+        self.subscribe(ws, topics)
+
+    def subscribe(self, ws: WebSocket, topics: Iterable[str]) -> None:
+        subscribed = self.subscriptions.setdefault(ws, set())
+        for topic in topics:
+            subscribed.add(topic)
+            self.topics.setdefault(topic, set()).add(ws)
+
+    def disconnect(self, ws: WebSocket) -> None:
+        for topic in self.subscriptions.pop(ws, ()):
+            sockets = self.topics.get(topic)
+            if sockets is None:
+                continue
+            sockets.discard(ws)
+            if not sockets:
+                del self.topics[topic]
+        conn = self.connections.pop(ws, None)
+        if conn and conn.writer and conn.writer is not asyncio.current_task():
+            conn.writer.cancel()
+
+    def recipients(self, topics: Iterable[str]) -> set[WebSocket]:
+        targets: set[WebSocket] = set()
+        for topic in topics:
+            targets |= self.topics.get(topic, set())
+        return targets
+
+    async def broadcast(self, data: dict, topics: Optional[Iterable[str]] = None) -> None:
+        """Publish ``data`` to the sockets subscribed to ``topics``, in every
+        worker sharing the backend.
+
+        By default those are the event's driver topic and ``admin``.  Never
+        waits on a socket; local delivery only enqueues.
+        """
+        await self.backend.publish(data, event_topics(data) if topics is None else topics)
+
+    def deliver(self, data: dict, topics: Iterable[str]) -> None:
+        """Queue ``data`` for this process's sockets on ``topics``."""
+        for ws in self.recipients(topics):
+            self.send(ws, data)
+
+    def send(self, ws: WebSocket, data: dict) -> None:
+        """Queue ``data`` for one socket, closing it if its queue is full."""
+        conn = self.connections.get(ws)
+        if conn is None:
+            return
+        key = coalesce_key(data)
+        if key in conn.pending:
+            conn.pending[key] = data
+            self.coalesced += 1
+            return
+        try:
+            conn.queue.put_nowait(key)
+        except asyncio.QueueFull:
+            self.dropped += 1 + len(conn.pending)
+            self.slow_disconnects += 1
+            logger.warning("Closing WebSocket that fell %d events behind", conn.queue.qsize())
+            self.disconnect(ws)
+            self._schedule_close(ws)
+            return
+        conn.pending[key] = data
+
+    async def _write(self, conn: Connection) -> None:
+        while True:
+            key = await conn.queue.get()
+            data = conn.pending.pop(key, None)
+            if data is None:
+                continue
+            try:
+                await asyncio.wait_for(conn.ws.send_json(data), self.send_timeout)
+            except Exception as exc:
+                self.dropped += 1 + len(conn.pending)
+                if isinstance(exc, asyncio.TimeoutError):
+                    self.slow_disconnects += 1
+                    self._schedule_close(conn.ws)
+                self.disconnect(conn.ws)
+                return
+            self.sent += 1
+
+    def _schedule_close(self, ws: WebSocket) -> None:
+        # keep a reference until done so the task is not garbage collected
+        task = asyncio.create_task(self._close(ws))
+        self.closing.add(task)
+        task.add_done_callback(self.closing.discard)
+
+    async def shutdown(self) -> None:
+        """Stop every writer and wait for pending closes to finish."""
+        writers = [c.writer for c in self.connections.values() if c.writer]
+        for ws in self.active:
+            self.disconnect(ws)
+        await asyncio.gather(*writers, *self.closing, return_exceptions=True)
+
+    async def _close(self, ws: WebSocket) -> None:
+        try:
+            # 1013: try again later
+            await asyncio.wait_for(ws.close(code=1013), self.send_timeout)
+        except Exception:
+            pass
+
+    def stats(self) -> dict:
+        depths = [conn.queue.qsize() for conn in self.connections.values()]
+        return {
+            "connections": len(self.connections),
+            "topics": len(self.topics),
+            "queued": sum(depths),
+            "maxQueueDepth": max(depths, default=0),
+            "queueSize": self.queue_size,
+            "sent": self.sent,
+            "coalesced": self.coalesced,
+            "dropped": self.dropped,
+            "slowDisconnects": self.slow_disconnects,
+            "backend": type(self.backend).__name__,
+        }
@@ -0,0 +1,197 @@
+"""Order search for ``/admin/search``.
+
+Every order keeps the digits of its name and of the customer's phone in
+``order_number`` / ``phone_digits``.  Searches match those columns with one
+query across all drivers:
+
+* PostgreSQL serves the substring match from ``pg_trgm`` GIN indexes.
+* SQLite serves it from ``orders_search``, an FTS5 trigram table that
+  triggers keep in step with ``orders``.
+
+Queries with letters or without digits match ``order_name`` /
+``customer_phone`` case-insensitively instead.  Results are ranked exact
+match, then prefix, then substring, and paged with a ``rank:id`` cursor.
+"""
+
+import logging
+from typing import Optional
+
+from sqlalchemy import select, update, text, case, func, or_, and_
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Order
+
+logger = logging.getLogger(__name__)
+
+# FTS5 trigrams (and pg_trgm) need at least three characters to use the index
+MIN_INDEXED_LENGTH = 3
+BACKFILL_BATCH = 1000
+
+SQLITE_TRIGGERS = (
+    """
+    CREATE TRIGGER IF NOT EXISTS orders_search_ai AFTER INSERT ON orders BEGIN
+        INSERT INTO orders_search (rowid, order_number, phone_digits)
+        VALUES (new.id, new.order_number, new.phone_digits);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS orders_search_ad AFTER DELETE ON orders BEGIN
+        INSERT INTO orders_search (orders_search, rowid, order_number, phone_digits)
+        VALUES ('delete', old.id, old.order_number, old.phone_digits);
+    END
+    """,
+    """
+    CREATE TRIGGER IF NOT EXISTS orders_search_au
+    AFTER UPDATE OF order_number, phone_digits ON orders BEGIN
+        INSERT INTO orders_search (orders_search, rowid, order_number, phone_digits)
+        VALUES ('delete', old.id, old.order_number, old.phone_digits);
+        INSERT INTO orders_search (rowid, order_number, phone_digits)
+        VALUES (new.id, new.order_number, new.phone_digits);
+    END
+    """,
+)
+
+
+def digits(value: Optional[str]) -> str:
+    return "".join(filter(str.isdigit, value or ""))
+
+
+def index_order(order: Order) -> None:
+    """Fill the search columns from ``order_name`` / ``customer_phone``."""
+    order.order_number = digits(order.order_name)
+    order.phone_digits = digits(order.customer_phone)
+
+
+async def create_indexes(conn) -> None:
+    """Create the search index for the connection's database, if missing."""
+    if conn.dialect.name == "sqlite":
+        result = await conn.execute(
+            text("SELECT 1 FROM sqlite_master WHERE name='orders_search'")
+        )
+        if result.first():
+            return
+        await conn.execute(
+            text(
+                "CREATE VIRTUAL TABLE orders_search USING fts5("
+                "order_number, phone_digits, content='orders', "
+                "content_rowid='id', tokenize='trigram')"
+            )
+        )
+        for trigger in SQLITE_TRIGGERS:
+            await conn.execute(text(trigger))
+        await conn.execute(text("INSERT INTO orders_search (orders_search) VALUES ('rebuild')"))
+        return
+
+    try:
+        async with conn.begin_nested():
+            await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+    except Exception:
+        logger.warning("pg_trgm unavailable; order search falls back to sequential scans")
+        return
+    for column in ("order_number", "phone_digits"):
+        await conn.execute(
+            text(
+                f"CREATE INDEX IF NOT EXISTS ix_orders_{column}_trgm "
+                f"ON orders USING gin ({column} gin_trgm_ops)"
+            )
+        )
+
+
+def _matches(session: AsyncSession, term: str):
+    if session.get_bind().dialect.name == "sqlite" and len(term) >= MIN_INDEXED_LENGTH:
+        # Quoted so FTS5 reads the digits as one phrase, i.e. a substring
+        fts = (
+            text("SELECT rowid FROM orders_search WHERE orders_search MATCH :term")
+            .bindparams(term=f'"{term}"')
+            .columns(Order.id)
+        )
+        return Order.id.in_(fts)
+    return or_(
+        Order.order_number.contains(term, autoescape=True),
+        Order.phone_digits.contains(term, autoescape=True),
+    )
+
+
+def _text_search(query: str):
+    """Rank and filter for a case-insensitive match on the raw name/phone."""
+    query = query.strip()
+    columns = (Order.order_name, Order.customer_phone)
+    rank = case(
+        (or_(*(func.lower(c) == query.lower() for c in columns)), 0),
+        (or_(*(c.istartswith(query, autoescape=True) for c in columns)), 1),
+        else_=2,
+    )
+    return rank, or_(*(c.icontains(query, autoescape=True) for c in columns))
+
+
+async def search_orders(
+    session: AsyncSession,
+    query: str,
+    limit: int = 50,
+    cursor: Optional[str] = None,
+) -> tuple[list[Order], Optional[str]]:
+    """Return up to ``limit`` orders matching ``query`` and the next cursor.
+
+    Numeric queries search the digits of order numbers and phones.  Queries
+    with letters or without digits (customer names, ``#ABC`` order names)
+    fall back to a plain case-insensitive substring match.
+    """
+    term = digits(query)
+    if not term or any(ch.isalpha() for ch in query):
+        if not query.strip():
+            return [], None
+        rank, matches = _text_search(query)
+    else:
+        rank = case(
+            (or_(Order.order_number == term, Order.phone_digits == term), 0),
+            (
+                or_(
+                    Order.order_number.startswith(term, autoescape=True),
+                    Order.phone_digits.startswith(term, autoescape=True),
+                ),
+                1,
+            ),
+            else_=2,
+        )
+        matches = _matches(session, term)
+    q = select(Order, rank).where(matches)
+    if cursor:
+        try:
+            after_rank, after_id = (int(part) for part in cursor.split(":"))
+        except ValueError:
+            raise ValueError("Invalid cursor")
+        q = q.where(
+            or_(rank > after_rank, and_(rank == after_rank, Order.id < after_id))
+        )
+    q = q.order_by(rank, Order.id.desc()).limit(limit + 1)
+    rows = (await session.execute(q)).all()
+    orders = [order for order, _ in rows[:limit]]
+    next_cursor = None
+    if len(rows) > limit:
+        last, last_rank = rows[limit - 1]
+        next_cursor = f"{last_rank}:{last.id}"
+    return orders, next_cursor
+
+
+async def backfill(session: AsyncSession) -> int:
+    """Fill the search columns of orders written before they existed."""
+    filled = 0
+    while True:
+        result = await session.execute(
+            select(Order.id, Order.order_name, Order.customer_phone)
+            .where(or_(Order.order_number == None, Order.phone_digits == None))
+            .limit(BACKFILL_BATCH)
+        )
+        rows = [
+            {
+                "id": order_id,
+                "order_number": digits(name),
+                "phone_digits": digits(phone),
+            }
+            for order_id, name, phone in result
+        ]
+        if not rows:
+            return filled
+        await session.execute(update(Order), rows)
+        await session.commit()
+        filled += len(rows)
@@ -1,16 +1,31 @@
 import os
 import json
+import time
+import datetime as dt
 import base64
+import asyncio
 import tempfile
+import threading
 import gspread
 from typing import Optional, Dict, List, Any
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Seconds between background refreshes of the fallback order sheet snapshot
+SNAPSHOT_REFRESH_INTERVAL = float(os.getenv("SHEET_REFRESH_INTERVAL", "60"))
+# A snapshot older than this is reloaded on lookup (no refresher running)
+SNAPSHOT_MAX_AGE = SNAPSHOT_REFRESH_INTERVAL * 2
+# Cached worksheets are re-read in full at least this often to pick up edits
+FULL_REREAD_SECONDS = float(os.getenv("SHEET_FULL_REREAD_SECONDS", "3600"))
 
-def _get_gspread_client() -> Optional[Any]:
-    """Return a gspread client using either base64 credentials or a file."""
+
+# Refresh the OAuth token when it expires within this many seconds
+TOKEN_REFRESH_MARGIN = 300
+
+
+def _build_gspread_client() -> Optional[Any]:
+    """Authenticate with either base64 credentials or a credentials file."""
     creds_b64 = os.getenv("GOOGLE_CREDENTIALS_B64")
     creds_file = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
     if creds_b64:
@@ -20,7 +35,7 @@ def _get_gspread_client() -> Optional[Any]:
             try:
                 return gspread.service_account_from_dict(info)
             except Exception:
-                with tempfile.NamedTemporaryFile(delete=False, mode="w") as tmp:
+                with tempfile.NamedTemporaryFile(mode="w", suffix=".json") as tmp:
                     tmp.write(decoded)
                     tmp.flush()
                     return gspread.service_account(filename=tmp.name)
@@ -34,79 +49,317 @@ def _get_gspread_client() -> Optional[Any]:
     return None
 
 
-def get_order_from_sheet(order_name: str) -> Optional[Dict[str, str]]:
-    """Lookup order details in the Google Sheet."""
-    sheet_id = os.getenv("SHEET_ID")
-    gc = _get_gspread_client()
-    if not gc or not sheet_id:
-        logger.warning("Missing Google credentials or sheet ID")
-        return None
-    try:
-        sh = gc.open_by_key(sheet_id)
-        ws = sh.sheet1
-        rows = ws.get_all_values()
-    except Exception as e:
-        logger.exception("Error reading Google Sheet: %s", e)
-        return None
-    logger.info("Fetched %d rows from sheet", len(rows))
-    if not rows:
-        return None
-    header = [h.strip().lower() for h in rows[0]]
-    def find_idx(names):
-        for idx, h in enumerate(header):
-            norm = h.replace(" ", "")
-            for name in names:
-                if norm == name.replace(" ", ""):
-                    return idx
-            if any(n in norm for n in names):
+class SheetsClientProvider:
+    """Process-wide gspread client and cached spreadsheet handles.
+
+    The service account is authorized once and the same authorized session
+    (and its HTTP connection pool) is reused for every sheet call. Opened
+    ``Spreadsheet`` and first ``Worksheet`` handles are cached per sheet ID
+    so lookups skip the metadata request; :meth:`invalidate` drops them after
+    an error.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._client: Optional[Any] = None
+        self._creds_key: Optional[tuple] = None
+        self._spreadsheets: Dict[str, Any] = {}
+        self._worksheets: Dict[str, Any] = {}
+
+    def client(self) -> Optional[Any]:
+        key = (os.getenv("GOOGLE_CREDENTIALS_B64"), os.getenv("GOOGLE_APPLICATION_CREDENTIALS"))
+        with self._lock:
+            if self._client is None or key != self._creds_key:
+                self._client = _build_gspread_client()
+                self._creds_key = key
+                self._spreadsheets.clear()
+                self._worksheets.clear()
+            return self._client
+
+    def spreadsheet(self, sheet_id: str) -> Optional[Any]:
+        gc = self.client()
+        if not gc:
+            return None
+        with self._lock:
+            sh = self._spreadsheets.get(sheet_id)
+        if sh is None:
+            sh = gc.open_by_key(sheet_id)
+            with self._lock:
+                self._spreadsheets[sheet_id] = sh
+        return sh
+
+    def worksheet(self, sheet_id: str) -> Optional[Any]:
+        with self._lock:
+            ws = self._worksheets.get(sheet_id)
+        if ws is None:
+            sh = self.spreadsheet(sheet_id)
+            if sh is None:
+                return None
+            ws = sh.sheet1
+            with self._lock:
+                self._worksheets[sheet_id] = ws
+        return ws
+
+    def invalidate(self, sheet_id: Optional[str] = None) -> None:
+        with self._lock:
+            if sheet_id is None:
+                self._spreadsheets.clear()
+                self._worksheets.clear()
+            else:
+                self._spreadsheets.pop(sheet_id, None)
+                self._worksheets.pop(sheet_id, None)
+
+    def refresh_token(self, margin: float = TOKEN_REFRESH_MARGIN) -> None:
+        """Refresh the access token ahead of expiry, off the request path."""
+        http = getattr(self._client, "http_client", None)
+        creds = getattr(http, "auth", None)
+        if creds is None:
+            return
+        expiry = getattr(creds, "expiry", None)
+        if expiry is None or (expiry - dt.datetime.utcnow()).total_seconds() < margin:
+            try:
+                http.login()
+            except Exception:
+                logger.exception("Google token refresh failed")
+
+
+sheets = SheetsClientProvider()
+
+
+def _get_gspread_client() -> Optional[Any]:
+    """Return the shared gspread client (authenticating on first use)."""
+    return sheets.client()
+
+
+def _trim(row: List[str]) -> List[str]:
+    """Drop trailing empty cells so padded and unpadded reads compare equal."""
+    end = len(row)
+    while end and not row[end - 1]:
+        end -= 1
+    return list(row[:end])
+
+
+def _col_letter(n: int) -> str:
+    letters = ""
+    while n > 0:
+        n, rem = divmod(n - 1, 26)
+        letters = chr(65 + rem) + letters
+    return letters
+
+
+class IncrementalSheetReader:
+    """Cached rows of one worksheet, topped up with only the appended rows.
+
+    The first read downloads the whole worksheet. Later reads fetch the
+    header and the range starting at the last known row in one
+    ``batch_get``; if the header changed or that last row no longer matches
+    (rows were deleted or edited) the worksheet is re-read in full and
+    ``generation`` is bumped so consumers rebuild instead of appending.
+    A full re-read is also forced every ``FULL_REREAD_SECONDS``.
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.rows: List[List[str]] = []
+        self.generation = 0
+        self._width = 26
+        self._full_read_at: Optional[float] = None
+
+    def _full_read(self, ws: Any) -> None:
+        self.rows = [_trim(r) for r in ws.get_all_values()]
+        self._width = max([26] + [len(r) for r in self.rows])
+        self.generation += 1
+        self._full_read_at = time.monotonic()
+        logger.info("Fetched %d rows from sheet", len(self.rows))
+
+    def read(self, ws: Any) -> tuple:
+        """Return ``(rows, generation)`` after fetching any new rows."""
+        with self._lock:
+            stale = (
+                self._full_read_at is None
+                or time.monotonic() - self._full_read_at > FULL_REREAD_SECONDS
+            )
+            if not self.rows or stale:
+                self._full_read(ws)
+                return self.rows, self.generation
+            n = len(self.rows)
+            header, tail = ws.batch_get(["1:1", f"A{n}:{_col_letter(self._width)}"])
+            header = _trim(header[0]) if header else []
+            tail = [_trim(r) for r in tail]
+            if header != self.rows[0] or not tail or tail[0] != self.rows[-1]:
+                self._full_read(ws)
+            elif len(tail) > 1:
+                new_rows = tail[1:]
+                self.rows = self.rows + new_rows
+                self._width = max([self._width] + [len(r) for r in new_rows])
+                logger.info("Fetched %d new rows from sheet", len(new_rows))
+            return self.rows, self.generation
+
+
+_readers: Dict[str, IncrementalSheetReader] = {}
+_readers_lock = threading.Lock()
+
+
+def _read_rows(sheet_id: str) -> tuple:
+    """Return ``(rows, generation)`` for ``sheet_id`` via its incremental reader."""
+    with _readers_lock:
+        reader = _readers.setdefault(sheet_id, IncrementalSheetReader())
+    return reader.read(sheets.worksheet(sheet_id))
+
+
+def _find_idx(header: List[str], names: List[str]) -> Optional[int]:
+    for idx, h in enumerate(header):
+        norm = h.replace(" ", "")
+        for name in names:
+            if norm == name.replace(" ", ""):
                 return idx
-        return None
-    order_idx = find_idx(["ordername", "ordernumber"])
-    name_idx = find_idx(["customername", "name"])
-    phone_idx = find_idx(["customerphone", "phone", "telephone"])
-    address_idx = find_idx(["address", "customeraddress"])
-    if order_idx is None:
-        return None
-    query_clean = order_name.lstrip("#").strip()
-    for row in rows[1:]:
-        if len(row) <= order_idx:
-            continue
-        row_value = row[order_idx].lstrip("#").strip()
-        if row_value == query_clean:
-            def get_cell(idx):
-                return row[idx].strip() if idx is not None and idx < len(row) else ""
-            return {
-                "customer_name": get_cell(name_idx),
-                "customer_phone": get_cell(phone_idx),
-                "address": get_cell(address_idx),
-            }
+        if any(n in norm for n in names):
+            return idx
     return None
 
 
-def load_sheet_orders() -> List[Dict[str, str]]:
-    """Return all orders from the verification Google Sheet."""
-    sheet_id = os.getenv("VERIFICATION_SHEET_ID") or os.getenv("SHEET_ID")
-    gc = _get_gspread_client()
-    if not gc or not sheet_id:
-        logger.warning("Missing Google credentials or sheet ID")
-        return []
-    try:
-        sh = gc.open_by_key(sheet_id)
-        ws = sh.sheet1
-        rows = ws.get_all_values()
-    except Exception as e:
-        logger.exception("Error reading Google Sheet: %s", e)
-        return []
-    logger.info("Fetched %d rows from sheet", len(rows))
-    if not rows:
-        return []
-    header = [h.strip().lower() for h in rows[0]]
+def _normalize_order(value: str) -> str:
+    return value.lstrip("#").strip()
+
+
+class SheetSnapshot:
+    """Process-wide in-memory copy of the order sheet indexed by order number.
+
+    ``refresh`` fetches the rows appended since the last refresh and adds
+    them to the index, rebuilding it only when the sheet was re-read in
+    full. It skips the fetch when the spreadsheet reports the same revision
+    as last time. Lookups are plain dict reads.
+    """
+
+    def __init__(self) -> None:
+        self._index: Dict[str, Dict[str, str]] = {}
+        self._lock = threading.Lock()
+        self._generation: Optional[int] = None
+        self._consumed = 0
+        self._columns: Dict[str, Optional[int]] = {}
+        self.loaded_at: Optional[float] = None
+        self.revision: Optional[str] = None
+
+    @property
+    def age(self) -> Optional[float]:
+        """Seconds since the last successful refresh (``None`` if never)."""
+        if self.loaded_at is None:
+            return None
+        return time.monotonic() - self.loaded_at
+
+    @property
+    def size(self) -> int:
+        return len(self._index)
+
+    def stats(self) -> Dict[str, Any]:
+        age = self.age
+        return {
+            "size": self.size,
+            "ageSeconds": round(age, 1) if age is not None else None,
+            "revision": self.revision,
+        }
+
+    def refresh(self) -> bool:
+        """Bring the snapshot up to date. Return ``True`` on success."""
+        sheet_id = os.getenv("SHEET_ID")
+        gc = _get_gspread_client()
+        if not gc or not sheet_id:
+            logger.warning("Missing Google credentials or sheet ID")
+            return False
+        with self._lock:
+            try:
+                sheets.refresh_token()
+                sh = sheets.spreadsheet(sheet_id)
+                try:
+                    revision = str(sh.get_lastUpdateTime())
+                except Exception:
+                    revision = None
+                if revision and revision == self.revision and self.loaded_at is not None:
+                    self.loaded_at = time.monotonic()
+                    return True
+                rows, generation = _read_rows(sheet_id)
+            except Exception as e:
+                sheets.invalidate(sheet_id)
+                logger.exception("Error reading Google Sheet: %s", e)
+                return False
+            if generation != self._generation:
+                self._index = {}
+                self._consumed = 1
+                self._columns = self._header_columns(rows[0] if rows else [])
+                self._generation = generation
+            self._index_rows(rows[self._consumed:])
+            self._consumed = max(len(rows), 1)
+            self.revision = revision
+            self.loaded_at = time.monotonic()
+            return True
+
+    @staticmethod
+    def _header_columns(header_row: List[str]) -> Dict[str, Optional[int]]:
+        header = [h.strip().lower() for h in header_row]
+        return {
+            "order": _find_idx(header, ["ordername", "ordernumber"]),
+            "name": _find_idx(header, ["customername", "name"]),
+            "phone": _find_idx(header, ["customerphone", "phone", "telephone"]),
+            "address": _find_idx(header, ["address", "customeraddress"]),
+        }
+
+    def _index_rows(self, rows: List[List[str]]) -> None:
+        order_idx = self._columns.get("order")
+        if order_idx is None:
+            return
+        for row in rows:
+            if len(row) <= order_idx:
+                continue
+            def get_cell(key):
+                idx = self._columns[key]
+                return row[idx].strip() if idx is not None and idx < len(row) else ""
+            self._index.setdefault(
+                _normalize_order(row[order_idx]),
+                {
+                    "customer_name": get_cell("name"),
+                    "customer_phone": get_cell("phone"),
+                    "address": get_cell("address"),
+                },
+            )
+
+    def lookup(self, order_name: str) -> Optional[Dict[str, str]]:
+        row = self._index.get(_normalize_order(order_name))
+        return dict(row) if row else None
+
+
+snapshot = SheetSnapshot()
+
+
+def get_order_from_sheet(order_name: str) -> Optional[Dict[str, str]]:
+    """Lookup order details in the in-memory snapshot of the Google Sheet.
+
+    The snapshot is normally kept warm by :func:`run_snapshot_refresher`;
+    when it is missing or stale (no refresher running) it is reloaded here.
+    """
+    age = snapshot.age
+    if age is None or age > SNAPSHOT_MAX_AGE:
+        snapshot.refresh()
+    return snapshot.lookup(order_name)
+
+
+async def run_snapshot_refresher(interval: float = SNAPSHOT_REFRESH_INTERVAL) -> None:
+    """Refresh the sheet snapshot in the background every ``interval`` seconds."""
+    while True:
+        try:
+            await asyncio.to_thread(snapshot.refresh)
+        except Exception:
+            logger.exception("Sheet snapshot refresh failed")
+        await asyncio.sleep(interval)
+
+
+def _order_columns(header_row: List[str]) -> Dict[str, Optional[int]]:
+    header = [h.strip().lower() for h in header_row]
     def idx(name:str):
         for i,h in enumerate(header):
             if name in h.replace(" ",""):
                 return i
         return None
-    indices = {
+    return {
         "date": idx("date"),
         "order": idx("order"),
         "name": idx("customer"),
@@ -115,8 +368,11 @@ def load_sheet_orders() -> List[Dict[str, str]]:
         "city": idx("city"),
         "cod": idx("cod"),
     }
+
+
+def _parse_orders(rows: List[List[str]], indices: Dict[str, Optional[int]]) -> List[Dict[str, str]]:
     orders = []
-    for row in rows[1:]:
+    for row in rows:
         order = {}
         if indices["order"] is None or len(row) <= indices["order"]:
             continue
@@ -133,3 +389,42 @@ def load_sheet_orders() -> List[Dict[str, str]]:
         order["cod_total"] = row[indices["cod"]].strip() if indices["cod"] is not None and len(row)>indices["cod"] else ""
         orders.append(order)
     return orders
+
+
+# Parsed verification orders per sheet: generation, rows consumed, columns, orders
+_parsed_orders: Dict[str, Dict[str, Any]] = {}
+_parsed_lock = threading.Lock()
+
+
+def load_sheet_orders() -> List[Dict[str, str]]:
+    """Return all orders from the verification Google Sheet.
+
+    Only rows appended since the previous call are fetched and parsed.
+    """
+    sheet_id = os.getenv("VERIFICATION_SHEET_ID") or os.getenv("SHEET_ID")
+    gc = _get_gspread_client()
+    if not gc or not sheet_id:
+        logger.warning("Missing Google credentials or sheet ID")
+        return []
+    try:
+        sheets.refresh_token()
+        rows, generation = _read_rows(sheet_id)
+    except Exception as e:
+        sheets.invalidate(sheet_id)
+        logger.exception("Error reading Google Sheet: %s", e)
+        return []
+    if not rows:
+        return []
+    with _parsed_lock:
+        cache = _parsed_orders.get(sheet_id)
+        if not cache or cache["generation"] != generation:
+            cache = {
+                "generation": generation,
+                "consumed": 1,
+                "indices": _order_columns(rows[0]),
+                "orders": [],
+            }
+            _parsed_orders[sheet_id] = cache
+        cache["orders"].extend(_parse_orders(rows[cache["consumed"]:], cache["indices"]))
+        cache["consumed"] = len(rows)
+        return list(cache["orders"])
@@ -0,0 +1,259 @@
+import asyncio
+import base64
+import datetime as dt
+import hashlib
+import hmac
+import logging
+from datetime import timezone
+from typing import Optional
+
+import httpx
+from sqlalchemy import select, func, or_
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import ShopifyOrder
+
+logger = logging.getLogger(__name__)
+
+API_VERSION = "2023-07"
+# Orders older than this are treated as a different order re-using the
+# same number and ignored by the scan lookup.
+ORDER_WINDOW_DAYS = 50
+
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    """Return the shared Shopify HTTP client, creating it on first use.
+
+    The client keeps a pool of warm keep-alive connections so repeated scans
+    skip the TCP/TLS handshake with the Shopify stores.
+    """
+    global _client
+    if _client is None or _client.is_closed:
+        _client = httpx.AsyncClient(
+            timeout=10,
+            limits=httpx.Limits(
+                max_connections=20,
+                max_keepalive_connections=10,
+                keepalive_expiry=60,
+            ),
+        )
+    return _client
+
+
+async def open_client() -> None:
+    """Create the shared client when the application starts."""
+    get_client()
+
+
+async def close_client() -> None:
+    """Close the shared client and its pooled connections."""
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def get_order_from_store(order_name: str, store_cfg: dict) -> Optional[dict]:
+    auth = (store_cfg["api_key"], store_cfg["password"])
+    url = f"https://{store_cfg['domain']}/admin/api/{API_VERSION}/orders.json"
+    params = {"name": order_name}
+    client = get_client()
+    try:
+        r = await client.get(url, auth=auth, params=params)
+        r.raise_for_status()
+    except httpx.HTTPError:
+        return None
+    data = r.json()
+    return data.get("orders", [{}])[0] if data.get("orders") else None
+
+
+def parse_created_at(order: dict) -> dt.datetime:
+    return dt.datetime.fromisoformat(order["created_at"].replace("Z", "+00:00"))
+
+
+def _parse_ts(val: Optional[str]) -> Optional[dt.datetime]:
+    """Parse a Shopify ISO timestamp into a naive UTC datetime."""
+    if not val:
+        return None
+    ts = dt.datetime.fromisoformat(val.replace("Z", "+00:00"))
+    if ts.tzinfo:
+        ts = ts.astimezone(timezone.utc).replace(tzinfo=None)
+    return ts
+
+
+def order_fields(order: dict) -> dict:
+    """Extract the fields the scan needs from a Shopify order payload."""
+    customer_name = phone = address = ""
+    sa = order.get("shipping_address")
+    if sa:
+        customer_name = sa.get("name", "") or ""
+        phone = sa.get("phone", "") or order.get("phone", "") or ""
+        address = ", ".join(
+            filter(
+                None,
+                [sa.get("address1"), sa.get("address2"), sa.get("city"), sa.get("province")],
+            )
+        )
+    return {
+        "tags": order.get("tags", "") or "",
+        "fulfillment_status": order.get("fulfillment_status") or "unfulfilled",
+        "cancelled": bool(order.get("cancelled_at")),
+        "cod_total": float(order.get("total_outstanding") or order.get("total_price") or 0),
+        "customer_name": customer_name,
+        "customer_phone": phone,
+        "address": address,
+    }
+
+
+def mirror_fields(row: ShopifyOrder) -> dict:
+    """Return the same shape as :func:`order_fields` for a mirrored order."""
+    return {
+        "tags": row.tags or "",
+        "fulfillment_status": row.fulfillment_status or "unfulfilled",
+        "cancelled": row.cancelled_at is not None,
+        "cod_total": row.cod_total or 0.0,
+        "customer_name": row.customer_name or "",
+        "customer_phone": row.customer_phone or "",
+        "address": row.address or "",
+    }
+
+
+async def find_order(order_name: str, stores: list[dict]) -> tuple[Optional[dict], str]:
+    """Query every store concurrently and return the newest in-window match.
+
+    Returns ``(order, store_name)`` or ``(None, "")`` when no store has a
+    recent order with that name.
+    """
+    results = await asyncio.gather(
+        *(get_order_from_store(order_name, store) for store in stores),
+        return_exceptions=True,
+    )
+    window_start = dt.datetime.now(timezone.utc) - dt.timedelta(days=ORDER_WINDOW_DAYS)
+    chosen_order, chosen_store_name, chosen_created = None, "", None
+    for store, order in zip(stores, results):
+        if isinstance(order, BaseException):
+            logger.warning("Shopify lookup failed for %s: %s", store["name"], order)
+            continue
+        if not order:
+            continue
+        created_at = parse_created_at(order)
+        if created_at >= window_start and (
+            chosen_created is None or created_at > chosen_created
+        ):
+            chosen_order, chosen_store_name, chosen_created = order, store["name"], created_at
+    return chosen_order, chosen_store_name
+
+
+async def find_mirrored_order(
+    session: AsyncSession, order_name: str
+) -> Optional[ShopifyOrder]:
+    """Return the newest in-window mirrored order with ``order_name``."""
+    window_start = dt.datetime.utcnow() - dt.timedelta(days=ORDER_WINDOW_DAYS)
+    return await session.scalar(
+        select(ShopifyOrder)
+        .where(
+            ShopifyOrder.order_name == order_name,
+            ShopifyOrder.created_at >= window_start,
+        )
+        .order_by(ShopifyOrder.created_at.desc())
+        .limit(1)
+    )
+
+
+# ---------------------------------------------------------------------------
+# Webhooks
+# ---------------------------------------------------------------------------
+
+ORDER_TOPICS = ("orders/create", "orders/updated", "orders/cancelled", "orders/fulfilled")
+FULFILLMENT_TOPICS = ("fulfillments/create", "fulfillments/update")
+
+
+def verify_webhook(body: bytes, hmac_header: Optional[str], secret: str) -> bool:
+    """Check the ``X-Shopify-Hmac-Sha256`` header against the raw body."""
+    if not hmac_header or not secret:
+        return False
+    digest = hmac.new(secret.encode(), body, hashlib.sha256).digest()
+    expected = base64.b64encode(digest).decode()
+    return hmac.compare_digest(expected, hmac_header)
+
+
+def _dialect_insert(session: AsyncSession):
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert
+    return sqlite.insert
+
+
+async def upsert_order(session: AsyncSession, store_name: str, order: dict) -> ShopifyOrder:
+    """Insert or refresh the mirror row for a Shopify order payload.
+
+    Shopify retries deliveries and sends ``orders/create`` and
+    ``orders/updated`` for the same order concurrently, so this is a single
+    upsert on ``(store, shopify_id)``.  Payloads older than the stored
+    ``updated_at`` are ignored so webhooks delivered out of order cannot
+    roll the mirror back.
+    """
+    fields = order_fields(order)
+    values = {
+        "store": store_name,
+        "shopify_id": int(order["id"]),
+        "order_name": order.get("name"),
+        "created_at": _parse_ts(order.get("created_at")),
+        "updated_at": _parse_ts(order.get("updated_at")),
+        "cancelled_at": _parse_ts(order.get("cancelled_at")),
+        "tags": fields["tags"],
+        "fulfillment_status": fields["fulfillment_status"],
+        "cod_total": fields["cod_total"],
+        "customer_name": fields["customer_name"],
+        "customer_phone": fields["customer_phone"],
+        "address": fields["address"],
+    }
+    stmt = _dialect_insert(session)(ShopifyOrder).values(**values)
+    new = stmt.excluded
+    update = {
+        c: getattr(new, c)
+        for c in values
+        if c not in ("store", "shopify_id", "order_name", "created_at", "updated_at")
+    }
+    for c in ("order_name", "created_at", "updated_at"):
+        update[c] = func.coalesce(getattr(new, c), getattr(ShopifyOrder, c))
+    await session.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[ShopifyOrder.store, ShopifyOrder.shopify_id],
+            set_=update,
+            where=or_(
+                ShopifyOrder.updated_at == None,
+                new.updated_at == None,
+                new.updated_at >= ShopifyOrder.updated_at,
+            ),
+        )
+    )
+    return await session.scalar(
+        select(ShopifyOrder)
+        .where(
+            ShopifyOrder.store == store_name,
+            ShopifyOrder.shopify_id == values["shopify_id"],
+        )
+        .execution_options(populate_existing=True)
+    )
+
+
+async def apply_fulfillment(
+    session: AsyncSession, store_name: str, fulfillment: dict
+) -> Optional[ShopifyOrder]:
+    """Mark a mirrored order fulfilled when a fulfillment succeeds."""
+    order_id = fulfillment.get("order_id")
+    if not order_id:
+        return None
+    row = await session.scalar(
+        select(ShopifyOrder).where(
+            ShopifyOrder.store == store_name,
+            ShopifyOrder.shopify_id == int(order_id),
+        )
+    )
+    if row and fulfillment.get("status") == "success":
+        row.fulfillment_status = "fulfilled"
+        await session.flush()
+    return row
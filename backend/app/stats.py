@@ -0,0 +1,387 @@
+"""Delivery statistics served from the ``driver_daily_stats`` rollup.
+
+``/stats``, ``/admin/stats`` and ``/admin/trends`` used to tally the raw
+orders on every request.  Each order now contributes to one rollup row per
+driver and scan day, kept current by the handlers that write orders: they
+take a :func:`contribution` snapshot before changing an order and hand it
+to :func:`track` in the same transaction.  The endpoints sum rollup rows,
+so their cost follows days x drivers rather than the number of orders.
+
+:func:`rebuild` recomputes the rollup from ``orders`` for backfills and
+drift repair; run it from ``backend/`` with::
+
+    python -m app.stats rebuild [--start YYYY-MM-DD] [--end YYYY-MM-DD]
+
+A full rebuild records itself on the ``stats_rollup`` row of ``job_status``.
+:func:`init_db` builds the rollup before the app serves requests when that
+row is missing, e.g. right after upgrading, and :func:`track` writes nothing
+until it exists, so deltas are never applied to a rollup still missing the
+orders they correct.
+"""
+
+import datetime as dt
+from typing import Iterable, Optional
+
+from sqlalchemy import select, insert, delete, func, case, null
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from .models import Order, DriverDailyStats, JobStatus, Merchant, merchant_driver_table
+
+DELIVERED_STATUSES = ("Livré", "Paid")
+RETURN_STATUSES = ("Returned", "Annulé", "Refusé")
+
+COUNTERS = (
+    "scanned",
+    "delivered",
+    "returned",
+    "pending_returns",
+    "collect",
+    "fees",
+    "canceled_amount",
+)
+
+
+# job_status row marking that the rollup holds every order
+ROLLUP_MARKER = "stats_rollup"
+
+# Databases whose marker has been seen, so track() checks it only once
+_built: set[str] = set()
+
+
+def empty_stats() -> dict:
+    return format_stats(0, 0, 0, 0, 0.0, 0.0, 0.0)
+
+
+def format_stats(
+    total: int,
+    delivered: int,
+    returned: int,
+    pending_ret: int,
+    collect: float,
+    fees: float,
+    canceled_amount: float,
+) -> dict:
+    rate = (delivered / total * 100) if total else 0
+    return {
+        "totalOrders": total,
+        "delivered": delivered,
+        "returned": returned,
+        "pendingReturns": pending_ret,
+        "totalCollect": collect,
+        "totalFees": fees,
+        "deliveryRate": rate,
+        "canceledAmount": canceled_amount,
+    }
+
+
+def contribution(order: Order) -> Optional[tuple]:
+    """Return ``(driver_id, day, counters)`` the order adds to the rollup.
+
+    Orders without a driver or a scan date add nothing.
+    """
+    if not order.driver_id or not order.scan_date:
+        return None
+    status = order.delivery_status
+    cash = order.cash_amount or 0
+    fee = order.driver_fee or 0
+    delivered = status in DELIVERED_STATUSES
+    pending = status in RETURN_STATUSES and bool(order.return_pending)
+    returned = status in RETURN_STATUSES and not pending
+    counters = (
+        1,
+        int(delivered),
+        int(returned),
+        int(pending),
+        cash if delivered else 0.0,
+        fee if delivered else 0.0,
+        cash if returned else 0.0,
+    )
+    return order.driver_id, order.scan_date, counters
+
+
+def _dialect_insert(session: AsyncSession):
+    if session.get_bind().dialect.name == "postgresql":
+        return postgresql.insert
+    return sqlite.insert
+
+
+async def is_built(session: AsyncSession) -> bool:
+    """Whether a full :func:`rebuild` has filled the rollup."""
+    url = str(session.get_bind().url)
+    if url in _built:
+        return True
+    built = await session.scalar(
+        select(JobStatus.last_success_at).where(JobStatus.name == ROLLUP_MARKER)
+    )
+    if built is None:
+        return False
+    _built.add(url)
+    return True
+
+
+async def track(
+    session: AsyncSession,
+    before: Iterable[Optional[tuple]],
+    orders: Iterable[Order],
+) -> None:
+    """Move the rollup from the ``before`` snapshots to ``orders`` as they are now.
+
+    The difference is added to the affected rows with a single upsert, so
+    concurrent writers never overwrite each other's counts.  Nothing is
+    written before the rollup is built; the build counts these orders.
+    """
+    deltas: dict[tuple[str, dt.date], list] = {}
+
+    def add(snapshot, sign):
+        if snapshot is None:
+            return
+        driver_id, day, counters = snapshot
+        row = deltas.setdefault((driver_id, day), [0] * len(COUNTERS))
+        for i, value in enumerate(counters):
+            row[i] += sign * value
+
+    for snapshot in before:
+        add(snapshot, -1)
+    for order in orders:
+        add(contribution(order), 1)
+
+    rows = [
+        {"driver_id": driver_id, "day": day, **dict(zip(COUNTERS, values))}
+        for (driver_id, day), values in deltas.items()
+        if any(values)
+    ]
+    if not rows or not await is_built(session):
+        return
+    stmt = _dialect_insert(session)(DriverDailyStats).values(rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[DriverDailyStats.driver_id, DriverDailyStats.day],
+        set_={c: getattr(DriverDailyStats, c) + stmt.excluded[c] for c in COUNTERS},
+    )
+    await session.execute(stmt)
+
+
+def _day_range(q, column, start_date: Optional[dt.date], end_date: Optional[dt.date]):
+    if start_date:
+        q = q.where(column >= start_date)
+    if end_date:
+        q = q.where(column <= end_date)
+    return q
+
+
+async def load_stats(
+    session: AsyncSession,
+    start_date: Optional[dt.date] = None,
+    end_date: Optional[dt.date] = None,
+    driver_id: Optional[str] = None,
+) -> dict[str, dict]:
+    """Return the stats of every driver with orders in the scan date range.
+
+    Drivers without matching orders are left out; callers fill them in with
+    :func:`empty_stats`.
+    """
+    q = select(
+        DriverDailyStats.driver_id,
+        *(func.sum(getattr(DriverDailyStats, c)) for c in COUNTERS),
+    ).group_by(DriverDailyStats.driver_id)
+    if driver_id is not None:
+        q = q.where(DriverDailyStats.driver_id == driver_id)
+    q = _day_range(q, DriverDailyStats.day, start_date, end_date)
+
+    result = await session.execute(q)
+    return {
+        row[0]: format_stats(
+            row[1] or 0,
+            row[2] or 0,
+            row[3] or 0,
+            row[4] or 0,
+            float(row[5] or 0),
+            float(row[6] or 0),
+            float(row[7] or 0),
+        )
+        for row in result
+        if row[1]
+    }
+
+
+def _trend_query(by: Optional[str], start_date, end_date):
+    """One grouped query yielding ``(day, key, delivered)`` rows.
+
+    Merchant rows also carry the driver, so a driver working for several
+    merchants is only counted once in the day's total.
+    """
+    if by == "store":
+        q = (
+            select(Order.scan_date, Order.store, func.count())
+            .where(
+                Order.delivery_status.in_(DELIVERED_STATUSES),
+                Order.scan_date != None,
+            )
+            .group_by(Order.scan_date, Order.store)
+        )
+        return _day_range(q, Order.scan_date, start_date, end_date)
+
+    day = DriverDailyStats.day
+    delivered = func.sum(DriverDailyStats.delivered)
+    if by == "driver":
+        q = select(day, DriverDailyStats.driver_id, delivered).group_by(
+            day, DriverDailyStats.driver_id
+        )
+    elif by == "merchant":
+        q = (
+            select(day, Merchant.name, delivered, DriverDailyStats.driver_id)
+            .outerjoin(
+                merchant_driver_table,
+                merchant_driver_table.c.driver_id == DriverDailyStats.driver_id,
+            )
+            .outerjoin(Merchant, Merchant.id == merchant_driver_table.c.merchant_id)
+            .group_by(day, DriverDailyStats.driver_id, Merchant.name)
+        )
+    else:
+        q = select(day, null(), delivered).group_by(day)
+    return _day_range(q.where(DriverDailyStats.delivered > 0), day, start_date, end_date)
+
+
+async def load_trend(
+    session: AsyncSession,
+    start_date: Optional[dt.date],
+    end_date: dt.date,
+    by: Optional[str] = None,
+) -> list[dict]:
+    """Delivered orders per scan day, with a zero for days without any.
+
+    With ``by`` set to ``driver``, ``store`` or ``merchant`` every day also
+    gets a ``breakdown`` holding a count for each key seen in the range.
+    Without ``start_date`` the series begins at the first delivery.
+    """
+    result = await session.execute(_trend_query(by, start_date, end_date))
+    totals: dict[dt.date, int] = {}
+    counts: dict[tuple[dt.date, str], int] = {}
+    counted: set[tuple[dt.date, str]] = set()
+    keys: set[str] = set()
+    for row in result:
+        day, key, delivered = row[0], row[1], row[2] or 0
+        if by != "merchant" or (day, row[3]) not in counted:
+            totals[day] = totals.get(day, 0) + delivered
+        if by == "merchant":
+            counted.add((day, row[3]))
+        if by and key:
+            keys.add(key)
+            counts[(day, key)] = counts.get((day, key), 0) + delivered
+
+    if not totals and start_date is None:
+        return []
+    first = start_date or min(totals)
+    trend = []
+    for offset in range((end_date - first).days + 1):
+        day = first + dt.timedelta(days=offset)
+        entry = {"date": day.isoformat(), "delivered": totals.get(day, 0)}
+        if by:
+            entry["breakdown"] = {k: counts.get((day, k), 0) for k in sorted(keys)}
+        trend.append(entry)
+    return trend
+
+
+# ---------------------------------------------------------------------------
+# Rebuild
+# ---------------------------------------------------------------------------
+
+
+def _order_aggregates():
+    delivered = Order.delivery_status.in_(DELIVERED_STATUSES)
+    pending = Order.delivery_status.in_(RETURN_STATUSES) & (
+        func.coalesce(Order.return_pending, 0) != 0
+    )
+    returned = Order.delivery_status.in_(RETURN_STATUSES) & ~pending
+
+    def count(cond):
+        return func.sum(case((cond, 1), else_=0))
+
+    def total(cond, column):
+        return func.sum(case((cond, func.coalesce(column, 0)), else_=0))
+
+    return (
+        func.count(),
+        count(delivered),
+        count(returned),
+        count(pending),
+        total(delivered, Order.cash_amount),
+        total(delivered, Order.driver_fee),
+        total(returned, Order.cash_amount),
+    )
+
+
+async def rebuild(
+    session: AsyncSession,
+    start_date: Optional[dt.date] = None,
+    end_date: Optional[dt.date] = None,
+) -> int:
+    """Recompute the rollup rows of the scan date range from ``orders``.
+
+    Rows in the range are replaced in one transaction, which also records
+    a full rebuild on the marker row.  Returns the number of rollup rows
+    written.
+    """
+    await session.execute(
+        _day_range(delete(DriverDailyStats), DriverDailyStats.day, start_date, end_date)
+    )
+    source = _day_range(
+        select(Order.driver_id, Order.scan_date, *_order_aggregates())
+        .where(Order.driver_id != None, Order.scan_date != None)
+        .group_by(Order.driver_id, Order.scan_date),
+        Order.scan_date,
+        start_date,
+        end_date,
+    )
+    result = await session.execute(
+        insert(DriverDailyStats).from_select(
+            ["driver_id", "day", *COUNTERS], source
+        )
+    )
+    count = result.rowcount or 0
+    if start_date is None and end_date is None:
+        now = dt.datetime.utcnow()
+        marker = {"last_success_at": now, "last_status": "ok", "last_count": count}
+        stmt = _dialect_insert(session)(JobStatus).values(name=ROLLUP_MARKER, **marker)
+        await session.execute(
+            stmt.on_conflict_do_update(index_elements=[JobStatus.name], set_=marker)
+        )
+    await session.commit()
+    if start_date is None and end_date is None:
+        _built.add(str(session.get_bind().url))
+    return count
+
+
+async def backfill(session: AsyncSession) -> int:
+    """Build the rollup once if no full rebuild has been recorded yet."""
+    if await is_built(session):
+        return 0
+    try:
+        return await rebuild(session)
+    except IntegrityError:
+        # another worker built it at the same time
+        await session.rollback()
+        return 0
+
+
+async def _main(argv: Optional[list[str]] = None) -> None:
+    import argparse
+
+    from .db import AsyncSessionLocal
+
+    parser = argparse.ArgumentParser(prog="python -m app.stats")
+    parser.add_argument("command", choices=["rebuild"])
+    parser.add_argument("--start", type=dt.date.fromisoformat)
+    parser.add_argument("--end", type=dt.date.fromisoformat)
+    args = parser.parse_args(argv)
+
+    async with AsyncSessionLocal() as session:
+        count = await rebuild(session, args.start, args.end)
+    print(f"rebuilt {count} driver_daily_stats rows")
+
+
+if __name__ == "__main__":
+    import asyncio
+
+    asyncio.run(_main())
@@ -1,16 +1,19 @@
 import datetime as dt
-from typing import Optional
-import httpx
-from sqlalchemy import select
+from typing import Optional, Sequence
+from sqlalchemy import select, update, delete, func, case, and_, or_
 from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import aliased
 
 from .models import (
     Order,
+    OrderEvent,
     Payout,
+    PayoutItem,
     DeliveryNote,
     DeliveryNoteItem,
     VerificationOrder,
 )
+from . import events
 
 NORMAL_DELIVERY_FEE = 20
 EXCHANGE_DELIVERY_FEE = 10
@@ -52,7 +55,8 @@ def parse_timestamp(val: str) -> dt.datetime:
     return dt.datetime.fromisoformat(val)
 
 
-def serialize_order(order: Order) -> dict:
+def serialize_order(order: Order, log_events: Sequence = ()) -> dict:
+    """Serialize an order; ``log_events`` are its timeline rows, oldest first."""
     status = order.delivery_status or "Dispatched"
     pending = bool(order.return_pending) and status in ("Returned", "Annulé", "Refusé")
     display_status = "Pending Return" if pending else status
@@ -65,33 +69,19 @@ def serialize_order(order: Order) -> dict:
         "tags": order.tags,
         "deliveryStatus": display_status,
         "notes": order.notes,
-        "driverNotes": order.driver_notes,
+        "driverNotes": events.render_driver_notes(order.driver_notes, log_events),
         "scheduledTime": order.scheduled_time,
-        "scanDate": order.scan_date,
+        "scanDate": order.scan_date.isoformat() if order.scan_date else order.scan_date,
         "cashAmount": order.cash_amount or 0,
         "driverFee": order.driver_fee or 0,
         "payoutId": order.payout_id,
-        "statusLog": order.status_log,
+        "statusLog": events.render_status_log(order.status_log, log_events),
         "commLog": order.comm_log,
         "followLog": order.follow_log,
         "returnPending": pending,
     }
 
 
-async def get_order_from_store(order_name: str, store_cfg: dict) -> Optional[dict]:
-    auth = (store_cfg["api_key"], store_cfg["password"])
-    url = f"https://{store_cfg['domain']}/admin/api/2023-07/orders.json"
-    params = {"name": order_name}
-    async with httpx.AsyncClient(timeout=10) as client:
-        try:
-            r = await client.get(url, auth=auth, params=params)
-            r.raise_for_status()
-        except httpx.HTTPError:
-            return None
-    data = r.json()
-    return data.get("orders", [{}])[0] if data.get("orders") else None
-
-
 async def order_exists(session: AsyncSession, driver_id: str, order_name: str) -> bool:
     result = await session.scalar(
         select(Order).where(Order.driver_id == driver_id, Order.order_name == order_name)
@@ -118,6 +108,70 @@ async def get_open_delivery_note(session: AsyncSession, driver_id: str) -> Deliv
     return note
 
 
+NOTE_SUMMARY_STATUSES = {
+    "delivered": ("Livré", "Paid"),
+    "cancelled": ("Annulé", "Refusé"),
+    "returned": ("Returned",),
+}
+
+
+async def load_note_summaries(
+    session: AsyncSession,
+    driver_id: Optional[str] = None,
+    status: Optional[str] = None,
+    limit: Optional[int] = None,
+    before: Optional[int] = None,
+) -> list[dict]:
+    """Load delivery notes newest first with their parcel count, COD total
+    and status counts, all in one grouped join.
+
+    ``before`` is the id of the last note of the previous page.
+    """
+    counts = [
+        func.sum(case((Order.delivery_status.in_(statuses), 1), else_=0))
+        for statuses in NOTE_SUMMARY_STATUSES.values()
+    ]
+    q = (
+        select(DeliveryNote)
+        .outerjoin(DeliveryNoteItem, DeliveryNoteItem.note_id == DeliveryNote.id)
+        .outerjoin(Order, Order.id == DeliveryNoteItem.order_id)
+        .add_columns(func.count(Order.id), func.sum(Order.cash_amount), *counts)
+        .group_by(DeliveryNote.id)
+    )
+    if driver_id is not None:
+        q = q.where(DeliveryNote.driver_id == driver_id)
+    if status is not None:
+        q = q.where(DeliveryNote.status == status)
+    if before is not None:
+        anchor = await session.get(DeliveryNote, before)
+        if anchor is not None:
+            q = q.where(
+                or_(
+                    DeliveryNote.created_at < anchor.created_at,
+                    and_(
+                        DeliveryNote.created_at == anchor.created_at,
+                        DeliveryNote.id < anchor.id,
+                    ),
+                )
+            )
+    q = q.order_by(DeliveryNote.created_at.desc(), DeliveryNote.id.desc())
+    if limit:
+        q = q.limit(limit)
+
+    result = await session.execute(q)
+    return [
+        {
+            "note": note,
+            "parcels": parcels or 0,
+            "totalCod": total_cash or 0,
+            "summary": {
+                key: count or 0 for key, count in zip(NOTE_SUMMARY_STATUSES, status_counts)
+            },
+        }
+        for note, parcels, total_cash, *status_counts in result
+    ]
+
+
 async def update_verification_from_order(
     session: AsyncSession, order_name: str, driver_id: str, ts: dt.datetime
 ) -> None:
@@ -136,10 +190,113 @@ async def update_verification_from_order(
         await session.commit()
 
 
+def split_payout_orders(value: Optional[str]) -> list[str]:
+    return [o.strip() for o in (value or "").split(",") if o.strip()]
+
+
+async def refresh_payout_totals(session: AsyncSession, payout: Payout) -> None:
+    """Recompute a payout's totals from its items."""
+    cash, fees = (
+        await session.execute(
+            select(
+                func.coalesce(func.sum(PayoutItem.cash), 0),
+                func.coalesce(func.sum(PayoutItem.fee), 0),
+            ).where(PayoutItem.payout_id == payout.id)
+        )
+    ).one()
+    payout.total_cash = cash
+    payout.total_fees = fees
+    payout.total_payout = cash - fees
+
+
+async def _add_items_for_names(
+    session: AsyncSession, payout: Payout, names: list[str]
+) -> None:
+    """Add one item per order name, taking cash and fee from the order."""
+    if not names:
+        return
+    result = await session.execute(
+        select(Order.id, Order.order_name, Order.cash_amount, Order.driver_fee).where(
+            Order.driver_id == payout.driver_id, Order.order_name.in_(names)
+        )
+    )
+    by_name = {}
+    for row in result:
+        by_name.setdefault(row.order_name, row)
+    for name in names:
+        row = by_name.get(name)
+        session.add(
+            PayoutItem(
+                payout_id=payout.id,
+                order_id=row.id if row else None,
+                order_name=name,
+                cash=(row.cash_amount or 0) if row else 0,
+                fee=(row.driver_fee or 0) if row else 0,
+            )
+        )
+    await session.flush()
+
+
+async def migrate_payout_orders(session: AsyncSession, payout: Payout) -> None:
+    """Turn a payout's legacy comma string into items, once."""
+    if payout.orders is None:
+        return
+    await _add_items_for_names(session, payout, split_payout_orders(payout.orders))
+    payout.orders = None
+    await session.flush()
+
+
+async def set_payout_orders(session: AsyncSession, payout: Payout, orders: str) -> list[Order]:
+    """Replace a payout's items with the orders named in ``orders``.
+
+    ``Order.payout_id`` follows the items: orders added to the payout are
+    linked to it and orders dropped from it are unlinked.  Returns the
+    orders whose link changed.
+    """
+    await migrate_payout_orders(session, payout)
+    await session.execute(delete(PayoutItem).where(PayoutItem.payout_id == payout.id))
+    await _add_items_for_names(session, payout, split_payout_orders(orders))
+    await refresh_payout_totals(session, payout)
+
+    item_ids = select(PayoutItem.order_id).where(
+        PayoutItem.payout_id == payout.id, PayoutItem.order_id != None
+    )
+    result = await session.execute(
+        select(Order).where(
+            Order.driver_id == payout.driver_id,
+            or_(Order.payout_id == payout.payout_id, Order.id.in_(item_ids)),
+        )
+    )
+    linked = set((await session.execute(item_ids)).scalars())
+    changed = []
+    for order in result.scalars():
+        payout_id = payout.payout_id if order.id in linked else None
+        if order.payout_id != payout_id:
+            order.payout_id = payout_id
+            changed.append(order)
+    return changed
+
+
+async def migrate_payout_strings(session: AsyncSession) -> int:
+    """Convert every payout still holding a legacy ``orders`` string."""
+    migrated = 0
+    while True:
+        result = await session.execute(
+            select(Payout).where(Payout.orders != None).order_by(Payout.id).limit(100)
+        )
+        payouts = result.scalars().all()
+        if not payouts:
+            return migrated
+        for payout in payouts:
+            await migrate_payout_orders(session, payout)
+        await session.commit()
+        migrated += len(payouts)
+
+
 async def add_to_payout(
     session: AsyncSession,
     driver_id: str,
-    order_name: str,
+    order: Order,
     cash_amount: float,
     driver_fee: float,
 ) -> str:
@@ -149,75 +306,150 @@ async def add_to_payout(
         .order_by(Payout.date_created.desc())
     )
     if not payout:
-        payout_id = f"PO-{dt.datetime.now().strftime('%Y%m%d-%H%M')}"
         payout = Payout(
             driver_id=driver_id,
-            payout_id=payout_id,
-            orders=order_name,
-            total_cash=cash_amount,
-            total_fees=driver_fee,
-            total_payout=cash_amount - driver_fee,
+            payout_id=f"PO-{dt.datetime.now().strftime('%Y%m%d-%H%M')}",
             status="pending",
         )
         session.add(payout)
+        await session.flush()
     else:
-        orders_list = [o.strip() for o in (payout.orders or "").split(",") if o.strip()]
-        orders_list.append(order_name)
-        payout.orders = ", ".join(orders_list)
-        payout.total_cash = (payout.total_cash or 0) + cash_amount
-        payout.total_fees = (payout.total_fees or 0) + driver_fee
-        payout.total_payout = payout.total_cash - payout.total_fees
-        payout_id = payout.payout_id
-
+        await migrate_payout_orders(session, payout)
+
+    session.add(
+        PayoutItem(
+            payout_id=payout.id,
+            order_id=order.id,
+            order_name=order.order_name,
+            cash=cash_amount,
+            fee=driver_fee,
+        )
+    )
     await session.flush()
-    return payout_id
+    await refresh_payout_totals(session, payout)
+    await session.flush()
+    return payout.payout_id
 
 
 async def remove_from_payout(
     session: AsyncSession,
     payout_id: str,
-    order_name: str,
-    cash_amount: float,
-    driver_fee: float,
+    order: Order,
 ) -> None:
-    payout = await session.scalar(select(Payout).where(Payout.payout_id == payout_id))
+    payout = await session.scalar(
+        select(Payout).where(Payout.driver_id == order.driver_id, Payout.payout_id == payout_id)
+    )
     if not payout:
         return
-
-    orders_list = [o.strip() for o in (payout.orders or "").split(",") if o.strip()]
-    if order_name not in orders_list:
+    await migrate_payout_orders(session, payout)
+
+    item = await session.scalar(
+        select(PayoutItem)
+        .where(
+            PayoutItem.payout_id == payout.id,
+            or_(
+                PayoutItem.order_id == order.id,
+                and_(PayoutItem.order_id == None, PayoutItem.order_name == order.order_name),
+            ),
+        )
+        .limit(1)
+    )
+    if not item:
         return
 
-    orders_list.remove(order_name)
-    payout.orders = ", ".join(orders_list)
-    payout.total_cash = (payout.total_cash or 0) - cash_amount
-    payout.total_fees = (payout.total_fees or 0) - driver_fee
-    payout.total_payout = payout.total_cash - payout.total_fees
-
+    await session.delete(item)
+    await session.flush()
+    await refresh_payout_totals(session, payout)
     await session.flush()
 
 
-async def sync_order_paid_status(session: AsyncSession, order: Order) -> None:
-    if order.delivery_status == "Paid":
-        return
-
-    payout = None
-    if order.payout_id:
-        payout = await session.scalar(select(Payout).where(Payout.payout_id == order.payout_id))
-    if not payout:
-        payout = await session.scalar(
-            select(Payout)
-            .where(
-                Payout.status == "paid",
-                Payout.driver_id == order.driver_id,
-                Payout.orders.ilike(f"%{order.order_name}%"),
-            )
+def unsynced_paid_orders(limit: int):
+    """Select orders whose payout is paid while their status is not Paid.
+
+    An order follows the driver's payout named by ``Order.payout_id`` when
+    that payout exists, else any paid payout of the driver holding its
+    ``payout_items`` row.  Payout ids only have minute resolution, so both
+    matches are on the driver too and each yields one row per order.
+    Orders that were Paid before were moved out of it on purpose and are
+    left alone.  Rows carry the order fields the stats rollup needs plus
+    ``paid_payout_id``.
+    """
+    linked = (
+        select(
+            Payout.driver_id,
+            Payout.payout_id,
+            func.max(case((Payout.status == "paid", 1), else_=0)).label("paid"),
+        )
+        .group_by(Payout.driver_id, Payout.payout_id)
+        .subquery()
+    )
+    item_order = aliased(Order)
+    item_payout = (
+        select(PayoutItem.order_id, func.min(Payout.payout_id).label("payout_id"))
+        .join(Payout, Payout.id == PayoutItem.payout_id)
+        .join(item_order, item_order.id == PayoutItem.order_id)
+        .where(Payout.status == "paid", Payout.driver_id == item_order.driver_id)
+        .group_by(PayoutItem.order_id)
+        .subquery()
+    )
+    was_paid = (
+        select(OrderEvent.id)
+        .where(
+            OrderEvent.order_id == Order.id,
+            OrderEvent.kind == events.STATUS,
+            OrderEvent.status == "Paid",
+        )
+        .exists()
+    )
+    return (
+        select(
+            Order.id,
+            Order.driver_id,
+            Order.scan_date,
+            Order.delivery_status,
+            Order.return_pending,
+            Order.cash_amount,
+            Order.driver_fee,
+            case((linked.c.payout_id != None, Order.payout_id), else_=item_payout.c.payout_id).label(
+                "paid_payout_id"
+            ),
+        )
+        .outerjoin(
+            linked,
+            and_(linked.c.payout_id == Order.payout_id, linked.c.driver_id == Order.driver_id),
         )
-        if payout:
-            order.payout_id = order.payout_id or payout.payout_id
+        .outerjoin(item_payout, item_payout.c.order_id == Order.id)
+        .where(
+            or_(Order.delivery_status != "Paid", Order.delivery_status == None),
+            or_(
+                linked.c.paid == 1,
+                and_(linked.c.payout_id == None, item_payout.c.payout_id != None),
+            ),
+            ~was_paid,
+            # logs not yet moved to order_events
+            or_(Order.status_log == None, ~Order.status_log.contains("Paid @")),
+        )
+        .order_by(Order.id)
+        .limit(limit)
+    )
 
-    if payout and payout.status == "paid":
-        order.delivery_status = "Paid"
-        ts = dt.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        order.status_log = ((order.status_log or "") + f" | Paid @ {ts}").strip(" |")
-        await session.flush()
+
+async def backfill_order_payout_ids(session: AsyncSession) -> int:
+    """Point ``Order.payout_id`` at the payout holding the order's item."""
+    latest = (
+        select(Payout.payout_id)
+        .join(PayoutItem, PayoutItem.payout_id == Payout.id)
+        .where(PayoutItem.order_id == Order.id)
+        .order_by(Payout.id.desc())
+        .limit(1)
+        .scalar_subquery()
+    )
+    has_item = select(PayoutItem.id).where(PayoutItem.order_id == Order.id).exists()
+    result = await session.execute(
+        update(Order)
+        .where(Order.payout_id == None, has_item)
+        .values(payout_id=latest)
+        .execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return result.rowcount or 0
@@ -0,0 +1,88 @@
+"""Time ``sync_verification_orders`` against a synthetic 10k-row sheet.
+
+Usage (from ``backend/``)::
+
+    python benchmarks/bench_verification_sync.py [rows]
+
+Runs on a throw-away SQLite file unless ``DATABASE_URL`` is set. A third of
+the sheet rows already exist in ``verification_orders`` without a driver and
+half of them have a matching scanned order, so the run exercises inserts,
+driver back-fills and the scan lookup.
+"""
+
+import os
+import sys
+import time
+import asyncio
+import datetime as dt
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+_tmp = None
+if not os.getenv("DATABASE_URL"):
+    _tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+    _tmp.close()
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{_tmp.name}"
+
+from app import main as app_main  # noqa: E402
+from app.db import AsyncSessionLocal  # noqa: E402
+from app.models import Order, VerificationOrder  # noqa: E402
+
+DAY = "2024-01-01"
+
+
+def make_rows(n: int) -> list[dict]:
+    return [
+        {
+            "order_name": f"#{100000 + i}",
+            "order_date": DAY,
+            "customer_name": f"Customer {i}",
+            "customer_phone": f"06{i:08d}",
+            "address": f"{i} Main street",
+            "city": "Casablanca",
+            "cod_total": "199",
+        }
+        for i in range(n)
+    ]
+
+
+async def seed(rows: list[dict]) -> None:
+    async with AsyncSessionLocal() as session:
+        now = dt.datetime.utcnow()
+        for i, row in enumerate(rows):
+            if i % 3 == 0:
+                session.add(
+                    VerificationOrder(order_date=DAY, order_name=row["order_name"])
+                )
+            if i % 2 == 0:
+                session.add(
+                    Order(
+                        driver_id="anouar",
+                        order_name=row["order_name"],
+                        timestamp=now,
+                        delivery_status="Dispatched",
+                    )
+                )
+        await session.commit()
+
+
+async def main(n: int) -> None:
+    await app_main.init_db()
+    rows = make_rows(n)
+    await seed(rows)
+    app_main.load_sheet_orders = lambda: rows
+
+    async with AsyncSessionLocal() as session:
+        start = time.perf_counter()
+        created = await app_main.sync_verification_orders(DAY, session)
+        elapsed = time.perf_counter() - start
+    print(f"rows={n} created={created} elapsed={elapsed:.3f}s")
+
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 10_000))
+    finally:
+        if _tmp:
+            os.remove(_tmp.name)
@@ -0,0 +1,47 @@
+import os, asyncio, sys
+import pytest
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+DB_FILE = 'fixtures_test.db'
+
+
+@pytest.fixture
+def app_env():
+    """``(app_main, app_db, app_models, client)`` with the schema created.
+
+    Older test modules point ``DATABASE_URL`` at their own file when they are
+    imported; tests using this fixture share whichever database is set.
+    """
+    if 'DATABASE_URL' not in os.environ:
+        if os.path.exists(DB_FILE):
+            os.remove(DB_FILE)
+        os.environ['DATABASE_URL'] = f'sqlite+aiosqlite:///{DB_FILE}'
+    from app import main as app_main
+    from app import db as app_db
+    from app import models as app_models
+    client = TestClient(app_main.app)
+    asyncio.run(app_main.init_db())
+    return app_main, app_db, app_models, client
+
+
+@pytest.fixture
+def count_queries(monkeypatch):
+    """Call to start recording the statements run through ``AsyncSession.execute``.
+
+    Returns the list the statements are appended to.
+    """
+    def start():
+        queries = []
+        original = AsyncSession.execute
+
+        async def counting_execute(self, stmt, *args, **kwargs):
+            queries.append(stmt)
+            return await original(self, stmt, *args, **kwargs)
+
+        monkeypatch.setattr(AsyncSession, 'execute', counting_execute)
+        return queries
+    return start
@@ -0,0 +1,85 @@
+import os, asyncio, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+
+def seed(app_main, app_db, app_models):
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, 'etag'):
+                session.add(app_models.Driver(id='etag'))
+            if not await session.scalar(
+                app_main.select(app_models.Order).where(app_models.Order.driver_id == 'etag')
+            ):
+                session.add(app_models.Order(driver_id='etag', order_name='#E1', delivery_status='Dispatched'))
+            await session.commit()
+    asyncio.run(inner())
+
+
+def test_unchanged_lists_answer_304_without_queries(app_env, count_queries):
+    app_main, app_db, app_models, client = app_env
+    seed(app_main, app_db, app_models)
+    urls = [
+        '/orders?driver=etag',
+        '/orders/archive?driver=etag',
+        '/orders/all?driver=etag',
+        '/orders/followups?driver=etag',
+        '/payouts?driver=etag',
+        '/notes?driver=etag',
+        '/notes?driver=etag&history=true',
+    ]
+    tags = {}
+    for url in urls:
+        resp = client.get(url)
+        assert resp.status_code == 200
+        assert resp.headers['cache-control'] == 'no-cache'
+        tags[url] = resp.headers['etag']
+    assert len(set(tags.values())) == len(urls)
+
+    queries = count_queries()
+
+    for url in urls:
+        resp = client.get(url, headers={'If-None-Match': tags[url]})
+        assert resp.status_code == 304
+        assert resp.content == b''
+        assert resp.headers['etag'] == tags[url]
+    assert queries == []
+
+    # other tags in the header, weak or not, still match
+    resp = client.get(urls[0], headers={'If-None-Match': f'"stale", W/{tags[urls[0]]}'})
+    assert resp.status_code == 304
+
+    # a write for the driver changes every tag
+    resp = client.put('/order/status?driver=etag', json={'order_name': '#E1', 'new_status': 'En cours'})
+    assert resp.status_code == 200
+    for url in urls:
+        resp = client.get(url, headers={'If-None-Match': tags[url]})
+        assert resp.status_code == 200
+        assert resp.headers['etag'] != tags[url]
+
+
+def test_book_loaded_during_a_write_is_not_cached_as_current(monkeypatch, app_env):
+    app_main, app_db, app_models, client = app_env
+    seed(app_main, app_db, app_models)
+    original = app_main.orderbook.load_order_book
+    raced = []
+
+    async def load_then_write(session, driver):
+        book = await original(session, driver)
+        if not raced:
+            # a scan commits and bumps the version before the book is cached
+            raced.append(1)
+            async with app_db.AsyncSessionLocal() as other:
+                other.add(app_models.Order(driver_id='etag', order_name='#E2', delivery_status='Dispatched'))
+                await other.commit()
+            await app_main.invalidate_driver('etag')
+        return book
+
+    monkeypatch.setattr(app_main.orderbook, 'load_order_book', load_then_write)
+    client.put('/order/status?driver=etag', json={'order_name': '#E1', 'new_status': 'Dispatched'})
+
+    stale = client.get('/orders/all?driver=etag')
+    assert '#E2' not in [o['orderName'] for o in stale.json()]
+    fresh = client.get('/orders/all?driver=etag', headers={'If-None-Match': stale.headers['etag']})
+    assert fresh.status_code == 200
+    assert '#E2' in [o['orderName'] for o in fresh.json()]
@@ -0,0 +1,75 @@
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+if os.path.exists("test.db"):
+    os.remove("test.db")
+
+os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///test.db"
+
+from app import main as app_main
+from app import jobs
+
+
+def test_single_runner_lease_and_status():
+    asyncio.run(app_main.init_db())
+    runs = []
+
+    async def job(session):
+        runs.append(1)
+        return 7
+
+    async def failing(session):
+        raise RuntimeError("sheet down")
+
+    async def scenario():
+        first = await jobs.run_job("lease_test", job, 60)
+        # A second worker ticking inside the lease must skip the run
+        second = await jobs.run_job("lease_test", job, 60)
+        await jobs.run_job("failing_test", failing, 60)
+        return first, second, await jobs.job_statuses()
+
+    first, second, statuses = asyncio.run(scenario())
+    assert (first, second) == (True, False)
+    assert runs == [1]
+    by_name = {s["name"]: s for s in statuses}
+    assert by_name["lease_test"]["status"] == "ok"
+    assert by_name["lease_test"]["count"] == 7
+    assert by_name["lease_test"]["lastSuccessAt"]
+    assert by_name["failing_test"]["status"] == "error"
+    assert "sheet down" in by_name["failing_test"]["message"]
+
+
+def test_lease_expires():
+    asyncio.run(app_main.init_db())
+
+    async def job(session):
+        return 0
+
+    async def scenario():
+        await jobs.run_job("expiry_test", job, 0)
+        return await jobs.run_job("expiry_test", job, 0)
+
+    assert asyncio.run(scenario()) is True
+
+
+def test_lease_renewed_while_running_then_released():
+    asyncio.run(app_main.init_db())
+
+    async def slow(session):
+        await asyncio.sleep(0.6)
+        return 1
+
+    async def scenario():
+        # the lease (0.27s) is far shorter than the run
+        first = asyncio.create_task(jobs.run_job("slow_test", slow, 0.3))
+        await asyncio.sleep(0.4)
+        overlapping = await jobs.run_job("slow_test", slow, 0.3)
+        ran = await first
+        # finished runs past their lease free it for the next tick
+        after = await jobs.run_job("slow_test", slow, 0.3)
+        return ran, overlapping, after
+
+    assert asyncio.run(scenario()) == (True, False, True)
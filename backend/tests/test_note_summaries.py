@@ -0,0 +1,70 @@
+import os, asyncio, sys
+import datetime as dt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+
+def seed(app_db, app_models):
+    statuses = [
+        ['Livré', 'Paid', 'Annulé'],
+        ['Returned', 'Refusé'],
+        ['Livré'],
+    ]
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, 'ns'):
+                session.add(app_models.Driver(id='ns'))
+            start = dt.datetime(2024, 1, 1)
+            ids = []
+            for i, note_statuses in enumerate(statuses):
+                note = app_models.DeliveryNote(
+                    driver_id='ns', status='approved', created_at=start + dt.timedelta(days=i)
+                )
+                session.add(note)
+                await session.flush()
+                ids.append(note.id)
+                for j, status in enumerate(note_statuses):
+                    order = app_models.Order(
+                        driver_id='ns', order_name=f'#N{i}{j}', delivery_status=status, cash_amount=10
+                    )
+                    session.add(order)
+                    await session.flush()
+                    session.add(app_models.DeliveryNoteItem(note_id=note.id, order_id=order.id))
+            # an empty draft note
+            session.add(app_models.DeliveryNote(driver_id='ns', status='draft'))
+            await session.commit()
+            return ids
+    return asyncio.run(inner())
+
+
+def test_note_history_is_one_grouped_query(app_env, count_queries):
+    app_main, app_db, app_models, client = app_env
+    ids = seed(app_db, app_models)
+
+    queries = count_queries()
+
+    notes = client.get('/notes?driver=ns&history=true').json()
+    assert [n['id'] for n in notes] == list(reversed(ids))
+    assert [(n['parcels'], n['totalCod']) for n in notes] == [(1, 10), (2, 20), (3, 30)]
+    assert notes[2]['summary'] == {'delivered': 2, 'cancelled': 1, 'returned': 0}
+    assert notes[1]['summary'] == {'delivered': 0, 'cancelled': 1, 'returned': 1}
+    assert len(queries) == 1
+
+    draft = client.get('/notes?driver=ns').json()
+    assert [(n['status'], n['parcels'], n['totalCod']) for n in draft] == [('draft', 0, 0)]
+
+
+def test_note_history_pages_with_before(app_env):
+    app_main, app_db, app_models, client = app_env
+
+    first = client.get('/notes?driver=ns&history=true&limit=2').json()
+    assert len(first) == 2
+    rest = client.get(f"/notes?driver=ns&history=true&limit=2&before={first[-1]['id']}").json()
+    assert len(rest) == 1 and rest[0]['parcels'] == 3
+
+    admin = client.get('/admin/notes?driver=ns&limit=2').json()
+    assert [n['status'] for n in admin] == ['draft', 'approved']
+    older = client.get(f"/admin/notes?driver=ns&limit=2&before={admin[-1]['id']}").json()
+    assert [len(n['items']) for n in older] == [2, 3]
+    assert older[1]['summary'] == {'delivered': 2, 'cancelled': 1, 'returned': 0}
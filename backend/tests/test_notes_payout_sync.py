@@ -35,6 +35,20 @@ def setup_records(app_main, app_db, app_models):
             await session.commit()
     asyncio.run(inner())
 
+def run_backfill(app_main, app_db):
+    # legacy payouts only list order names; the backfill job links them
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            await app_main.migrate_payout_strings(session)
+            await app_main.backfill_order_payout_ids(session)
+    asyncio.run(inner())
+
+def run_reconcile(app_main, app_db):
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            return await app_main.paid_reconcile_job(session)
+    return asyncio.run(inner())
+
 def get_order_status(app_db, app_models):
     async def inner():
         async with app_db.AsyncSessionLocal() as session:
@@ -42,11 +56,129 @@ def get_order_status(app_db, app_models):
             return o.delivery_status
     return asyncio.run(inner())
 
-def test_notes_sync_sets_paid():
+def test_reconcile_job_sets_paid():
     app_main, app_db, app_models, client = setup_app()
     setup_records(app_main, app_db, app_models)
+    run_backfill(app_main, app_db)
+    # listing notes is a pure read
     resp = client.get('/admin/notes?driver=d1')
     assert resp.status_code == 200
-    data = resp.json()
+    assert resp.json()[0]['items'][0]['status'] == 'Livré'
+    assert get_order_status(app_db, app_models) == 'Livré'
+
+    assert run_reconcile(app_main, app_db) == 1
+    data = client.get('/admin/notes?driver=d1').json()
     assert data and data[0]['items'][0]['status'] == 'Paid'
     assert get_order_status(app_db, app_models) == 'Paid'
+    timeline = client.get('/orders/%231/timeline?driver=d1').json()['events']
+    assert (timeline[-1]['status'], timeline[-1]['actor']) == ('Paid', 'system')
+    assert run_reconcile(app_main, app_db) == 0
+
+def test_reconcile_matches_exact_order():
+    app_main, app_db, app_models, client = setup_app()
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, 'd2'):
+                session.add(app_models.Driver(id='d2'))
+            short = app_models.Order(driver_id='d2', order_name='#12', delivery_status='Livré')
+            long = app_models.Order(driver_id='d2', order_name='#123', delivery_status='Livré')
+            session.add_all([short, long])
+            await session.flush()
+            note = app_models.DeliveryNote(driver_id='d2', status='approved')
+            session.add(note)
+            await session.flush()
+            session.add_all([
+                app_models.DeliveryNoteItem(note_id=note.id, order_id=short.id),
+                app_models.DeliveryNoteItem(note_id=note.id, order_id=long.id),
+            ])
+            payout = app_models.Payout(driver_id='d2', payout_id='PO-2', status='paid')
+            session.add(payout)
+            await session.flush()
+            session.add(app_models.PayoutItem(payout_id=payout.id, order_id=long.id, order_name='#123'))
+            await session.commit()
+    asyncio.run(inner())
+
+    run_reconcile(app_main, app_db)
+    items = client.get('/admin/notes?driver=d2').json()[0]['items']
+    assert {i['orderName']: i['status'] for i in items} == {'#12': 'Livré', '#123': 'Paid'}
+
+    async def payout_ids():
+        async with app_db.AsyncSessionLocal() as session:
+            rows = await session.execute(
+                select(app_models.Order.order_name, app_models.Order.payout_id)
+                .where(app_models.Order.driver_id == 'd2')
+            )
+            return dict(rows.all())
+    assert asyncio.run(payout_ids()) == {'#12': None, '#123': 'PO-2'}
+
+def rollup(app_main, app_db, app_models, driver):
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            M = app_models.DriverDailyStats
+            rows = await session.execute(
+                select(*(getattr(M, c) for c in app_main.stats.COUNTERS)).where(M.driver_id == driver)
+            )
+            return [tuple(r) for r in rows]
+    return asyncio.run(inner())
+
+def test_reconcile_keeps_drivers_sharing_a_payout_id_apart():
+    app_main, app_db, app_models, client = setup_app()
+    import datetime as dt
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            for d in ('s1', 's2', 's3'):
+                if not await session.get(app_models.Driver, d):
+                    session.add(app_models.Driver(id=d))
+            await session.flush()
+            day = dt.date(2024, 6, 1)
+            session.add_all([
+                app_models.Order(driver_id='s1', order_name='#S1', delivery_status='Returned',
+                                 return_pending=0, cash_amount=100, scan_date=day, payout_id='PO-X'),
+                app_models.Order(driver_id='s3', order_name='#S3', delivery_status='Livré',
+                                 cash_amount=80, scan_date=day, payout_id='PO-X'),
+                # payout ids only have minute resolution
+                app_models.Payout(driver_id='s1', payout_id='PO-X', status='paid'),
+                app_models.Payout(driver_id='s2', payout_id='PO-X', status='paid'),
+                app_models.Payout(driver_id='s3', payout_id='PO-X', status='pending'),
+            ])
+            await session.commit()
+            await app_main.stats.rebuild(session, day, day)
+    asyncio.run(inner())
+
+    assert run_reconcile(app_main, app_db) == 1
+    timeline = client.get('/orders/%23S1/timeline?driver=s1').json()['events']
+    assert [e['status'] for e in timeline] == ['Paid']
+    # s3's payout is still pending
+    assert client.get('/orders/all?driver=s3').json()[0]['deliveryStatus'] == 'Livré'
+
+    tracked = rollup(app_main, app_db, app_models, 's1')
+
+    async def rebuild():
+        async with app_db.AsyncSessionLocal() as session:
+            await app_main.stats.rebuild(session)
+    asyncio.run(rebuild())
+    assert tracked == rollup(app_main, app_db, app_models, 's1')
+    assert tracked == [(1, 1, 0, 0, 100.0, 0.0, 0.0)]
+
+def test_reconcile_leaves_orders_moved_out_of_paid():
+    app_main, app_db, app_models, client = setup_app()
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, 'm1'):
+                session.add(app_models.Driver(id='m1'))
+            session.add_all([
+                app_models.Order(driver_id='m1', order_name='#M1', delivery_status='Livré', payout_id='PO-M'),
+                app_models.Payout(driver_id='m1', payout_id='PO-M', status='paid'),
+            ])
+            await session.commit()
+    asyncio.run(inner())
+
+    assert run_reconcile(app_main, app_db) == 1
+    # an agent takes the order back out of Paid on purpose
+    resp = client.put('/order/status?driver=m1', json={'order_name': '#M1', 'new_status': 'Returned'})
+    assert resp.status_code == 200
+    assert run_reconcile(app_main, app_db) == 0
+    assert client.get('/orders/all?driver=m1').json()[0]['deliveryStatus'] != 'Paid'
@@ -0,0 +1,100 @@
+import os, asyncio, sys
+import datetime as dt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import select
+
+
+def add_order(app_db, app_models, driver, name, **fields):
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, driver):
+                session.add(app_models.Driver(id=driver))
+            session.add(app_models.Order(driver_id=driver, order_name=name, **fields))
+            await session.commit()
+    asyncio.run(inner())
+
+
+def test_updates_write_events_not_log_strings(app_env):
+    app_main, app_db, app_models, client = app_env
+    add_order(app_db, app_models, 'ev', '#T1', delivery_status='Dispatched')
+
+    client.put('/order/status?driver=ev', json={'order_name': '#T1', 'new_status': 'En cours'})
+    client.put('/order/status?driver=ev', json={'order_name': '#T1', 'driver_note': 'call later'})
+    client.put('/order/status?driver=ev', json={'order_name': '#T1', 'new_status': 'Returned'})
+    client.post('/order/accept-return?driver=ev', json={'order_name': '#T1'}, cookies={'agent': 'sara'})
+
+    async def stored():
+        async with app_db.AsyncSessionLocal() as session:
+            order = await session.scalar(select(app_models.Order).where(app_models.Order.order_name == '#T1'))
+            return order.status_log, order.driver_notes, order.follow_log
+    status_log, driver_notes, follow_log = asyncio.run(stored())
+    assert (status_log, driver_notes) == (None, None)
+    assert follow_log.endswith(' - Return accepted by sara\n')
+
+    order = client.get('/orders/all?driver=ev').json()[0]
+    entries = [e.split(' @ ')[0] for e in order['statusLog'].split(' | ')]
+    assert entries == ['En cours', 'Returned', 'return accepted sara']
+    assert order['driverNotes'].endswith(' - call later\n')
+    assert order['followLog'] == follow_log
+
+    page = client.get('/orders/%23T1/timeline?driver=ev').json()
+    assert [(e['kind'], e['status'] or e['text']) for e in page['events']] == [
+        ('status', 'En cours'),
+        ('driver_note', 'call later'),
+        ('status', 'Returned'),
+        ('return_accepted', None),
+    ]
+    assert page['events'][-1]['actor'] == 'sara'
+    assert page['nextBefore'] is None
+
+
+def test_timeline_pages_backwards(app_env):
+    app_main, app_db, app_models, client = app_env
+    add_order(app_db, app_models, 'ev2', '#T2', delivery_status='Dispatched')
+    for i in range(5):
+        client.put('/order/status?driver=ev2', json={'order_name': '#T2', 'driver_note': f'n{i}'})
+
+    page = client.get('/orders/%23T2/timeline?driver=ev2&limit=2').json()
+    assert [e['text'] for e in page['events']] == ['n3', 'n4']
+    page = client.get(f"/orders/%23T2/timeline?driver=ev2&limit=2&before={page['nextBefore']}").json()
+    assert [e['text'] for e in page['events']] == ['n1', 'n2']
+    page = client.get(f"/orders/%23T2/timeline?driver=ev2&limit=2&before={page['nextBefore']}").json()
+    assert [e['text'] for e in page['events']] == ['n0']
+    assert page['nextBefore'] is None
+
+    assert client.get('/orders/%23NOPE/timeline?driver=ev2').status_code == 404
+
+
+def test_legacy_log_strings_are_migrated(app_env):
+    app_main, app_db, app_models, client = app_env
+    add_order(
+        app_db, app_models, 'ev3', '#T3',
+        delivery_status='Livré',
+        timestamp=dt.datetime(2024, 1, 1, 9, 0),
+        status_log='En cours @ 2024-01-01 10:00:00 | Livré @ 2024-01-01 12:30:00',
+        driver_notes='2024-01-01 11:00 - at the door\n',
+    )
+    before = client.get('/orders/all?driver=ev3').json()[0]
+
+    async def run():
+        async with app_db.AsyncSessionLocal() as session:
+            migrated = await app_main.events.migrate_legacy_logs(session)
+        async with app_db.AsyncSessionLocal() as session:
+            again = await app_main.events.migrate_legacy_logs(session)
+        return migrated, again
+    migrated, again = asyncio.run(run())
+    assert migrated >= 1 and again == 0
+
+    asyncio.run(app_main.invalidate_driver('ev3'))
+    after = client.get('/orders/all?driver=ev3').json()[0]
+    assert after['statusLog'] == before['statusLog']
+    assert after['driverNotes'] == before['driverNotes']
+
+    page = client.get('/orders/%23T3/timeline?driver=ev3').json()
+    assert [(e['kind'], e['ts']) for e in page['events']] == [
+        ('status', '2024-01-01 10:00:00'),
+        ('driver_note', '2024-01-01 11:00:00'),
+        ('status', '2024-01-01 12:30:00'),
+    ]
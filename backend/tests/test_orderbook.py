@@ -0,0 +1,162 @@
+import os, asyncio, sys
+import datetime as dt
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+
+def seed(app_db, app_models):
+    now = dt.datetime.utcnow()
+    soon = (dt.datetime.now() + dt.timedelta(minutes=30)).strftime("%Y-%m-%d %H:%M:%S")
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, 'book'):
+                session.add(app_models.Driver(id='book'))
+            M = app_models.Order
+            session.add_all([
+                M(driver_id='book', order_name='#A1', delivery_status='Dispatched', timestamp=now - dt.timedelta(hours=1)),
+                M(driver_id='book', order_name='#A2', delivery_status='En cours', timestamp=now - dt.timedelta(hours=2), scheduled_time=soon),
+                M(driver_id='book', order_name='#A3', delivery_status='Dispatched', timestamp=now - dt.timedelta(hours=12)),
+                M(driver_id='book', order_name='#L1', delivery_status='Livré', timestamp=now - dt.timedelta(hours=3)),
+                M(driver_id='book', order_name='#R1', delivery_status='Returned', return_pending=1, timestamp=now - dt.timedelta(hours=4)),
+                M(driver_id='book', order_name='#R2', delivery_status='Refusé', return_pending=0, timestamp=now - dt.timedelta(minutes=90)),
+                M(driver_id='book', order_name='#D1', delivery_status='Deleted', timestamp=now),
+            ])
+            # held in a pending note, hidden from every view
+            held = M(driver_id='book', order_name='#P1', delivery_status='Dispatched', timestamp=now)
+            session.add(held)
+            await session.flush()
+            note = app_models.DeliveryNote(driver_id='book', status='draft')
+            session.add(note)
+            await session.flush()
+            session.add(app_models.DeliveryNoteItem(note_id=note.id, order_id=held.id))
+            await session.commit()
+    asyncio.run(inner())
+
+
+def names(resp):
+    assert resp.status_code == 200
+    return [o['orderName'] for o in resp.json()]
+
+
+def test_views_share_one_order_book_query(app_env, count_queries):
+    app_main, app_db, app_models, client = app_env
+    seed(app_db, app_models)
+    asyncio.run(app_main.cache_delete('orderbook', 'book'))
+
+    queries = count_queries()
+
+    active = client.get('/orders?driver=book')
+    assert names(active) == ['#A3', '#R1', '#R2', '#A1', '#A2']
+    assert [o['urgent'] for o in active.json()] == [False, False, False, False, True]
+    assert names(client.get('/orders/archive?driver=book')) == ['#R2', '#L1']
+    assert sorted(names(client.get('/orders/all?driver=book'))) == ['#A1', '#A2', '#A3', '#L1', '#R1', '#R2']
+    # three views, one book load: the projected orders plus their events
+    assert len(queries) == 2
+
+    # follow-ups are their own filtered query
+    followups = client.get('/orders/followups?driver=book').json()
+    assert [o['orderName'] for o in followups] == ['#A3']
+    assert followups[0]['urgent'] is False
+
+    # a status change invalidates the shared book for every view
+    resp = client.put('/order/status?driver=book', json={'order_name': '#A1', 'new_status': 'Pas de réponse 3'})
+    assert resp.status_code == 200
+    followups = names(client.get('/orders/followups?driver=book'))
+    assert sorted(followups) == ['#A1', '#A3']
+
+
+def test_changes_return_only_rows_written_since_version(app_env):
+    app_main, app_db, app_models, client = app_env
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, 'delta'):
+                session.add(app_models.Driver(id='delta'))
+            await session.flush()
+            shown = app_models.Order(driver_id='delta', order_name='#C1', delivery_status='Dispatched')
+            held = app_models.Order(driver_id='delta', order_name='#C2', delivery_status='Dispatched')
+            session.add_all([shown, held])
+            await app_main.orderbook.mark_changed(session, 'delta', shown, held)
+            await session.flush()
+            note = app_models.DeliveryNote(driver_id='delta', status='draft')
+            session.add(note)
+            await session.flush()
+            session.add(app_models.DeliveryNoteItem(note_id=note.id, order_id=held.id))
+            await session.commit()
+            return note.id
+    note_id = asyncio.run(inner())
+
+    snap = client.get('/orders/changes?driver=delta&since=0').json()
+    assert snap['full'] is True
+    assert [o['orderName'] for o in snap['orders']] == ['#C1']
+    v0 = snap['version']
+
+    assert client.get(f'/orders/changes?driver=delta&since={v0}').json() == {
+        'version': v0, 'full': False, 'orders': [], 'removed': [],
+    }
+
+    client.put('/order/status?driver=delta', json={'order_name': '#C1', 'new_status': 'En cours'})
+    delta = client.get(f'/orders/changes?driver=delta&since={v0}').json()
+    assert delta['version'] == v0 + 1
+    assert [(o['orderName'], o['deliveryStatus']) for o in delta['orders']] == [('#C1', 'En cours')]
+
+    assert client.post(f'/notes/{note_id}/approve?driver=delta').status_code == 200
+    delta = client.get(f"/orders/changes?driver=delta&since={delta['version']}").json()
+    assert [o['orderName'] for o in delta['orders']] == ['#C2']
+
+    client.put('/order/status?driver=delta', json={'order_name': '#C1', 'new_status': 'Deleted'})
+    delta = client.get(f"/orders/changes?driver=delta&since={delta['version']}").json()
+    assert delta['orders'] == [] and delta['removed'] == ['#C1']
+
+    # a version the server never issued falls back to a snapshot
+    snap = client.get('/orders/changes?driver=delta&since=999999').json()
+    assert snap['full'] is True
+    assert [o['orderName'] for o in snap['orders']] == ['#C2']
+
+
+def test_followups_use_status_and_schedule_columns(app_env):
+    app_main, app_db, app_models, client = app_env
+    old = dt.datetime.utcnow() - dt.timedelta(days=2)
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, 'fu'):
+                session.add(app_models.Driver(id='fu'))
+            M = app_models.Order
+            session.add_all([
+                # scanned long ago but updated since: not stale
+                M(driver_id='fu', order_name='#F1', delivery_status='En cours', timestamp=old),
+                # legacy row, no columns yet: stale once backfilled too
+                M(driver_id='fu', order_name='#F2', delivery_status='Dispatched', timestamp=old,
+                  scheduled_time='2000-01-01T10:00'),
+                M(driver_id='fu', order_name='#F3', delivery_status='Dispatched'),
+            ])
+            await session.commit()
+    asyncio.run(inner())
+
+    client.put('/order/status?driver=fu', json={'order_name': '#F1', 'new_status': 'Pas de réponse 1'})
+    assert names(client.get('/orders/followups?driver=fu')) == ['#F2']
+
+    async def backfill():
+        async with app_db.AsyncSessionLocal() as session:
+            await app_main.orderbook.backfill_followup_columns(session)
+        async with app_db.AsyncSessionLocal() as session:
+            rows = (await session.execute(
+                app_main.select(app_models.Order.order_name, app_models.Order.last_status_at, app_models.Order.scheduled_at)
+                .where(app_models.Order.driver_id == 'fu')
+                .order_by(app_models.Order.order_name)
+            )).all()
+            again = await app_main.orderbook.backfill_followup_columns(session)
+        return rows, again
+    rows, again = asyncio.run(backfill())
+    assert all(r.last_status_at is not None for r in rows)
+    assert rows[1].scheduled_at == dt.datetime(2000, 1, 1, 10, 0)
+    assert again == 0
+
+    followups = client.get('/orders/followups?driver=fu').json()
+    assert [(o['orderName'], o['urgent']) for o in followups] == [('#F2', True)]
+
+    # scheduling in the past through the API makes it overdue right away
+    client.put('/order/status?driver=fu', json={'order_name': '#F3', 'scheduled_time': '2000-01-02 09:00:00'})
+    assert sorted(names(client.get('/orders/followups?driver=fu'))) == ['#F2', '#F3']
@@ -0,0 +1,74 @@
+import os, asyncio, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import select
+
+
+def add_orders(app_db, app_models, driver, *specs):
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, driver):
+                session.add(app_models.Driver(id=driver))
+            for name, cash in specs:
+                session.add(app_models.Order(driver_id=driver, order_name=name, delivery_status='Dispatched', cash_amount=cash, tags=''))
+            await session.commit()
+    asyncio.run(inner())
+
+
+def test_delivered_orders_become_payout_items(app_env, count_queries):
+    app_main, app_db, app_models, client = app_env
+    add_orders(app_db, app_models, 'pi', *[(f'#P{i}', 100 + i) for i in range(5)])
+    for i in range(5):
+        client.put('/order/status?driver=pi', json={'order_name': f'#P{i}', 'new_status': 'Livré'})
+    client.put('/order/status?driver=pi', json={'order_name': '#P4', 'new_status': 'Returned'})
+
+    queries = count_queries()
+    payouts = client.get('/payouts?driver=pi').json()
+    assert len(queries) == 1
+
+    assert len(payouts) == 1
+    p = payouts[0]
+    assert p['orders'] == '#P0, #P1, #P2, #P3'
+    assert [d['name'] for d in p['orderDetails']] == ['#P0', '#P1', '#P2', '#P3']
+    assert p['totalCash'] == 100 + 101 + 102 + 103
+    assert p['totalFees'] == 80
+    assert p['totalPayout'] == p['totalCash'] - 80
+
+
+def test_legacy_strings_and_manual_edits_use_items(app_env):
+    app_main, app_db, app_models, client = app_env
+    add_orders(app_db, app_models, 'pl', ('#L1', 50), ('#L2', 70), ('#L3', 30))
+
+    async def legacy():
+        async with app_db.AsyncSessionLocal() as session:
+            for name in ('#L1', '#L2'):
+                o = await session.scalar(select(app_models.Order).where(app_models.Order.order_name == name))
+                o.driver_fee = 20
+                o.payout_id = 'PO-L'
+            session.add(app_models.Payout(driver_id='pl', payout_id='PO-L', orders='#L1, #L2, #GONE', total_cash=120, total_fees=40, total_payout=80, status='pending'))
+            await session.commit()
+        async with app_db.AsyncSessionLocal() as session:
+            return await app_main.migrate_payout_strings(session)
+    assert asyncio.run(legacy()) >= 1
+
+    p = client.get('/payouts?driver=pl').json()[0]
+    assert p['orders'] == '#L1, #L2, #GONE'
+    assert [(d['name'], d['cashAmount']) for d in p['orderDetails']] == [('#L1', 50), ('#L2', 70), ('#GONE', 0)]
+    # migration keeps the stored totals
+    assert (p['totalCash'], p['totalFees']) == (120, 40)
+
+    # editing the order list rebuilds the items and the totals
+    resp = client.put('/payout/PO-L?driver=pl', json={'orders': '#L2, #L3'})
+    assert resp.status_code == 200
+    p = client.get('/payouts?driver=pl').json()[0]
+    assert p['orders'] == '#L2, #L3'
+    assert (p['totalCash'], p['totalFees'], p['totalPayout']) == (100, 20, 80)
+    # and moves the orders' payout links with them
+    links = {o['orderName']: o['payoutId'] for o in client.get('/orders/all?driver=pl').json()}
+    assert links == {'#L1': None, '#L2': 'PO-L', '#L3': 'PO-L'}
+
+    # a payout emptied by an edit lists no orders rather than null
+    client.put('/payout/PO-L?driver=pl', json={'orders': ''})
+    p = client.get('/payouts?driver=pl').json()[0]
+    assert (p['orders'], p['orderDetails']) == ('', [])
@@ -30,7 +30,7 @@ async def setup_records(app_main, app_db, app_models):
 def get_order_status(app_main, app_db, app_models):
     async def inner():
         async with app_db.AsyncSessionLocal() as session:
-            o = await session.scalar(select(app_models.Order).where(app_models.Order.order_name=='#1'))
+            o = await session.scalar(select(app_models.Order).where(app_models.Order.driver_id=='abder', app_models.Order.order_name=='#1'))
             return o.delivery_status
     return asyncio.run(inner())
 
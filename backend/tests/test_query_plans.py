@@ -0,0 +1,87 @@
+import os, asyncio, sys
+import datetime as dt
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import select, text
+from sqlalchemy.dialects import sqlite
+
+
+def query_plan(app_db, stmt) -> str:
+    compiled = stmt.compile(
+        dialect=sqlite.dialect(paramstyle='named'),
+        compile_kwargs={'render_postcompile': True},
+    )
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            result = await session.execute(
+                text('EXPLAIN QUERY PLAN ' + compiled.string), compiled.params
+            )
+            return '\n'.join(row[-1] for row in result)
+    return asyncio.run(inner())
+
+
+def test_order_access_paths_use_composite_indexes(app_env):
+    app_main, app_db, app_models, client = app_env
+    if not app_db.engine.url.drivername.startswith('sqlite'):
+        pytest.skip('query plans are checked on SQLite')
+    Order = app_models.Order
+    Item = app_models.DeliveryNoteItem
+
+    plans = {
+        'uq_orders_driver_order_name': select(Order).where(
+            Order.driver_id == 'd1', Order.order_name == '#1'
+        ),
+        'ix_orders_driver_scan_date': select(Order.id).where(
+            Order.driver_id == 'd1',
+            Order.scan_date >= dt.date(2024, 1, 1),
+            Order.scan_date <= dt.date(2024, 1, 31),
+        ),
+        'ix_orders_driver_status': select(Order.id).where(
+            Order.driver_id == 'd1', Order.delivery_status == 'Livré'
+        ),
+        'ix_delivery_note_items_order_note': select(Item.note_id).where(
+            Item.order_id.in_([1, 2, 3])
+        ),
+    }
+    for index, stmt in plans.items():
+        plan = query_plan(app_db, stmt)
+        assert index in plan, plan
+        assert 'SCAN' not in plan, plan
+
+
+def test_text_dates_that_cannot_convert_are_set_aside(app_env):
+    app_main, app_db, app_models, client = app_env
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    async def inner():
+        engine = create_async_engine('sqlite+aiosqlite://')
+        async with engine.begin() as conn:
+            await conn.execute(text('CREATE TABLE orders (id INTEGER, scan_date VARCHAR)'))
+            await conn.execute(text('CREATE TABLE driver_daily_stats (driver_id VARCHAR, day VARCHAR)'))
+            await conn.execute(text('CREATE TABLE job_status (name VARCHAR)'))
+            await conn.execute(text(
+                "INSERT INTO orders VALUES (1, '2024-03-01'), (2, '01/03/2024'), (3, ''), (4, NULL)"))
+            await conn.execute(text(
+                "INSERT INTO driver_daily_stats VALUES ('d1', '2024-03-01'), ('d1', 'bad')"))
+            await conn.execute(text("INSERT INTO job_status VALUES ('stats_rollup')"))
+
+            await app_db._set_aside_bad_dates(conn, 'orders', 'scan_date')
+            await app_db._set_aside_bad_dates(conn, 'driver_daily_stats', 'day')
+
+            orders = (await conn.execute(text('SELECT id, scan_date FROM orders ORDER BY id'))).all()
+            kept = (await conn.execute(text(
+                'SELECT order_id, scan_date FROM orders_invalid_scan_date ORDER BY order_id'))).all()
+            days = (await conn.execute(text('SELECT day FROM driver_daily_stats'))).all()
+            markers = (await conn.execute(text('SELECT name FROM job_status'))).all()
+        await engine.dispose()
+        return orders, kept, days, markers
+
+    orders, kept, days, markers = asyncio.run(inner())
+    assert orders == [(1, '2024-03-01'), (2, None), (3, None), (4, None)]
+    assert kept == [(2, '01/03/2024'), (3, '')]
+    # no NULL key in the rollup; it is rebuilt instead
+    assert days == [('2024-03-01',)] and markers == []
@@ -3,7 +3,6 @@ import httpx
 import asyncio
 import importlib
 import sys
-import datetime as dt
 from fastapi.testclient import TestClient
 
 sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
@@ -27,7 +26,7 @@ class DummyResponse:
 async def fake_get(self, url, auth=None, params=None):
     return DummyResponse({"orders": []})
 
-def test_scan_triggers_sheet_sync(monkeypatch):
+def test_scan_does_not_trigger_sheet_sync(monkeypatch):
     calls = []
     async def dummy_sync(date, session):
         calls.append(date)
@@ -39,4 +38,5 @@ def test_scan_triggers_sheet_sync(monkeypatch):
 
     resp = client.post("/scan?driver=abderrehman", json={"barcode": "#1111"})
     assert resp.status_code == 200
-    assert calls and calls[0] == dt.datetime.now().strftime("%Y-%m-%d")
+    # The verification sheet is imported by the background job, not per scan
+    assert calls == []
@@ -0,0 +1,109 @@
+import os, asyncio, sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from sqlalchemy import text
+
+
+def seed(app_main, app_db, app_models):
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            for d in ('se1', 'se2'):
+                if not await session.get(app_models.Driver, d):
+                    session.add(app_models.Driver(id=d))
+            await session.flush()
+            M = app_models.Order
+            session.add_all([
+                M(driver_id='se1', order_name='#987650', customer_phone='+212 600-000-001'),
+                M(driver_id='se2', order_name='#198765', customer_phone='0611111111'),
+                M(driver_id='se1', order_name='#98765', customer_phone='0622222222'),
+                M(driver_id='se2', order_name='#555', customer_phone='06 98 76 54 32'),
+                M(driver_id='se2', order_name='#ABC-77', customer_phone='0633333333'),
+            ])
+            await session.commit()
+            # rows written before the search columns existed
+            await app_main.search.backfill(session)
+    asyncio.run(inner())
+
+
+def test_search_ranks_exact_prefix_then_substring(app_env, count_queries):
+    app_main, app_db, app_models, client = app_env
+    seed(app_main, app_db, app_models)
+
+    queries = count_queries()
+
+    resp = client.get('/admin/search?q=%2398765')
+    assert resp.status_code == 200
+    assert [(o['orderName'], o['driver']) for o in resp.json()] == [
+        ('#98765', 'se1'),   # exact order number
+        ('#987650', 'se1'),  # prefix
+        ('#555', 'se2'),     # substring of the phone digits
+        ('#198765', 'se2'),  # substring of the order number
+    ]
+    assert 'X-Next-Cursor' not in resp.headers
+    assert len(queries) == 1
+
+    # formatting in the stored phone does not matter
+    assert [o['orderName'] for o in client.get('/admin/search?q=0611111111').json()] == ['#198765']
+    # short terms fall back to a plain substring match
+    assert '#555' in [o['orderName'] for o in client.get('/admin/search?q=55').json()]
+    # queries with letters match the raw name, case-insensitively
+    assert [o['orderName'] for o in client.get('/admin/search?q=%23abc').json()] == ['#ABC-77']
+    assert client.get('/admin/search?q=xyzzy').json() == []
+
+
+def test_search_pages_with_cursor(app_env):
+    app_main, app_db, app_models, client = app_env
+    seen = []
+    cursor = None
+    while True:
+        url = '/admin/search?q=98765&limit=3' + (f'&cursor={cursor}' if cursor else '')
+        resp = client.get(url)
+        seen += [o['orderName'] for o in resp.json()]
+        cursor = resp.headers.get('X-Next-Cursor')
+        if not cursor:
+            break
+    assert seen == ['#98765', '#987650', '#555', '#198765']
+    assert client.get('/admin/search?q=1&cursor=bad').status_code == 400
+
+
+def test_search_pages_by_default(app_env):
+    app_main, app_db, app_models, client = app_env
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, 'se3'):
+                session.add(app_models.Driver(id='se3'))
+            session.add_all([
+                app_models.Order(driver_id='se3', order_name=f'#PG-{n}', customer_phone='')
+                for n in range(55)
+            ])
+            await session.commit()
+    asyncio.run(inner())
+
+    # a short query must not return the whole table in one response
+    resp = client.get('/admin/search?q=pg-')
+    assert len(resp.json()) == 50
+    rest = client.get(f"/admin/search?q=pg-&cursor={resp.headers['X-Next-Cursor']}")
+    assert len(rest.json()) == 5 and 'X-Next-Cursor' not in rest.headers
+    assert len(client.get('/admin/search?q=pg-&limit=200').json()) == 55
+    assert client.get('/admin/search?q=pg-&limit=201').status_code == 422
+
+
+def test_new_scans_are_indexed(app_env):
+    app_main, app_db, app_models, client = app_env
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            order = app_models.Order(driver_id='se1', order_name='#424242', customer_phone='0700 11 22 33')
+            app_main.search.index_order(order)
+            session.add(order)
+            await session.commit()
+            plan = await session.execute(text(
+                "EXPLAIN QUERY PLAN SELECT rowid FROM orders_search WHERE orders_search MATCH '\"424\"'"
+            ))
+            return order.order_number, order.phone_digits, [row[-1] for row in plan]
+    number, phone, plan = asyncio.run(inner())
+    assert (number, phone) == ('424242', '0700112233')
+    assert any('VIRTUAL TABLE INDEX' in step for step in plan)
+    assert [o['orderName'] for o in client.get('/admin/search?q=0700112233').json()] == ['#424242']
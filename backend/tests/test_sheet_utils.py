@@ -13,6 +13,17 @@ class DummyWorksheet:
     def get_all_values(self):
         return self._rows
 
+    def batch_get(self, ranges):
+        # Supports the "1:1" and "A{n}:{col}" ranges used by the incremental reader
+        out = []
+        for rng in ranges:
+            if rng == "1:1":
+                out.append(self._rows[:1])
+            else:
+                start = int(rng.split(":")[0][1:])
+                out.append(self._rows[start - 1:])
+        return out
+
 class DummySheet:
     def __init__(self, rows):
         self.sheet1 = DummyWorksheet(rows)
@@ -89,3 +100,135 @@ def test_load_sheet_orders_missing_date(monkeypatch):
             "cod_total": "",
         }
     ]
+
+
+def test_snapshot_downloads_once_and_indexes(monkeypatch):
+    rows = [
+        ["Order Number", "Customer Name", "Phone"],
+        ["#1234", "Alice", "555"],
+        ["#1234", "Duplicate", ""],
+        ["5678", "Bob", "666"],
+    ]
+    calls = []
+    downloads = []
+    stub = make_gspread_stub(rows, calls)
+    sys.modules['gspread'] = stub
+    import app.sheet_utils as sheet_utils
+    importlib.reload(sheet_utils)
+    monkeypatch.setenv("GOOGLE_CREDENTIALS_B64", base64.b64encode(b'{"dummy": "yes"}').decode())
+    monkeypatch.setenv("SHEET_ID", "dummy")
+    monkeypatch.setattr(
+        DummyWorksheet,
+        "get_all_values",
+        lambda self: downloads.append(1) or self._rows,
+    )
+
+    assert sheet_utils.snapshot.stats()["ageSeconds"] is None
+    assert sheet_utils.get_order_from_sheet("#1234")["customer_name"] == "Alice"
+    assert sheet_utils.get_order_from_sheet("5678")["customer_phone"] == "666"
+    assert sheet_utils.get_order_from_sheet("#9999") is None
+    assert len(downloads) == 1
+
+    stats = sheet_utils.snapshot.stats()
+    assert stats["size"] == 2
+    assert stats["ageSeconds"] is not None
+
+    # An unchanged revision skips the fetch entirely
+    fetches = []
+    batch_get = DummyWorksheet.batch_get
+    monkeypatch.setattr(
+        DummyWorksheet, "batch_get", lambda self, r: fetches.append(r) or batch_get(self, r)
+    )
+    monkeypatch.setattr(DummySheet, "get_lastUpdateTime", lambda self: "rev-1", raising=False)
+    assert sheet_utils.snapshot.refresh()
+    assert sheet_utils.snapshot.refresh()
+    assert (len(downloads), len(fetches)) == (1, 1)
+
+
+def test_client_and_handles_are_reused(monkeypatch):
+    rows = [["Order", "Customer"], ["#111", "Alice"]]
+    calls = []
+    opened = []
+    sys.modules['gspread'] = make_gspread_stub(rows, calls)
+    import app.sheet_utils as sheet_utils
+    importlib.reload(sheet_utils)
+    monkeypatch.setenv("GOOGLE_CREDENTIALS_B64", base64.b64encode(b'{"dummy": "yes"}').decode())
+    monkeypatch.setenv("VERIFICATION_SHEET_ID", "dummy")
+    monkeypatch.setattr(
+        DummyClient, "open_by_key", lambda self, key: opened.append(key) or DummySheet(self._rows)
+    )
+
+    for _ in range(3):
+        assert sheet_utils.load_sheet_orders()[0]["order_name"] == "#111"
+    assert len(calls) == 1
+    assert opened == ["dummy"]
+
+    # An error drops the cached handle so the next call reopens the sheet
+    good = DummyWorksheet.batch_get
+    monkeypatch.setattr(DummyWorksheet, "batch_get", lambda self, r: 1 / 0)
+    assert sheet_utils.load_sheet_orders() == []
+    monkeypatch.setattr(DummyWorksheet, "batch_get", good)
+    assert sheet_utils.load_sheet_orders()
+    assert opened == ["dummy", "dummy"]
+    assert len(calls) == 1
+
+
+def test_credentials_file_fallback_is_removed(monkeypatch):
+    written = []
+
+    def from_dict(info):
+        raise ValueError("unsupported")
+
+    def from_file(filename):
+        written.append(filename)
+        assert os.path.exists(filename)
+        return DummyClient([])
+
+    sys.modules['gspread'] = types.SimpleNamespace(
+        service_account=from_file, service_account_from_dict=from_dict
+    )
+    import app.sheet_utils as sheet_utils
+    importlib.reload(sheet_utils)
+    monkeypatch.setenv("GOOGLE_CREDENTIALS_B64", base64.b64encode(b'{"dummy": "yes"}').decode())
+
+    assert sheet_utils._get_gspread_client() is not None
+    assert written and not os.path.exists(written[0])
+
+
+def test_incremental_reader_fetches_only_appended_rows(monkeypatch):
+    rows = [
+        ["Date", "Order", "Customer"],
+        ["2024-01-01", "#1", "Alice"],
+        ["2024-01-01", "#2", "Bob"],
+    ]
+    calls = []
+    full_reads = []
+    ranges = []
+    sys.modules['gspread'] = make_gspread_stub(rows, calls)
+    import app.sheet_utils as sheet_utils
+    importlib.reload(sheet_utils)
+    monkeypatch.setenv("GOOGLE_CREDENTIALS_B64", base64.b64encode(b'{"dummy": "yes"}').decode())
+    monkeypatch.setenv("VERIFICATION_SHEET_ID", "dummy")
+    monkeypatch.setattr(
+        DummyWorksheet, "get_all_values", lambda self: full_reads.append(1) or self._rows
+    )
+    batch_get = DummyWorksheet.batch_get
+    monkeypatch.setattr(
+        DummyWorksheet, "batch_get", lambda self, r: ranges.append(r[1]) or batch_get(self, r)
+    )
+
+    assert [o["order_name"] for o in sheet_utils.load_sheet_orders()] == ["#1", "#2"]
+    rows.append(["2024-01-02", "#3", "Carol"])
+    assert [o["order_name"] for o in sheet_utils.load_sheet_orders()] == ["#1", "#2", "#3"]
+    assert len(full_reads) == 1
+    assert ranges == ["A3:Z"]
+
+    # Rows deleted: the last known row no longer matches, so re-read in full
+    del rows[1:3]
+    assert [o["order_name"] for o in sheet_utils.load_sheet_orders()] == ["#3"]
+    assert len(full_reads) == 2
+
+    # Header change also forces a full re-read
+    rows[0] = ["Date", "Order", "Customer", "City"]
+    sheet_utils.load_sheet_orders()
+    assert len(full_reads) == 3
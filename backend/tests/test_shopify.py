@@ -0,0 +1,74 @@
+import os
+import sys
+import asyncio
+import datetime as dt
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+from app import shopify
+
+STORES = [
+    {"name": "a", "api_key": "k", "password": "p", "domain": "a.example.com"},
+    {"name": "b", "api_key": "k", "password": "p", "domain": "b.example.com"},
+]
+
+
+class DummyResponse:
+    def __init__(self, payload):
+        self._payload = payload
+    def raise_for_status(self):
+        pass
+    def json(self):
+        return self._payload
+
+
+def iso(days_ago):
+    ts = dt.datetime.now(dt.timezone.utc) - dt.timedelta(days=days_ago)
+    return ts.strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def test_find_order_queries_stores_concurrently(monkeypatch):
+    clients = set()
+    in_flight = []
+    peak = []
+
+    async def fake_get(self, url, auth=None, params=None):
+        clients.add(id(self))
+        in_flight.append(url)
+        peak.append(len(in_flight))
+        await asyncio.sleep(0.01)
+        in_flight.remove(url)
+        created = iso(5) if url.startswith("https://a.") else iso(1)
+        return DummyResponse({"orders": [{"name": params["name"], "created_at": created}]})
+
+    monkeypatch.setattr(httpx.AsyncClient, "get", fake_get)
+
+    async def run():
+        first = await shopify.find_order("#1", STORES)
+        second = await shopify.find_order("#1", STORES)
+        await shopify.close_client()
+        return first, second
+
+    (order, store), _ = asyncio.run(run())
+    assert store == "b"
+    assert order["name"] == "#1"
+    assert max(peak) == 2
+    assert len(clients) == 1
+
+
+def test_find_order_ignores_old_and_failed(monkeypatch):
+    async def fake_get(self, url, auth=None, params=None):
+        if url.startswith("https://a."):
+            raise httpx.ConnectError("boom")
+        return DummyResponse({"orders": [{"name": params["name"], "created_at": iso(90)}]})
+
+    monkeypatch.setattr(httpx.AsyncClient, "get", fake_get)
+
+    async def run():
+        try:
+            return await shopify.find_order("#2", STORES)
+        finally:
+            await shopify.close_client()
+
+    assert asyncio.run(run()) == (None, "")
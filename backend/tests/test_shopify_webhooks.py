@@ -0,0 +1,129 @@
+import os
+import sys
+import json
+import hmac
+import base64
+import hashlib
+import asyncio
+import datetime as dt
+import httpx
+from fastapi.testclient import TestClient
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+if os.path.exists("test.db"):
+    os.remove("test.db")
+
+os.environ["DATABASE_URL"] = "sqlite+aiosqlite:///test.db"
+
+from app import main as app_main
+
+SECRET = "hush"
+DOMAIN = "nouralibas.myshopify.com"
+
+
+def signed_post(client, topic, payload):
+    body = json.dumps(payload).encode()
+    sig = base64.b64encode(hmac.new(SECRET.encode(), body, hashlib.sha256).digest()).decode()
+    return client.post(
+        "/webhooks/shopify",
+        content=body,
+        headers={
+            "X-Shopify-Topic": topic,
+            "X-Shopify-Shop-Domain": DOMAIN,
+            "X-Shopify-Hmac-Sha256": sig,
+            "Content-Type": "application/json",
+        },
+    )
+
+
+async def dummy_sync(date, session):
+    pass
+
+
+def test_webhook_feeds_scan_without_shopify_call(monkeypatch):
+    monkeypatch.setitem(app_main.SHOPIFY_STORES[0], "webhook_secret", SECRET)
+    monkeypatch.setattr(app_main, "sync_verification_orders", dummy_sync)
+
+    async def no_network(self, url, auth=None, params=None):
+        raise AssertionError("live Shopify lookup on the scan path")
+
+    monkeypatch.setattr(httpx.AsyncClient, "get", no_network)
+    client = TestClient(app_main.app)
+    asyncio.run(app_main.init_db())
+
+    created = (dt.datetime.utcnow() - dt.timedelta(days=1)).strftime("%Y-%m-%dT%H:%M:%SZ")
+    order = {
+        "id": 9001,
+        "name": "#90001",
+        "created_at": created,
+        "updated_at": created,
+        "tags": "ch",
+        "fulfillment_status": None,
+        "total_price": "150.00",
+        "shipping_address": {"name": "Mirror Name", "phone": "0600", "address1": "Street", "city": "Rabat"},
+    }
+    resp = client.post("/webhooks/shopify", json=order, headers={"X-Shopify-Topic": "orders/create", "X-Shopify-Shop-Domain": DOMAIN, "X-Shopify-Hmac-Sha256": "bad"})
+    assert resp.status_code == 401
+
+    assert signed_post(client, "orders/create", order).status_code == 200
+    assert signed_post(client, "fulfillments/create", {"id": 1, "order_id": 9001, "status": "success"}).status_code == 200
+
+    resp = client.post("/scan?driver=abderrehman", json={"barcode": "90001"})
+    assert resp.status_code == 200
+    assert resp.json()["result"] == "✅ OK"
+
+    notes = client.get("/notes?driver=abderrehman").json()
+    note = client.get(f"/notes/{notes[0]['id']}?driver=abderrehman").json()
+    item = next(i for i in note["items"] if i["orderName"] == "#90001")
+    assert item["cashAmount"] == 150.0
+
+
+def test_out_of_order_update_is_ignored(monkeypatch):
+    monkeypatch.setitem(app_main.SHOPIFY_STORES[0], "webhook_secret", SECRET)
+    client = TestClient(app_main.app)
+    asyncio.run(app_main.init_db())
+
+    base = {"id": 9002, "name": "#90002", "created_at": "2024-01-01T00:00:00Z"}
+    assert signed_post(client, "orders/updated", {**base, "updated_at": "2024-01-03T00:00:00Z", "tags": "new"}).status_code == 200
+    assert signed_post(client, "orders/updated", {**base, "updated_at": "2024-01-02T00:00:00Z", "tags": "old"}).status_code == 200
+
+    async def fetch():
+        from sqlalchemy import select
+        from app.db import AsyncSessionLocal
+        from app.models import ShopifyOrder
+        async with AsyncSessionLocal() as session:
+            return await session.scalar(select(ShopifyOrder.tags).where(ShopifyOrder.shopify_id == 9002))
+
+    assert asyncio.run(fetch()) == "new"
+
+
+def test_concurrent_deliveries_of_one_order_both_succeed():
+    asyncio.run(app_main.init_db())
+    base = {"id": 9003, "name": "#90003", "created_at": "2024-01-01T00:00:00Z"}
+
+    async def deliver(payload):
+        from app.db import AsyncSessionLocal
+        async with AsyncSessionLocal() as session:
+            row = await app_main.shopify.upsert_order(session, "nouralibas", payload)
+            await session.commit()
+            return row.tags
+
+    async def race():
+        # orders/create and orders/updated arriving together
+        return await asyncio.gather(
+            deliver({**base, "updated_at": "2024-01-01T00:00:00Z", "tags": "created"}),
+            deliver({**base, "updated_at": "2024-01-02T00:00:00Z", "tags": "updated"}),
+        )
+
+    asyncio.run(race())
+
+    async def fetch():
+        from sqlalchemy import select
+        from app.db import AsyncSessionLocal
+        from app.models import ShopifyOrder
+        async with AsyncSessionLocal() as session:
+            rows = await session.execute(select(ShopifyOrder.tags).where(ShopifyOrder.shopify_id == 9003))
+            return rows.scalars().all()
+
+    assert asyncio.run(fetch()) == ["updated"]
@@ -0,0 +1,224 @@
+import os, asyncio, sys
+import datetime as dt
+from sqlalchemy import select, delete
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
+
+
+def seed(app_main, app_db, app_models):
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            for d in ('st1', 'st2', 'st3'):
+                if not await session.get(app_models.Driver, d):
+                    session.add(app_models.Driver(id=d))
+            M = app_models.Order
+            session.add_all([
+                M(driver_id='st1', order_name='#S1', delivery_status='Livré', scan_date=dt.date(2024, 3, 1), cash_amount=100, driver_fee=10),
+                M(driver_id='st1', order_name='#S2', delivery_status='Paid', scan_date=dt.date(2024, 3, 2), cash_amount=50, driver_fee=5),
+                M(driver_id='st1', order_name='#S3', delivery_status='Returned', scan_date=dt.date(2024, 3, 2), cash_amount=30, return_pending=0),
+                M(driver_id='st1', order_name='#S4', delivery_status='Refusé', scan_date=dt.date(2024, 3, 3), cash_amount=20, return_pending=1),
+                M(driver_id='st1', order_name='#S5', delivery_status='Dispatched', scan_date=dt.date(2024, 3, 5), cash_amount=70),
+                # never counted without a scan date
+                M(driver_id='st1', order_name='#S6', delivery_status='Livré', scan_date=None, cash_amount=1),
+            ])
+            await session.commit()
+            await app_main.stats.rebuild(session)
+    asyncio.run(inner())
+
+
+def test_stats_match_response_shape(app_env):
+    app_main, app_db, app_models, client = app_env
+    seed(app_main, app_db, app_models)
+
+    stats = client.get('/stats?driver=st1&start=2024-03-01&end=2024-03-04').json()
+    assert stats == {
+        'totalOrders': 4,
+        'delivered': 2,
+        'returned': 1,
+        'pendingReturns': 1,
+        'totalCollect': 150.0,
+        'totalFees': 15.0,
+        'deliveryRate': 50.0,
+        'canceledAmount': 30.0,
+    }
+    # without a range every order with a scan day counts
+    assert client.get('/stats?driver=st1').json()['totalOrders'] == 5
+    assert client.get('/stats?driver=st1&start=bad').status_code == 400
+    assert client.get('/stats?driver=nobody').status_code == 400
+
+
+def test_admin_stats_is_one_rollup_query(app_env, count_queries):
+    app_main, app_db, app_models, client = app_env
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            for d in ('st2', 'st3'):
+                if not await session.get(app_models.Driver, d):
+                    session.add(app_models.Driver(id=d))
+            session.add(app_models.Order(driver_id='st2', order_name='#S8', delivery_status='Annulé',
+                                         scan_date=dt.date(2024, 3, 1), cash_amount=40, return_pending=0))
+            await session.commit()
+            await app_main.stats.rebuild(session)
+    asyncio.run(inner())
+
+    queries = count_queries()
+
+    data = client.get('/admin/stats?start=2024-03-01&end=2024-03-04').json()
+    # the driver list plus one GROUP BY over the rollup
+    assert len(queries) == 2
+    assert data['st2'] == {
+        'totalOrders': 1,
+        'delivered': 0,
+        'returned': 1,
+        'pendingReturns': 0,
+        'totalCollect': 0.0,
+        'totalFees': 0.0,
+        'deliveryRate': 0.0,
+        'canceledAmount': 40.0,
+    }
+    assert data['st3']['totalOrders'] == 0 and data['st3']['deliveryRate'] == 0
+
+
+def rollup_rows(app_main, app_db, app_models, driver):
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            M = app_models.DriverDailyStats
+            rows = await session.execute(
+                app_main.select(M.day, *(getattr(M, c) for c in app_main.stats.COUNTERS))
+                .where(M.driver_id == driver)
+                .order_by(M.day)
+            )
+            return [tuple(r) for r in rows]
+    return asyncio.run(inner())
+
+
+def test_write_paths_keep_rollup_in_sync(app_env):
+    app_main, app_db, app_models, client = app_env
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            if not await session.get(app_models.Driver, 'roll'):
+                session.add(app_models.Driver(id='roll'))
+            M = app_models.Order
+            session.add_all([
+                M(driver_id='roll', order_name='#W1', delivery_status='Dispatched', scan_date=dt.date(2024, 4, 1), cash_amount=100),
+                M(driver_id='roll', order_name='#W2', delivery_status='Dispatched', scan_date=dt.date(2024, 4, 1), cash_amount=60),
+                M(driver_id='roll', order_name='#W3', delivery_status='Dispatched', scan_date=dt.date(2024, 4, 2), cash_amount=40),
+            ])
+            await session.commit()
+            await app_main.stats.rebuild(session, dt.date(2024, 4, 1), dt.date(2024, 4, 2))
+    asyncio.run(inner())
+
+    def put(name, **body):
+        resp = client.put('/order/status?driver=roll', json={'order_name': name, **body})
+        assert resp.status_code == 200
+
+    put('#W1', new_status='Livré')
+    put('#W2', new_status='Returned')
+    put('#W3', new_status='Livré', cash_amount=45)
+    assert client.post('/order/accept-return?driver=roll', json={'order_name': '#W2'}).status_code == 200
+    payout_id = client.get('/payouts?driver=roll').json()[0]['payoutId']
+    assert client.post(f'/payout/mark-paid/{payout_id}?driver=roll').status_code == 200
+    assert client.post(f'/payout/mark-unpaid/{payout_id}?driver=roll').status_code == 200
+    put('#W3', new_status='Dispatched')
+
+    tracked = rollup_rows(app_main, app_db, app_models, 'roll')
+
+    async def rebuild():
+        async with app_db.AsyncSessionLocal() as session:
+            await app_main.stats.rebuild(session)
+    asyncio.run(rebuild())
+    assert tracked == rollup_rows(app_main, app_db, app_models, 'roll')
+    assert tracked == [
+        (dt.date(2024, 4, 1), 2, 1, 1, 0, 100.0, 20.0, 60.0),
+        (dt.date(2024, 4, 2), 1, 0, 0, 0, 0.0, 0.0, 0.0),
+    ]
+
+
+def test_trends_are_one_grouped_query(app_env, count_queries):
+    app_main, app_db, app_models, client = app_env
+
+    async def inner():
+        async with app_db.AsyncSessionLocal() as session:
+            for d in ('tr1', 'tr2'):
+                if not await session.get(app_models.Driver, d):
+                    session.add(app_models.Driver(id=d))
+            await session.flush()
+            merchant = app_models.Merchant(name='Shop A')
+            session.add(merchant)
+            await session.flush()
+            await session.execute(app_models.merchant_driver_table.insert().values(
+                merchant_id=merchant.id, driver_id='tr1'))
+            M = app_models.Order
+            session.add_all([
+                M(driver_id='tr1', order_name='#T1', delivery_status='Livré', scan_date=dt.date(2023, 5, 1), store='irrakids'),
+                M(driver_id='tr1', order_name='#T2', delivery_status='Paid', scan_date=dt.date(2023, 5, 3), store='irranova'),
+                M(driver_id='tr2', order_name='#T3', delivery_status='Livré', scan_date=dt.date(2023, 5, 3), store='irrakids'),
+                M(driver_id='tr2', order_name='#T4', delivery_status='Dispatched', scan_date=dt.date(2023, 5, 2), store='irrakids'),
+            ])
+            await session.commit()
+            await app_main.stats.rebuild(session, dt.date(2023, 5, 1), dt.date(2023, 5, 31))
+    asyncio.run(inner())
+
+    queries = count_queries()
+
+    rng = 'start=2023-05-01&end=2023-05-03'
+    assert client.get(f'/admin/trends?{rng}').json() == [
+        {'date': '2023-05-01', 'delivered': 1},
+        {'date': '2023-05-02', 'delivered': 0},
+        {'date': '2023-05-03', 'delivered': 2},
+    ]
+    assert len(queries) == 1
+
+    by_driver = client.get(f'/admin/trends?{rng}&by=driver').json()
+    assert [d['breakdown'] for d in by_driver] == [
+        {'tr1': 1, 'tr2': 0}, {'tr1': 0, 'tr2': 0}, {'tr1': 1, 'tr2': 1},
+    ]
+    by_store = client.get(f'/admin/trends?{rng}&by=store').json()
+    assert by_store[2] == {'date': '2023-05-03', 'delivered': 2,
+                           'breakdown': {'irrakids': 1, 'irranova': 1}}
+    by_merchant = client.get(f'/admin/trends?{rng}&by=merchant').json()
+    assert [(d['delivered'], d['breakdown']) for d in by_merchant] == [
+        (1, {'Shop A': 1}), (0, {'Shop A': 0}), (2, {'Shop A': 1}),
+    ]
+    assert len(queries) == 4
+    assert client.get(f'/admin/trends?{rng}&by=city').status_code == 422
+
+
+def test_upgrade_builds_rollup_before_tracking(app_env):
+    app_main, app_db, app_models, client = app_env
+    M = app_models.Order
+
+    async def forget_build():
+        async with app_db.AsyncSessionLocal() as session:
+            await session.execute(delete(app_models.JobStatus).where(
+                app_models.JobStatus.name == app_main.stats.ROLLUP_MARKER))
+            await session.execute(delete(app_models.DriverDailyStats).where(
+                app_models.DriverDailyStats.driver_id == 'st4'))
+            if not await session.get(app_models.Driver, 'st4'):
+                session.add(app_models.Driver(id='st4'))
+            # written before the rollup existed
+            session.add(M(driver_id='st4', order_name='#S9', delivery_status='Livré',
+                          scan_date=dt.date(2024, 4, 1), cash_amount=60, driver_fee=6))
+            await session.commit()
+        app_main.stats._built.clear()
+    asyncio.run(forget_build())
+
+    async def edit_and_scan():
+        async with app_db.AsyncSessionLocal() as session:
+            order = await session.scalar(select(M).where(M.order_name == '#S9'))
+            before = app_main.stats.contribution(order)
+            order.delivery_status = 'Returned'
+            new = M(driver_id='st4', order_name='#S10', delivery_status='Dispatched',
+                    scan_date=dt.date(2024, 4, 1))
+            session.add(new)
+            await app_main.stats.track(session, [before], [order, new])
+            await session.commit()
+    asyncio.run(edit_and_scan())
+    # nothing is written, not even a negative delta, until the rollup is built
+    assert client.get('/stats?driver=st4').json()['totalOrders'] == 0
+
+    asyncio.run(app_main.init_db())
+    stats = client.get('/stats?driver=st4').json()
+    assert stats['totalOrders'] == 2 and stats['pendingReturns'] == 1 and stats['delivered'] == 0
+    assert 'stats_rollup' in [j['name'] for j in client.get('/admin/jobs').json()]
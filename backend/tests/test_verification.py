@@ -62,6 +62,13 @@ def test_verify_endpoint(monkeypatch):
     client = TestClient(app_main.app)
     asyncio.run(app_main.init_db())
 
+    resp = client.get("/admin/verify?date=2024-01-01")
+    assert resp.status_code == 200
+    assert resp.json()["total"] == 0  # nothing imported yet
+
+    resp = client.post("/admin/verify/sync?date=2024-01-01")
+    assert resp.json()["created"] == 1
+
     resp = client.get("/admin/verify?date=2024-01-01")
     assert resp.status_code == 200
     data = resp.json()
@@ -99,6 +106,7 @@ def test_verify_endpoint_defaults_date(monkeypatch):
     client = TestClient(app_main.app)
     asyncio.run(app_main.init_db())
 
+    client.post("/admin/verify/sync?date=2024-01-02")
     resp = client.get("/admin/verify?date=2024-01-02")
     assert resp.status_code == 200
     data = resp.json()
@@ -128,8 +136,135 @@ def test_verify_endpoint_deduplicates(monkeypatch):
     client = TestClient(app_main.app)
     asyncio.run(app_main.init_db())
 
+    resp = client.post("/admin/verify/sync?start=2024-01-01&end=2024-01-02")
+    assert resp.json()["days"] == {"2024-01-01": 1, "2024-01-02": 0}
     resp = client.get("/admin/verify?start=2024-01-01&end=2024-01-02")
     assert resp.status_code == 200
     data = resp.json()
     assert data["total"] == 1
     assert data["rows"][0]["orderName"] == "#333"
+
+
+def test_sync_backfills_driver_from_latest_scan(monkeypatch):
+    if os.path.exists("test.db"):
+        os.remove("test.db")
+    from app import main as app_main
+    from app.db import AsyncSessionLocal
+    from app.models import Order, VerificationOrder
+    from sqlalchemy import select
+    import datetime as dt
+
+    rows = [
+        {"order_name": "#444", "order_date": "2024-01-05", "customer_name": "Eve"},
+        {"order_name": "#555", "order_date": "2024-01-05", "customer_name": "Sam"},
+        {"order_name": "#666", "order_date": "2024-01-06", "customer_name": "Other day"},
+    ]
+    monkeypatch.setattr(app_main, "load_sheet_orders", lambda: rows)
+    asyncio.run(app_main.init_db())
+
+    async def scenario():
+        async with AsyncSessionLocal() as session:
+            session.add(VerificationOrder(order_date="2024-01-05", order_name="#444"))
+            session.add_all(
+                [
+                    Order(driver_id="anouar", order_name="#444", timestamp=dt.datetime(2024, 1, 5, 9)),
+                    Order(driver_id="nizar", order_name="#444", timestamp=dt.datetime(2024, 1, 5, 11)),
+                    Order(driver_id="mohammed", order_name="#555", timestamp=dt.datetime(2024, 1, 5, 10)),
+                ]
+            )
+            await session.commit()
+            created = await app_main.sync_verification_orders("2024-01-05", session)
+            result = await session.execute(
+                select(VerificationOrder).order_by(VerificationOrder.order_name)
+            )
+            return created, [(v.order_name, v.driver_id) for v in result.scalars()]
+
+    created, stored = asyncio.run(scenario())
+    assert created == 1
+    assert stored == [("#444", "nizar"), ("#555", "mohammed")]
+
+
+def test_range_sync_downloads_sheet_once(monkeypatch):
+    if os.path.exists("test.db"):
+        os.remove("test.db")
+    from app import main as app_main
+
+    downloads = []
+    rows = [
+        {"order_name": "#701", "order_date": "2024-02-01"},
+        {"order_name": "#702", "order_date": "2024-02-03"},
+        {"order_name": "#703", "order_date": "2024-02-03"},
+        {"order_name": "#704", "order_date": "2024-03-01"},
+    ]
+    monkeypatch.setattr(app_main, "load_sheet_orders", lambda: downloads.append(1) or rows)
+    client = TestClient(app_main.app)
+    asyncio.run(app_main.init_db())
+
+    resp = client.post("/admin/verify/sync?start=2024-02-01&end=2024-02-03")
+    assert resp.status_code == 200
+    assert resp.json() == {
+        "success": True,
+        "created": 3,
+        "days": {"2024-02-01": 1, "2024-02-02": 0, "2024-02-03": 2},
+    }
+    assert len(downloads) == 1
+
+
+def test_sync_job_covers_trailing_days(monkeypatch):
+    from app import main as app_main
+    from app import db as app_db
+    from app.models import VerificationOrder
+    from sqlalchemy import select
+    import datetime as dt
+
+    today = dt.datetime.now().date()
+    rows = [
+        {"order_name": "#801", "order_date": (today - dt.timedelta(days=2)).isoformat()},
+        {"order_name": "#802", "order_date": ""},
+        {"order_name": "#803", "order_date": (today - dt.timedelta(days=30)).isoformat()},
+    ]
+    monkeypatch.setattr(app_main, "load_sheet_orders", lambda: rows)
+    monkeypatch.setattr(app_main, "VERIFICATION_SYNC_DAYS", 3)
+    asyncio.run(app_main.init_db())
+
+    async def scenario():
+        async with app_db.AsyncSessionLocal() as session:
+            created = await app_main.verification_sync_job(session)
+            result = await session.execute(
+                select(VerificationOrder.order_name, VerificationOrder.order_date)
+                .where(VerificationOrder.order_name.in_(["#801", "#802", "#803"]))
+                .order_by(VerificationOrder.order_name)
+            )
+            return created, result.all()
+
+    created, stored = asyncio.run(scenario())
+    assert created == 2
+    assert [name for name, _ in stored] == ["#801", "#802"]
+    assert str(stored[1][1]) == today.isoformat()
+
+
+def test_large_import_stays_under_sqlite_parameter_limit(monkeypatch):
+    from sqlalchemy import event
+    from app import main as app_main
+    from app import db as app_db
+
+    rows = [{"order_name": f"#B{n}", "order_date": "2024-05-01"} for n in range(1000)]
+    monkeypatch.setattr(app_main, "load_sheet_orders", lambda: rows)
+    asyncio.run(app_main.init_db())
+
+    params = []
+
+    def record(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            params.append(len(parameters))
+
+    event.listen(app_db.engine.sync_engine, "before_cursor_execute", record)
+    try:
+        async def run():
+            async with app_db.AsyncSessionLocal() as session:
+                return await app_main.sync_verification_orders("2024-05-01", session)
+        assert asyncio.run(run()) == 1000
+    finally:
+        event.remove(app_db.engine.sync_engine, "before_cursor_execute", record)
+    # two batches, each looked up in verification_orders and orders
+    assert len(params) == 4 and max(params) <= 999
@@ -1,16 +1,197 @@
-import os
-import pytest
+import os, asyncio, sys
+from sqlalchemy import select
 
-pytest.skip("websocket tests not implemented", allow_module_level=True)
+sys.path.insert(0, os.path.dirname(os.path.dirname(__file__)))
 
-# Use in-memory SQLite for tests
-os.environ.setdefault('DATABASE_URL', 'sqlite+aiosqlite:///:memory:')
 
-# The websocket logic requires FastAPI's TestClient. Keeping import
-from fastapi.testclient import TestClient
-from app.main import app
+class FakeSocket:
+    def __init__(self, fail=False, block=False):
+        self.sent = []
+        self.fail = fail
+        self.block = block
+        self.closed = None
 
-client = TestClient(app)
+    async def accept(self):
+        pass
 
-# Placeholder test to ensure WebSocket endpoint is reachable
-# Actual assertions are skipped above
+    async def send_json(self, data):
+        if self.fail:
+            raise RuntimeError('gone')
+        if self.block:
+            await asyncio.Event().wait()
+        self.sent.append(data)
+
+    async def close(self, code=1000):
+        self.closed = code
+
+
+async def drain():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_broadcast_reaches_only_subscribed_sockets():
+    from app import realtime
+
+    async def inner():
+        manager = realtime.ConnectionManager()
+        d1, d2, admin, broken = FakeSocket(), FakeSocket(), FakeSocket(), FakeSocket(fail=True)
+        await manager.connect(d1, [realtime.driver_topic('d1')])
+        await manager.connect(d2, [realtime.driver_topic('d2')])
+        await manager.connect(admin, [realtime.ADMIN_TOPIC])
+        await manager.connect(broken, [realtime.driver_topic('d1')])
+
+        await manager.broadcast({'type': 'new_order', 'driver': 'd1', 'order': '#1'})
+        await drain()
+        assert [m['order'] for m in d1.sent] == ['#1']
+        assert d2.sent == []
+        assert [m['order'] for m in admin.sent] == ['#1']
+        # failing sockets are dropped from every topic
+        assert broken not in manager.active
+        assert manager.topics[realtime.driver_topic('d1')] == {d1}
+
+        manager.disconnect(d2)
+        assert realtime.driver_topic('d2') not in manager.topics
+        for ws in manager.active:
+            manager.disconnect(ws)
+    asyncio.run(inner())
+
+
+def test_slow_sockets_coalesce_then_get_closed():
+    from app import realtime
+
+    async def inner():
+        manager = realtime.ConnectionManager(queue_size=2, send_timeout=0.05)
+        slow, fast = FakeSocket(block=True), FakeSocket()
+        await manager.connect(slow, [realtime.ADMIN_TOPIC])
+        await manager.connect(fast, [realtime.ADMIN_TOPIC])
+
+        # broadcast returns without waiting on the stuck socket
+        await manager.broadcast({'type': 'status_update', 'driver': 'd1', 'order': '#1'})
+        await drain()
+        for n in range(2, 5):
+            await manager.broadcast({'type': 'status_update', 'driver': 'd1', 'order': f'#{n}'})
+        await manager.broadcast({'type': 'new_order', 'driver': 'd1', 'order': '#5'})
+        stats = manager.stats()
+        assert stats['coalesced'] == 4  # #3 and #4 replace the queued #2 on both sockets
+        assert stats['maxQueueDepth'] == 2 and stats['dropped'] == 0
+        await drain()
+        assert [m['order'] for m in fast.sent] == ['#1', '#4', '#5']
+
+        # a third distinct event overflows the slow socket's queue
+        await manager.broadcast({'type': 'note_update', 'driver': 'd1', 'noteId': 1})
+        assert len(manager.closing) == 1
+        await drain()
+        assert not manager.closing
+        assert slow not in manager.active and slow.closed == 1013
+        stats = manager.stats()
+        assert stats['connections'] == 1 and stats['slowDisconnects'] == 1
+        assert stats['dropped'] == 3
+
+        # a send that outlives the timeout closes the socket too
+        stuck = FakeSocket(block=True)
+        await manager.connect(stuck, [realtime.ADMIN_TOPIC])
+        await manager.broadcast({'type': 'new_order', 'driver': 'd2'})
+        await asyncio.sleep(0.1)
+        assert stuck not in manager.active and stuck.closed == 1013
+        assert manager.stats()['slowDisconnects'] == 2
+        writer = manager.connections[fast].writer
+        await manager.shutdown()
+        assert manager.active == [] and writer.done()
+    asyncio.run(inner())
+
+
+def test_ws_topics_from_query_cookie_and_subscribe(app_env):
+    app_main, app_db, app_models, client = app_env
+
+    async def create_agent():
+        async with app_db.AsyncSessionLocal() as session:
+            for d in ('wsd1', 'wsd2'):
+                if not await session.get(app_models.Driver, d):
+                    session.add(app_models.Driver(id=d))
+            await session.flush()
+            if not await session.scalar(select(app_models.Agent).where(app_models.Agent.username == 'wsagent')):
+                session.add(app_models.Agent(
+                    username='wsagent', password='x',
+                    drivers=[await session.get(app_models.Driver, 'wsd1')],
+                ))
+            await session.commit()
+    asyncio.run(create_agent())
+
+    with client.websocket_connect('/ws?driver=wsd2') as ws:
+        ws.send_json({'type': 'subscribe', 'agent': 'wsagent'})
+        assert ws.receive_json() == {'type': 'subscribed', 'topics': ['driver:wsd1', 'driver:wsd2']}
+
+    with client.websocket_connect('/ws', cookies={'agent': 'wsagent'}) as ws:
+        ws.send_json({'type': 'subscribe'})
+        assert ws.receive_json()['topics'] == ['driver:wsd1']
+
+    # clients that ask for nothing keep receiving every event
+    with client.websocket_connect('/ws') as ws:
+        ws.send_json({'type': 'subscribe'})
+        assert ws.receive_json()['topics'] == ['admin']
+
+    assert app_main.manager.active == []
+    assert client.get('/admin/ws').json()['connections'] == 0
+
+
+def test_redis_backend_delivers_across_workers():
+    import fakeredis
+    from app import realtime
+
+    async def inner():
+        server = fakeredis.FakeServer()
+        workers = []
+        for _ in range(2):
+            manager = realtime.ConnectionManager()
+            client = fakeredis.aioredis.FakeRedis(server=server, decode_responses=True)
+            manager.backend = realtime.RedisBroadcast(client, manager.deliver)
+            workers.append((manager, asyncio.create_task(manager.backend.run())))
+        (a, _), (b, _) = workers
+        on_a, on_b, other = FakeSocket(), FakeSocket(), FakeSocket()
+        await a.connect(on_a, [realtime.driver_topic('d1')])
+        await b.connect(on_b, [realtime.ADMIN_TOPIC])
+        await b.connect(other, [realtime.driver_topic('d2')])
+        for _ in range(50):
+            # wait until both workers are subscribed
+            if await client.pubsub_numsub(realtime.WS_REDIS_CHANNEL) == [(realtime.WS_REDIS_CHANNEL, 2)]:
+                break
+            await asyncio.sleep(0.01)
+
+        await a.broadcast({'type': 'new_order', 'driver': 'd1', 'order': '#1'})
+        for _ in range(50):
+            if on_a.sent and on_b.sent:
+                break
+            await asyncio.sleep(0.01)
+        # published once, delivered once by each worker
+        assert a.backend.published == 1 and b.backend.published == 0
+        assert [m['order'] for m in on_a.sent] == ['#1']
+        assert [m['order'] for m in on_b.sent] == ['#1']
+        assert other.sent == []
+        assert (a.backend.received, b.backend.received) == (1, 1)
+
+        for manager, task in workers:
+            task.cancel()
+            for ws in manager.active:
+                manager.disconnect(ws)
+        await asyncio.gather(*(task for _, task in workers), return_exceptions=True)
+    asyncio.run(inner())
+
+
+def test_redis_backend_falls_back_to_local_delivery():
+    from app import realtime
+
+    class DownRedis:
+        async def publish(self, channel, message):
+            raise ConnectionError('down')
+
+    async def inner():
+        manager = realtime.ConnectionManager()
+        manager.backend = realtime.RedisBroadcast(DownRedis(), manager.deliver)
+        ws = FakeSocket()
+        await manager.connect(ws, [realtime.ADMIN_TOPIC])
+        await manager.broadcast({'type': 'new_order', 'driver': 'd1'})
+        await drain()
+        assert [m['type'] for m in ws.sent] == ['new_order']
+        manager.disconnect(ws)
+    asyncio.run(inner())